@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+"""
+backfills.py -- registered mapper jobs for data fixes & schema changes
+
+Start one from the admin handler, e.g.
+    POST /admin/mappers  mapper=conference_month&shards=4
+
+Every function here must be safe to run more than once on an entity.
+
+"""
+
+import facets
+import mapper
+
+
+@mapper.register('conference_month', 'Conference')
+def conferenceMonth(conf):
+    """Recompute Conference.month from startDate."""
+    month = conf.startDate.month if conf.startDate else 0
+    if conf.month != month:
+        conf.month = month
+        return conf
+
+
+@mapper.register('session_type', 'Session')
+def sessionType(sess):
+    """Normalize typeOfSession to stripped, title-cased strings."""
+    if sess.typeOfSession:
+        normalized = ' '.join(sess.typeOfSession.split()).title()
+        if normalized != sess.typeOfSession:
+            sess.typeOfSession = normalized
+            return sess
+
+
+@mapper.register('session_resave', 'Session')
+def sessionResave(sess):
+    """Re-put a Session so newly added indexed properties get written."""
+    return sess
+
+
+@mapper.register('session_facets', 'Conference')
+def sessionFacets(conf):
+    """Rebuild a conference's session facet counts from its sessions."""
+    facets.rebuild(conf.key)
+
+
+@mapper.register('conference_resave', 'Conference')
+def conferenceResave(conf):
+    """Re-put a Conference so computed dateBuckets get written."""
+    return conf
+
+
+@mapper.register('wishlist_resave', 'WishList')
+def wishlistResave(item):
+    """Re-put a WishList entry so it gets a changeSeq for getChangesSince."""
+    return item
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+benchmark_encoding.py -- JSON vs protobuf size and speed for list responses
+
+    python benchmark_encoding.py [--sdk ~/google_appengine] [--items 1000,5000]
+
+Builds ConferenceForms and SessionForms lists of each size and reports,
+for protorpc's JSON and protobuf codecs, the payload size (raw and
+gzipped) and the mean encode and decode time.  Needs protorpc, which
+ships with the App Engine SDK.
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import gzip
+import io
+import random
+import time
+
+
+def conferenceForms(n, rnd):
+    from models import ConferenceForm, ConferenceForms
+    return ConferenceForms(items=[ConferenceForm(
+        name='Conference %d' % i,
+        description='A conference about topic %d. ' % (i % 7) * 4,
+        organizerUserId='user%d@example.com' % rnd.randint(0, 500),
+        topics=['Topic %d' % (i % 5), 'Topic %d' % (i % 3)],
+        city=rnd.choice(['London', 'Paris', 'Tokyo']),
+        startDate='2016-%02d-%02d' % (1 + i % 12, 1 + i % 28),
+        month=1 + i % 12,
+        maxAttendees=rnd.randint(10, 1000),
+        seatsAvailable=rnd.randint(0, 10),
+        endDate='2016-%02d-%02d' % (1 + i % 12, 1 + i % 28),
+        websafeKey='ag9zfmNvbmZlcmVuY2UtYXBwcjQLEgdQcm9maWxlIg%08d' % i,
+        organizerDisplayName='Organizer %d' % (i % 50))
+        for i in range(n)])
+
+
+def sessionForms(n, rnd):
+    from models import SessionForm, SessionForms
+    return SessionForms(items=[SessionForm(
+        name='Session %d' % i,
+        highlights='What you will learn in session %d. ' % i * 3,
+        speaker='Speaker %d' % rnd.randint(0, 40),
+        duration=rnd.choice([30, 45, 60, 90]),
+        typeOfSession=rnd.choice(['Talk', 'Workshop', 'Keynote']),
+        date='2016-%02d-%02d' % (1 + i % 12, 1 + i % 28),
+        startTime=rnd.randint(8, 20),
+        organizerUserId='user%d@example.com' % rnd.randint(0, 500),
+        websafeKey='ag9zfmNvbmZlcmVuY2UtYXBwcjQLEgdQcm9maWxlIg%08d' % i)
+        for i in range(n)])
+
+
+def _gzipped(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+    return len(out.getvalue())
+
+
+def _mean(func, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+def measure(codec, message, repeat):
+    """Return (bytes, gzipped bytes, encode ms, decode ms)."""
+    data = codec.encode_message(message)
+    encode = _mean(lambda: codec.encode_message(message), repeat)
+    decode = _mean(lambda: codec.decode_message(type(message), data), repeat)
+    return len(data), _gzipped(data), 1000 * encode, 1000 * decode
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sdk', help='App Engine SDK directory')
+    parser.add_argument('--items', default='100,1000,5000')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    try:
+        from loadgen import setupSdk
+        setupSdk(args.sdk)
+        from protorpc import protobuf, protojson
+    except ImportError:
+        parser.error('App Engine SDK not found; pass its directory with --sdk')
+
+    rnd = random.Random(42)
+    print('%-16s %6s %-9s %11s %11s %10s %10s' % (
+        'message', 'items', 'codec', 'bytes', 'gzipped', 'encode ms', 'decode ms'))
+    for n in [int(i) for i in args.items.split(',')]:
+        for label, build in (('ConferenceForms', conferenceForms),
+                             ('SessionForms', sessionForms)):
+            message = build(n, rnd)
+            for name, codec in (('json', protojson), ('protobuf', protobuf)):
+                size, gzipped, encode, decode = measure(codec, message, args.repeat)
+                print('%-16s %6d %-9s %11d %11d %10.2f %10.2f' % (
+                    label, n, name, size, gzipped, encode, decode))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""
+benchmark_storage.py -- run one workload against each storage backend
+
+    python benchmark_storage.py [--backends sqlite,ndb] [--conferences 50]
+
+The SQLite backend runs on any machine.  The ndb backend needs the App
+Engine SDK on sys.path and runs against the local testbed stubs; it is
+skipped with a note when the SDK can't be imported.
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import repository
+
+
+def _timed(results, name, func, *args):
+    start = time.time()
+    value = func(*args)
+    results.setdefault(name, []).append(time.time() - start)
+    return value
+
+
+def workload(repo, conferences, sessions, users, seed=42):
+    """Run the shared mixed workload; return {operation: [seconds]}."""
+    rnd = random.Random(seed)
+    results = {}
+    user_ids = ['user%d' % i for i in range(users)]
+    for u in user_ids:
+        _timed(results, 'getOrCreateProfile', repo.getOrCreateProfile,
+               u, u, '%s@example.com' % u)
+
+    conf_keys = []
+    for i in range(conferences):
+        conf_keys.append(_timed(
+            results, 'createConference', repo.createConference,
+            rnd.choice(user_ids),
+            {'name': 'Conference %d' % i, 'city': rnd.choice(['London', 'Paris']),
+             'topics': ['Topic %d' % (i % 5)], 'maxAttendees': users,
+             'seatsAvailable': users, 'month': 1 + i % 12}))
+
+    session_keys = []
+    for c_key in conf_keys:
+        session_keys.extend(_timed(
+            results, 'createSessions', repo.createSessions, c_key, 'organizer',
+            [{'name': 'Session %d' % j, 'speaker': 'Speaker %d' % rnd.randint(0, 20),
+              'typeOfSession': rnd.choice(['Talk', 'Workshop']),
+              'startTime': rnd.randint(8, 20), 'duration': 60}
+             for j in range(sessions)]))
+
+    for u in user_ids:
+        for c_key in rnd.sample(conf_keys, min(3, len(conf_keys))):
+            _timed(results, 'register', repo.register, u, c_key)
+        for s_key in rnd.sample(session_keys, min(5, len(session_keys))):
+            _timed(results, 'addToWishlist', repo.addToWishlist, u, s_key)
+
+    for _ in range(conferences * 4):
+        c_key = rnd.choice(conf_keys)
+        _timed(results, 'getConference', repo.getConference, c_key)
+        _timed(results, 'sessionsForConference', repo.sessionsForConference, c_key)
+        _timed(results, 'sessionsByType', repo.sessionsForConference, c_key, 'Talk')
+    for u in user_ids:
+        _timed(results, 'wishlistSessions', repo.wishlistSessions, u)
+        _timed(results, 'getConferences', repo.getConferences,
+               repo.getProfile(u)['conferenceKeysToAttend'])
+    for i in range(20):
+        _timed(results, 'sessionsBySpeaker', repo.sessionsBySpeaker, 'Speaker %d' % i)
+
+    for c_key in rnd.sample(conf_keys, max(1, conferences // 10)):
+        organizer = repo.getConference(c_key)['organizerUserId']
+        _timed(results, 'deleteConference', repo.deleteConference, c_key, organizer)
+        _timed(results, 'getConference', repo.getConference, c_key)
+    return results
+
+
+def _ndbRepository():
+    """Build an NdbRepository on testbed stubs, or None without the SDK."""
+    try:
+        from google.appengine.ext import testbed
+    except ImportError:
+        return None, None
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    from google.appengine.ext import ndb
+    ndb.get_context().clear_cache()
+    return repository.get('ndb'), bed
+
+
+def _report(name, results):
+    print('%s:' % name)
+    print('  %-24s %8s %10s %10s' % ('operation', 'calls', 'mean ms', 'total ms'))
+    total = 0.0
+    for op in sorted(results):
+        times = results[op]
+        total += sum(times)
+        print('  %-24s %8d %10.3f %10.1f' % (
+            op, len(times), 1000 * sum(times) / len(times), 1000 * sum(times)))
+    print('  %-24s %8s %10s %10.1f' % ('total', '', '', 1000 * total))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--backends', default='sqlite,ndb')
+    parser.add_argument('--conferences', type=int, default=50)
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--users', type=int, default=100)
+    args = parser.parse_args()
+
+    for backend in args.backends.split(','):
+        if backend == 'sqlite':
+            fd, path = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+            try:
+                results = workload(repository.get('sqlite', path=path),
+                                   args.conferences, args.sessions, args.users)
+            finally:
+                os.remove(path)
+        elif backend == 'ndb':
+            repo, bed = _ndbRepository()
+            if repo is None:
+                print('ndb: skipped (App Engine SDK not importable)')
+                continue
+            try:
+                results = workload(repo, args.conferences, args.sessions, args.users)
+            finally:
+                bed.deactivate()
+        else:
+            parser.error('unknown backend: %s' % backend)
+        _report(backend, results)
+
+
+if __name__ == '__main__':
+    main()
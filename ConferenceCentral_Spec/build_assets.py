@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+
+"""
+build_assets.py -- bundle, fingerprint and precompress web client assets
+
+    python build_assets.py [--check]
+
+Reads templates/index.html and, for the local stylesheets and scripts it
+references:
+
+  * concatenates them into one CSS and one JS bundle and minifies them
+    (comments and redundant whitespace only; nothing is renamed)
+  * copies files referenced by url() in the CSS (fonts, images) and the
+    bundles into static/dist under content-hashed names, with .gz and,
+    when the brotli module is installed, .br variants for CDNs and front
+    ends that serve precompressed files
+  * writes templates/index.dist.html with the references rewritten
+  * regenerates the marked handler block in app.yaml, so /dist is served
+    with a one year expiration and / with the rewritten page, uncached
+
+Files from the previous build are kept, so pages cached before a deploy
+still find their bundles.  Re-run after changing anything under static/
+or templates/index.html; --check exits non-zero if the build is stale.
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SOURCE_HTML = 'templates/index.html'
+OUTPUT_HTML = 'templates/index.dist.html'
+DIST_DIR = 'static/dist'
+DIST_URL = '/dist'
+MANIFEST = 'manifest.json'
+APP_YAML = 'app.yaml'
+BEGIN_MARKER = '# BEGIN generated by build_assets.py'
+END_MARKER = '# END generated by build_assets.py'
+HASH_LENGTH = 10
+
+# mirrors the static_dir handlers in app.yaml
+URL_DIRS = {
+    '/js': 'static/js',
+    '/img': 'static/img',
+    '/css': 'static/bootstrap/css',
+    '/fonts': 'static/fonts',
+}
+
+HANDLERS = '''%s
+- url: %s
+  static_dir: %s
+  expiration: "365d"
+
+- url: /
+  static_files: %s
+  upload: %s
+  secure: always
+  expiration: "0s"
+%s''' % (BEGIN_MARKER, DIST_URL, DIST_DIR, OUTPUT_HTML,
+         OUTPUT_HTML.replace('.', r'\.'), END_MARKER)
+
+STYLESHEET_RE = re.compile(
+    r'[ \t]*<link rel="stylesheet" href="(/[^/][^"]*)">[ \t]*\n?')
+SCRIPT_RE = re.compile(r'[ \t]*<script src="(/[^/][^"]*)"></script>[ \t]*\n?')
+CSS_URL_RE = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+CSS_IMPORT_RE = re.compile(r'@import[^;]+;\s*')
+
+
+def _read(path):
+    with io.open(os.path.join(ROOT, path), 'rb') as f:
+        return f.read()
+
+
+def _write(path, data):
+    with io.open(os.path.join(ROOT, path), 'wb') as f:
+        f.write(data)
+
+
+def localPath(url):
+    """Return the file behind a local URL, or None if it isn't served
+    from one of URL_DIRS."""
+    path = url.split('?')[0].split('#')[0]
+    for prefix, directory in URL_DIRS.items():
+        if path.startswith(prefix + '/'):
+            return directory + path[len(prefix):]
+    return None
+
+
+def _tokens(text, line_comments):
+    """Yield (kind, chunk) for text, kind being 'string', 'comment' or
+    'code'; a conservative scanner that only understands quotes and
+    comments."""
+    i, start, n = 0, 0, len(text)
+    while i < n:
+        c = text[i]
+        if c in '\'"`':
+            if start < i:
+                yield 'code', text[start:i]
+            j = i + 1
+            while j < n and text[j] != c:
+                j += 2 if text[j] == '\\' else 1
+            yield 'string', text[i:j + 1]
+            i = start = j + 1
+        elif text.startswith('/*', i):
+            if start < i:
+                yield 'code', text[start:i]
+            j = text.find('*/', i + 2)
+            j = n if j < 0 else j + 2
+            yield 'comment', text[i:j]
+            i = start = j
+        elif line_comments and text.startswith('//', i):
+            if start < i:
+                yield 'code', text[start:i]
+            j = text.find('\n', i)
+            j = n if j < 0 else j
+            yield 'comment', text[i:j]
+            i = start = j
+        else:
+            i += 1
+    if start < n:
+        yield 'code', text[start:]
+
+
+def minifyCss(css):
+    out = []
+    for kind, chunk in _tokens(css, line_comments=False):
+        if kind == 'code':
+            chunk = re.sub(r'\s+', ' ', chunk)
+            chunk = re.sub(r'\s*([{};,])\s*', r'\1', chunk)
+            chunk = re.sub(r':\s+', ':', chunk)
+            out.append(chunk)
+        elif kind == 'string':
+            out.append(chunk)
+    return ''.join(out).replace(';}', '}').strip() + '\n'
+
+
+def minifyJs(js):
+    """Strip comments, indentation and blank lines.  Newlines are kept,
+    so automatic semicolon insertion behaves exactly as before."""
+    out = []
+    for kind, chunk in _tokens(js, line_comments=True):
+        if kind != 'comment':
+            out.append(chunk)
+    lines = (line.strip() for line in ''.join(out).split('\n'))
+    return '\n'.join(line for line in lines if line) + '\n'
+
+
+def _hashed(name, data):
+    root, ext = os.path.splitext(name)
+    digest = hashlib.sha1(data).hexdigest()[:HASH_LENGTH]
+    return '%s.%s%s' % (root, digest, ext)
+
+
+def _gzip(data):
+    out = io.BytesIO()
+    # fixed mtime so identical input gives identical output
+    with gzip.GzipFile(filename='', fileobj=out, mode='wb', mtime=0) as f:
+        f.write(data)
+    return out.getvalue()
+
+
+class Build(object):
+    """Collects the files of one build, keyed by their dist name."""
+
+    def __init__(self):
+        self.files = {}
+
+    def add(self, name, data, compress=True):
+        dist_name = _hashed(name, data)
+        self.files[dist_name] = data
+        if compress:
+            self.files[dist_name + '.gz'] = _gzip(data)
+            if brotli is not None:
+                self.files[dist_name + '.br'] = brotli.compress(data)
+        return '%s/%s' % (DIST_URL, dist_name)
+
+    def cssBundle(self, urls):
+        imports, parts = [], []
+        for url in urls:
+            css = _read(localPath(url)).decode('utf-8')
+            base = url.rsplit('/', 1)[0]
+
+            def rewrite(match):
+                ref = match.group(2)
+                if ref.startswith(('data:', 'http:', 'https:', '//')):
+                    return match.group(0)
+                absolute = ref if ref.startswith('/') else \
+                    os.path.normpath(base + '/' + ref).replace(os.sep, '/')
+                path = localPath(absolute)
+                if path is None or not os.path.exists(os.path.join(ROOT, path)):
+                    return match.group(0)
+                suffix = ref[len(ref.split('?')[0].split('#')[0]):]
+                return "url('%s%s')" % (
+                    self.add(os.path.basename(path), _read(path), compress=False),
+                    suffix)
+
+            css = CSS_URL_RE.sub(rewrite, css)
+            # @import is only valid before other rules
+            imports.extend(m.strip() for m in CSS_IMPORT_RE.findall(css))
+            parts.append(CSS_IMPORT_RE.sub('', css))
+        bundle = '\n'.join(imports) + '\n' + minifyCss('\n'.join(parts))
+        return self.add('app.css', bundle.encode('utf-8'))
+
+    def jsBundle(self, urls):
+        # a leading semicolon keeps one file's last statement from running
+        # into the next file
+        bundle = '\n;'.join(minifyJs(_read(localPath(url)).decode('utf-8'))
+                            for url in urls)
+        return self.add('app.js', bundle.encode('utf-8'))
+
+
+def rewriteHtml(html, css_url, js_url):
+    """Replace the local stylesheet and script tags with one tag each, at
+    the position of the first one."""
+    def replaceAll(pattern, tag, text):
+        state = {'done': False}
+
+        def replace(match):
+            if localPath(match.group(1)) is None:
+                return match.group(0)
+            if state['done']:
+                return ''
+            state['done'] = True
+            indent = re.match(r'[ \t]*', match.group(0)).group(0)
+            return indent + tag + '\n'
+        return pattern.sub(replace, text)
+
+    html = replaceAll(STYLESHEET_RE, '<link rel="stylesheet" href="%s">' % css_url, html)
+    return replaceAll(SCRIPT_RE, '<script src="%s"></script>' % js_url, html)
+
+
+def rewriteAppYaml(text):
+    """Replace the generated handler block (or the plain / handler, on the
+    first build) with HANDLERS."""
+    if BEGIN_MARKER in text:
+        return re.sub(re.escape(BEGIN_MARKER) + '.*?' + re.escape(END_MARKER),
+                      lambda m: HANDLERS, text, flags=re.S)
+    plain = re.compile(r'- url: /\n  static_files: templates/index\.html\n'
+                       r'(  [^\n]*\n)*')
+    if not plain.search(text):
+        raise ValueError('no / handler for templates/index.html in app.yaml')
+    return plain.sub(lambda m: HANDLERS + '\n', text, count=1)
+
+
+def build():
+    """Return ({path: contents} to write, dist file names, source paths)."""
+    html = _read(SOURCE_HTML).decode('utf-8')
+    css_urls = [u for u in STYLESHEET_RE.findall(html) if localPath(u)]
+    js_urls = [u for u in SCRIPT_RE.findall(html) if localPath(u)]
+
+    assets = Build()
+    css_url = assets.cssBundle(css_urls)
+    js_url = assets.jsBundle(js_urls)
+
+    outputs = dict(('%s/%s' % (DIST_DIR, name), data)
+                   for name, data in assets.files.items())
+    outputs[OUTPUT_HTML] = rewriteHtml(html, css_url, js_url).encode('utf-8')
+    outputs[APP_YAML] = rewriteAppYaml(_read(APP_YAML).decode('utf-8')).encode('utf-8')
+    return outputs, sorted(assets.files), [localPath(u) for u in css_urls + js_urls]
+
+
+def _prune(dist, current):
+    """Delete dist files from neither this build nor the previous one,
+    and record this build in the manifest."""
+    manifest_path = os.path.join(dist, MANIFEST)
+    previous = []
+    if os.path.exists(manifest_path):
+        with io.open(manifest_path, 'rb') as f:
+            previous = json.loads(f.read().decode('utf-8')).get('current', [])
+    keep = set(current) | set(previous) | set([MANIFEST])
+    for name in os.listdir(dist):
+        if name not in keep:
+            os.remove(os.path.join(dist, name))
+    manifest = json.dumps({'current': current, 'previous': sorted(set(previous) - set(current))},
+                          indent=2, sort_keys=True) + '\n'
+    _write('%s/%s' % (DIST_DIR, MANIFEST), manifest.encode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--check', action='store_true',
+                        help='exit non-zero if the committed build is stale')
+    args = parser.parse_args()
+
+    outputs, current, sources = build()
+    stale = [path for path, data in sorted(outputs.items())
+             if not os.path.exists(os.path.join(ROOT, path)) or _read(path) != data]
+    if args.check:
+        for path in stale:
+            print('stale: %s' % path)
+        sys.exit(1 if stale else 0)
+
+    dist = os.path.join(ROOT, DIST_DIR)
+    if not os.path.isdir(dist):
+        os.makedirs(dist)
+    for path in stale:
+        _write(path, outputs[path])
+    _prune(dist, current)
+
+    print('bundled %d files, %d bytes:' % (
+        len(sources), sum(os.path.getsize(os.path.join(ROOT, p)) for p in sources)))
+    for name in current:
+        if name.startswith('app.') and not name.endswith(('.gz', '.br')):
+            print('  %-24s %s' % (name, ', '.join(
+                '%s %d' % (suffix or 'raw', len(outputs['%s/%s' % (DIST_DIR, name + suffix)]))
+                for suffix in ('', '.gz', '.br')
+                if '%s/%s' % (DIST_DIR, name + suffix) in outputs)))
+    if brotli is None:
+        print('  (brotli module not installed; .br variants skipped)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""
+changes.py -- delta-sync feed of Conference, Session and WishList changes
+
+Every put of those kinds stamps a changeSeq (microseconds since the
+epoch, see models.SyncedModel), and hard deletes leave a Tombstone
+stamped the same way.  A sync token is the changeSeq a client has seen
+everything up to; since() answers with the changes after it, oldest
+first, read as one indexed range query per kind and merged in order.
+Conference and Session changes are public; WishList changes and their
+tombstones are only reported to their owner.
+
+A write is stamped before it commits and global queries are eventually
+consistent, so the feed stops SETTLE_SECONDS short of now: a change
+stamped later than that might still be invisible, and skipping past it
+would lose it for good.  A deleted Conference stands for its sessions
+and their wishlist entries, which the deletion job removes without
+tombstones of their own.
+
+Tombstones are kept TOMBSTONE_DAYS; a client whose token is older is
+told to resync from scratch.
+
+"""
+
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import Session
+from models import Tombstone
+from models import WishList
+
+SETTLE_SECONDS = 60
+TOMBSTONE_DAYS = 30
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+PURGE_BATCH = 200
+PURGE_URL = '/tasks/purge_tombstones'
+SLICE_SECONDS = 60
+
+
+class BadSyncToken(ValueError):
+    """Raised for a sync token that isn't one getChangesSince issued."""
+
+
+def _seconds(seconds):
+    return int(seconds * 1000000)
+
+
+def _now():
+    return _seconds(time.time())
+
+
+def decodeToken(token):
+    """Return the changeSeq a sync token stands for; 0 for no token."""
+    if not token:
+        return 0
+    try:
+        seq = int(token)
+    except ValueError:
+        raise BadSyncToken('Malformed sync token.')
+    if seq < 0:
+        raise BadSyncToken('Malformed sync token.')
+    return seq
+
+
+def tombstone(key, owner=None):
+    """Return an unsaved Tombstone for key, in key's entity group."""
+    return Tombstone(parent=key.parent(), id=key.urlsafe(),
+                     kind=key.kind(), owner=owner)
+
+
+@ndb.transactional()
+def delete(key, owner=None):
+    """Delete key and leave its Tombstone, atomically."""
+    tombstone(key, owner).put()
+    key.delete()
+
+
+def _range(model, q, since, horizon, page_size):
+    return q.filter(model.changeSeq > since, model.changeSeq <= horizon) \
+            .order(model.changeSeq).fetch_async(page_size)
+
+
+def since(token, user_id=None, page_size=None):
+    """Return (entities, next token, more, resync) for the changes after
+    token.  entities mixes Conferences, Sessions, WishLists and
+    Tombstones in changeSeq order; more means another page is ready now.
+    """
+    seq = decodeToken(token)
+    page_size = min(page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    horizon = _now() - _seconds(SETTLE_SECONDS)
+    if seq and seq < horizon - _seconds(TOMBSTONE_DAYS * 24 * 3600):
+        return [], None, False, True
+    if seq >= horizon:
+        return [], str(seq), False, False
+
+    streams = [
+        (Conference, Conference.query()),
+        (Session, Session.query()),
+        (Tombstone, Tombstone.query(Tombstone.owner == None)),
+    ]
+    if user_id:
+        streams += [
+            (WishList, WishList.query(WishList.userID == user_id)),
+            (Tombstone, Tombstone.query(Tombstone.owner == user_id)),
+        ]
+    futures = [_range(model, q, seq, horizon, page_size) for model, q in streams]
+    results = [f.get_result() for f in futures]
+
+    # a full result may have more behind it, so nothing past its last
+    # changeSeq is known to be complete
+    full = [r[-1].changeSeq for r in results if len(r) == page_size]
+    merged = sorted((e for r in results for e in r),
+                    key=lambda e: (e.changeSeq, e.key.urlsafe()))
+    more = bool(full)
+    if full:
+        bound = min(full)
+        # stop short of the bound's own sequence; if that leaves nothing,
+        # the page is every change stamped exactly bound, which one
+        # kind's page may not have held in full
+        merged = [e for e in merged if e.changeSeq < bound]
+        if not merged:
+            futures = [q.filter(model.changeSeq == bound).fetch_async()
+                       for model, q in streams]
+            merged = sorted((e for f in futures for e in f.get_result()),
+                            key=lambda e: e.key.urlsafe())
+
+    if len(merged) > page_size:
+        # never split a changeSeq across pages
+        cut = page_size
+        while cut < len(merged) and merged[cut].changeSeq == merged[cut - 1].changeSeq:
+            cut += 1
+        more = more or cut < len(merged)
+        merged = merged[:cut]
+
+    next_seq = merged[-1].changeSeq if more else horizon
+    return merged, str(next_seq), more, False
+
+
+def purgeTombstones(cursor='', cutoff=None):
+    """Delete tombstones past TOMBSTONE_DAYS, chaining a task with the
+    cursor before the deadline; return the number this slice deleted."""
+    if cutoff is None:
+        cutoff = _now() - _seconds(TOMBSTONE_DAYS * 24 * 3600)
+    deadline = time.time() + SLICE_SECONDS
+    q = Tombstone.query(Tombstone.changeSeq < cutoff)
+    deleted = 0
+    start = Cursor(urlsafe=cursor) if cursor else None
+    while time.time() < deadline:
+        keys, start, more = q.fetch_page(PURGE_BATCH, start_cursor=start,
+                                         keys_only=True)
+        ndb.delete_multi(keys)
+        deleted += len(keys)
+        if not more or not start:
+            return deleted
+    taskqueue.add(url=PURGE_URL, params={
+        'cursor': start.urlsafe(), 'cutoff': cutoff})
+    return deleted
@@ -15,15 +15,19 @@ Extended by Andrew Sychra on 2016 mar 03
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
+import itertools
 from datetime import datetime
+from datetime import timedelta
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from models import ConflictException
@@ -45,6 +49,22 @@ from models import confWebSafeKey
 from models import SessionByType
 from models import WishList
 from models import WishListForm
+from models import FacetCount
+from models import SessionFacetsForm
+from models import SessionFacetQueryForm
+from models import AgendaQueryForm
+from models import KeysForm
+from models import ChangeForm
+from models import ChangesForm
+from models import Tombstone
+from models import TrendingSession
+from models import TrendingSessionsForm
+from models import ConferenceMetricsForm
+from models import MetricPoint
+from models import SessionPopularity
+from models import sessionAgendaSlot
+from models import weekBuckets
+from models import monthBuckets
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
@@ -52,6 +72,21 @@ from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
 
 from utils import getUserId
+import entitycache
+import etags
+import changes
+import deadline
+import deletion
+import facets
+import fieldmask
+import idempotency
+import metrics
+import fanout
+import profiling
+import ratelimit
+import recommendations
+import trending
+import unitofwork
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
@@ -69,6 +104,9 @@ DEFAULTS = {
     "topics": [ "Default", "Topic" ],
 }
 
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
 SESS_DEFAULTS = {
     "name": "Topic needs to go here"
 }
@@ -87,7 +125,41 @@ FIELDS =    {
             'TOPIC': 'topics',
             'MONTH': 'month',
             'MAX_ATTENDEES': 'maxAttendees',
+            'START_DATE': 'startDate',
+            'END_DATE': 'endDate',
+            }
+
+# Date range filters are served from Conference.dateBuckets, so they don't
+# take the single inequality slot.  Conferences must start on/after a
+# START_DATE bound and end on/before an END_DATE bound; a missing side of
+# the range is capped this many days from the other.  A range with more
+# buckets than MAX_DISJUNCTS allows becomes one startDate range instead
+# (or, if another filter holds the inequality slot, an in-memory trim).
+DATE_RANGE_OPERATORS = {
+            'startDate': ('=', '>', '>='),
+            'endDate': ('=', '<', '<='),
             }
+MAX_DATE_RANGE_DAYS = 366
+# ranges up to this long are matched on week buckets, longer on months
+WEEK_BUCKET_MAX_DAYS = 56
+
+# most disjunct queries a multi-valued / date range query may fan out to
+MAX_DISJUNCTS = 30
+
+CHANGES_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    syncToken=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+)
+
+TRENDING_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    limit=messages.IntegerField(2, variant=messages.Variant.INT32),
+)
+
+# most keys getConferencesByKeys / getSessionsByKeys accept per call
+MAX_BATCH_KEYS = 100
 
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
@@ -99,6 +171,54 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+# read requests taking an optional field mask (comma separated form fields)
+CONF_FIELDS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    fields=messages.StringField(2),
+)
+
+FIELDS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fields=messages.StringField(1),
+)
+
+CONF_METRICS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    resolution=messages.StringField(2),
+    days=messages.IntegerField(3, variant=messages.Variant.INT32),
+)
+
+STRING_FIELDS_REQUEST = endpoints.ResourceContainer(
+    StringMessage,
+    fields=messages.StringField(3),
+)
+
+# global scans; pageToken resumes a scan the request budget cut short
+SCAN_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fields=messages.StringField(1),
+    pageToken=messages.StringField(2),
+)
+
+STRING_SCAN_REQUEST = endpoints.ResourceContainer(
+    StringMessage,
+    fields=messages.StringField(3),
+    pageToken=messages.StringField(4),
+)
+
+# Masks within these fields are served by projection queries on the
+# indexes in index.yaml; websafeKey comes from the key and
+# organizerDisplayName from the organizer profile.
+CONF_PROJECTION = ('name', 'city', 'deleted', 'endDate', 'maxAttendees',
+                   'month', 'organizerUserId', 'seatsAvailable', 'startDate')
+CONF_COVERED_FIELDS = frozenset(CONF_PROJECTION) - frozenset(['deleted']) | \
+    frozenset(['websafeKey', 'organizerDisplayName'])
+SESS_PROJECTION = ('startTime', 'date', 'duration', 'name', 'speaker',
+                   'typeOfSession', 'websafeKey')
+SESS_COVERED_FIELDS = frozenset(SESS_PROJECTION)
+
 
 
 
@@ -140,6 +260,13 @@ class ConferenceApi(remote.Service):
                 data[df] = DEFAULTS[df]
                 setattr(request, df, DEFAULTS[df])
 
+        # convert the date from a string to a Date object
+        if data['date']:
+            try:
+                data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
+            except ValueError:
+                raise endpoints.BadRequestException("Session 'date' must be YYYY-MM-DD")
+
 
         # Building the Session parent key to assign it to the specific parent
         p_key = ndb.Key(urlsafe=request.websafeKey)
@@ -151,8 +278,22 @@ class ConferenceApi(remote.Service):
 
 
 
-        # creation of Session & return (modified) SessionForm
-        Session(**data).put()
+        # creation of Session & return (modified) SessionForm; the session
+        # is in its conference's entity group, so checking the deleted flag
+        # in the same transaction keeps it from outliving a deletion
+        sess = Session(**data)
+
+        @ndb.transactional()
+        def txn():
+            conf = p_key.get()
+            if not conf or conf.deleted:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s' % request.websafeKey)
+            sess.put()
+        txn()
+        entitycache.invalidate(c_key)
+        facets.record(sess)
+        etags.invalidate(etags.sessionsTag(p_key.urlsafe()))
 
         #This is after the .put() that way the conference is queried with the newly assigned
         #session.
@@ -175,11 +316,17 @@ class ConferenceApi(remote.Service):
 
     # This is just a modified form of the copyConferenceToForm but for session
     # helper function abstracted away because several endpoint methods will use it.
-    def _copySessionToForm(self, sess):
-        """Copy relevant fields from Session to SessionForm."""
+    def _copySessionToForm(self, sess, mask=None):
+        """Copy relevant fields from Session to SessionForm; with a field
+        mask only the masked fields are read."""
         sf = SessionForm()
-        for field in sf.all_fields():
-            setattr(sf, field.name, getattr(sess, field.name))
+        for field in fieldmask.fieldsOf(SessionForm, mask):
+            # convert Date to date string; just copy others
+            if field.name == 'date':
+                if sess.date:
+                    sf.date = str(sess.date)
+            else:
+                setattr(sf, field.name, getattr(sess, field.name))
 
         sf.check_initialized()
         return sf
@@ -189,10 +336,11 @@ class ConferenceApi(remote.Service):
 
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
-        """Copy relevant fields from Conference to ConferenceForm."""
+    def _copyConferenceToForm(self, conf, displayName, mask=None):
+        """Copy relevant fields from Conference to ConferenceForm; with a
+        field mask only the masked fields are read and converted."""
         cf = ConferenceForm()
-        for field in cf.all_fields():
+        for field in fieldmask.fieldsOf(ConferenceForm, mask):
             if hasattr(conf, field.name):
                 # convert Date to date string; just copy others
                 if field.name.endswith('Date'):
@@ -201,12 +349,52 @@ class ConferenceApi(remote.Service):
                     setattr(cf, field.name, getattr(conf, field.name))
             elif field.name == "websafeKey":
                 setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
+        if displayName and fieldmask.wants(mask, 'organizerDisplayName'):
             setattr(cf, 'organizerDisplayName', displayName)
         cf.check_initialized()
         return cf
 
 
+    def _conferenceQuery(self, mask, **kwargs):
+        """Return Conference.query(**kwargs), as a projection query when
+        the field mask is covered by CONF_PROJECTION."""
+        if fieldmask.covered(mask, CONF_COVERED_FIELDS):
+            kwargs['projection'] = CONF_PROJECTION
+        return Conference.query(**kwargs)
+
+
+    def _sessionQuery(self, mask, **kwargs):
+        """Return Session.query(**kwargs), as a projection query when the
+        field mask is covered by SESS_PROJECTION."""
+        if fieldmask.covered(mask, SESS_COVERED_FIELDS):
+            kwargs['projection'] = SESS_PROJECTION
+        return Session.query(**kwargs)
+
+
+    def _scanSessions(self, query, pageToken, mask):
+        """Return SessionForms for query from pageToken on, stopping at the
+        request budget or deadline.MAX_ITEMS with partial=True and a token
+        to carry on from."""
+        sess, next_token, partial = deadline.collect(
+            deadline.queryPages(query), pageToken)
+        return SessionForms(
+            items=[self._copySessionToForm(sf, mask) for sf in sess],
+            nextPageToken=next_token,
+            partial=partial,
+        )
+
+
+    def _organizerNames(self, conferences, mask):
+        """Return {organizerUserId: displayName}, or {} if the mask has
+        no organizerDisplayName."""
+        if not fieldmask.wants(mask, 'organizerDisplayName'):
+            return {}
+        # get all keys and use get_multi for speed
+        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
+        return dict((profile.key.id(), profile.displayName)
+                    for profile in ndb.get_multi(organisers) if profile)
+
+
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
         # preload necessary data items
@@ -222,6 +410,8 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['websafeKey']
         del data['organizerDisplayName']
+        del data['etag']
+        del data['unchanged']
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS:
@@ -272,18 +462,24 @@ class ConferenceApi(remote.Service):
         # update existing conference
         conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
         # check that conference exists
-        if not conf:
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
 
-        # check that user is owner
+        # check that user is owner before touching their profile: anyone
+        # else's is in another entity group, out of this transaction's reach
         if user_id != conf.organizerUserId:
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
+        prof = conf.key.parent().get()
+        uow = unitofwork.UnitOfWork()
+        uow.track(conf)
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
+            if field.name in ('etag', 'unchanged'):
+                continue
             data = getattr(request, field.name)
             # only copy fields where we get data
             if data not in (None, []):
@@ -294,13 +490,17 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
-        conf.put()
-        prof = ndb.Key(Profile, user_id).get()
+        # skip the write (and cache invalidation) if nothing changed
+        if uow.commit():
+            entitycache.invalidate(conf.key)
+            etags.invalidate(etags.conferenceTag(conf.key.urlsafe()))
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
+    @ratelimit.limited
+    @idempotency.idempotent
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
@@ -320,16 +520,112 @@ class ConferenceApi(remote.Service):
          The speaker is simply a string value inside of the session. I decided to keep it very simple.
     """
 
+    @endpoints.method(CONF_GET_REQUEST, SessionFacetsForm,
+            path='conference/{websafeConferenceKey}/sessionFacets',
+            http_method='GET', name='getSessionFacets')
+    @ratelimit.limited
+    def getSessionFacets(self, request):
+        """Return session counts by type, speaker, day and time bucket."""
+        counts = facets.get(ndb.Key(urlsafe=request.websafeConferenceKey))
+
+        def facetList(facet):
+            return [FacetCount(value=v, count=n)
+                    for v, n in sorted(counts[facet].items())]
+
+        return SessionFacetsForm(
+            byType=facetList('byType'),
+            bySpeaker=facetList('bySpeaker'),
+            byDay=facetList('byDay'),
+            byTimeBucket=facetList('byTimeBucket'),
+        )
+
+
+    # Every facet filter is an equality filter, so the datastore serves any
+    # combination from built-in indexes (merge join) ordered by key.
+    @endpoints.method(SessionFacetQueryForm, SessionForms,
+            path='getConferenceSessionsByFacet',
+            http_method='POST', name='getConferenceSessionsByFacet')
+    @ratelimit.limited
+    def getConferenceSessionsByFacet(self, request):
+        """Return a page of a conference's sessions matching facet filters."""
+        mask = fieldmask.parse(request.fields, SessionForm)
+        q = Session.query(ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
+        if request.typeOfSession:
+            q = q.filter(Session.typeOfSession == request.typeOfSession)
+        if request.speaker:
+            q = q.filter(Session.speaker == request.speaker)
+        if request.date:
+            try:
+                day = datetime.strptime(request.date[:10], "%Y-%m-%d").date()
+            except ValueError:
+                raise endpoints.BadRequestException("'date' must be YYYY-MM-DD")
+            q = q.filter(Session.date == day)
+        if request.timeBucket:
+            q = q.filter(Session.timeBucket == request.timeBucket)
+        q = q.order(Session.key)
+
+        try:
+            cursor = Cursor(urlsafe=request.pageToken) if request.pageToken else None
+            keys, next_cursor, more = q.fetch_page(
+                min(request.pageSize or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE),
+                start_cursor=cursor, keys_only=True)
+        except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+            if not request.pageToken:
+                raise
+            raise endpoints.BadRequestException('Invalid page token.')
+        sess = [s for s in entitycache.get_multi(keys) if s]
+        return SessionForms(
+            items=[self._copySessionToForm(sf, mask) for sf in sess],
+            nextPageToken=next_cursor.urlsafe() if (more and next_cursor) else None
+        )
+
+
+    # Sessions are ordered in the index by agendaSlot, which encodes
+    # (date, startTime), then key, so each page costs one bounded query.
+    @endpoints.method(AgendaQueryForm, SessionForms,
+            path='getConferenceAgenda',
+            http_method='POST', name='getConferenceAgenda')
+    @ratelimit.limited
+    def getConferenceAgenda(self, request):
+        """Return a page of a conference's sessions in time order, optionally
+        starting from a fromDate/fromTime anchor."""
+        mask = fieldmask.parse(request.fields, SessionForm)
+        q = Session.query(ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
+        if request.fromDate or request.fromTime is not None:
+            from_date = None
+            if request.fromDate:
+                from_date = datetime.strptime(request.fromDate[:10], "%Y-%m-%d").date()
+            q = q.filter(Session.agendaSlot >= sessionAgendaSlot(from_date, request.fromTime))
+        q = q.order(Session.agendaSlot, Session.key)
+
+        cursor = Cursor(urlsafe=request.pageToken) if request.pageToken else None
+        keys, next_cursor, more = q.fetch_page(
+            min(request.pageSize or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE),
+            start_cursor=cursor, keys_only=True)
+        sess = [s for s in entitycache.get_multi(keys) if s]
+        return SessionForms(
+            items=[self._copySessionToForm(sf, mask) for sf in sess],
+            nextPageToken=next_cursor.urlsafe() if (more and next_cursor) else None
+        )
+
+
 # Setup to return an array of all Sessions this person talks at, just the key is needed.
-    @endpoints.method(StringMessage, SessionForms,
+    @endpoints.method(STRING_FIELDS_REQUEST, SessionForms,
             path='getConferenceSessions',
             http_method='POST', name='getConferenceSessions')
     # confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
+    @ratelimit.limited
     def getConferenceSessions(self, request):
         """Return sessions based on conference key."""
-
-
-        sess = Session.query(ancestor=ndb.Key(urlsafe=request.data))
+        c_key = ndb.Key(urlsafe=request.data)
+        mask = fieldmask.parse(request.fields, SessionForm)
+        tag_key = etags.sessionsTag(c_key.urlsafe())
+        if etags.isCached(self, tag_key, mask):
+            return SessionForms(etag=etags.requested(self), unchanged=True)
+
+        # keys-only query, then resolve the sessions through the entity cache
+        keys = Session.query(ancestor=c_key).fetch(keys_only=True)
+        sess = [s for s in entitycache.get_multi(keys) if s]
         # code to view results in logs
         # speaking = sess.filter(Session.typeOfSession == request.type)
         # speaking = sess.filter(Session.query(ancestor=ndb.Key(urlsafe=request.websafeKey)))
@@ -339,7 +635,9 @@ class ConferenceApi(remote.Service):
 
         # return message_types.VoidMessage
         return SessionForms(
-            items=[self._copySessionToForm(sf) for sf in sess]
+            items=[self._copySessionToForm(sf, mask) for sf in sess],
+            etag=etags.variant(etags.remember(
+                tag_key, *[(s.key.id(), s.version) for s in sess]), mask)
         )
 
 
@@ -349,41 +647,44 @@ class ConferenceApi(remote.Service):
             path='getConferenceSessionsByType',
             http_method='POST', name='getConferenceSessionsByType')
     # confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
+    @ratelimit.limited
     def getConferenceSessionsByType(self, request):
         """Return conferences set by a specific type, make sure whatever you put in for the Session Type
            you write verbatim into the input."""
 
 
+        mask = fieldmask.parse(request.fields, SessionForm)
         sess = Session.query(ancestor=ndb.Key(urlsafe=request.websafeKey))
         speaking = sess.filter(Session.typeOfSession == request.type)
 
         return SessionForms(
-            items=[self._copySessionToForm(sf) for sf in speaking]
+            items=[self._copySessionToForm(sf, mask) for sf in speaking]
         )
 
 
     # Setup to return an array of all Sessions this person talks at, just the key is needed.
-    @endpoints.method(StringMessage, SessionForms,
+    @endpoints.method(STRING_SCAN_REQUEST, SessionForms,
             path='getSessionsBySpeaker',
             http_method='POST', name='getSessionsBySpeaker')
+    @deadline.budgeted
+    @ratelimit.limited
     def getSessionsSpeaker(self, request):
         """Return all Sessions a speaker is currently engagned in at a conference."""
 
 
+        mask = fieldmask.parse(request.fields, SessionForm)
+
         # create ancestor query for all key matches for this user
         sess = Session.query()
         speaking = sess.filter(Session.speaker == request.data)
-
-
-        # returns all Sessions
-        return SessionForms(
-            items=[self._copySessionToForm(sf) for sf in speaking]
-        )
+        return self._scanSessions(speaking, request.pageToken, mask)
 
 
     ###########createSession, modify this later so 2nd argument is websafeConferenceKey
     @endpoints.method(SessionForm, SessionForm, path='session',
                 http_method='POST', name='createSession')
+    @ratelimit.limited
+    @idempotency.idempotent
     def createSession(self, request):
         """Create new session."""
         return self._createSessionObject(request)
@@ -401,6 +702,8 @@ class ConferenceApi(remote.Service):
     @endpoints.method(WishListForm, StringMessage,
             path='addSessionToWishlist',
             http_method='POST', name='addSessionToWishlist')
+    @ratelimit.limited
+    @idempotency.idempotent
     def addSessionToWishlist(self, request):
         """Adds conference to users wishlist."""
         user = endpoints.get_current_user()
@@ -409,23 +712,44 @@ class ConferenceApi(remote.Service):
         user_id = getUserId(user)
 
 
-        p_key = ndb.Key(urlsafe=request.sessionKey)
-        print p_key
+        p_key = self._parseKey(request.sessionKey, 'Session')
 
-        wishItem = WishList(parent=p_key)
+        # one item per user and session, keyed by the user id
+        wishItem = WishList(id=user_id, parent=p_key)
 
         #Assign the wishlist item to have both a sessionkey to get he session and the user_id to correctly call it
         #back uniquely to that user.
         wishItem.sessionKey = request.sessionKey
         wishItem.userID = user_id
 
-        wishItem.put()
+        # the session and its conference share the wishlist item's entity
+        # group, so checking them in the same transaction keeps the item
+        # from outliving a conference deletion; the ancestor query also
+        # finds items saved before they were keyed by user id
+        @ndb.transactional()
+        def txn():
+            sess, conf = ndb.get_multi([p_key, p_key.parent()])
+            if not sess or not conf or conf.deleted:
+                raise endpoints.NotFoundException(
+                    'No session found with key: %s' % request.sessionKey)
+            if WishList.query(WishList.userID == user_id,
+                              ancestor=p_key).get(keys_only=True):
+                return False
+            wishItem.put()
+            return True
 
         # This is just setting up the message to return to the user
         websafeKey = StringMessage()
-        websafeKey.data = "Successfully added to wishlist: " + request.sessionKey
+        if not txn():
+            websafeKey.data = "Already in wishlist: " + request.sessionKey
+            return websafeKey
 
-        testQ = WishList.query()
+        # counted only for a new item, so repeated adds can't inflate them
+        recommendations.enqueue(request.sessionKey, user_id)
+        metrics.record('wishlist', p_key.parent().urlsafe(), request.sessionKey)
+        trending.record(request.sessionKey, 1)
+
+        websafeKey.data = "Successfully added to wishlist: " + request.sessionKey
 
         #Just return the message confirming that the session was added to the wishlist
         return websafeKey
@@ -433,18 +757,19 @@ class ConferenceApi(remote.Service):
 
 
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(FIELDS_REQUEST, SessionForms,
             path='getSessionsInWishlist',
             http_method='POST', name='getSessionsInWishlist')
+    @ratelimit.limited
     def getSessionsInWishlist(self, request):
         """Return sessions in users wishlist."""
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
+        mask = fieldmask.parse(request.fields, SessionForm)
 
         key_array = []
-        print user_id
 
 
 
@@ -455,36 +780,65 @@ class ConferenceApi(remote.Service):
 
 
 
-        # array to hold all ancestor keys for sessions in the wishlist to call all the relevant sessions
-        items = []
+        # Resolve every session in the wishlist with one batched cache lookup
+        sessions = entitycache.get_multi([ndb.Key(urlsafe=key) for key in key_array])
+        Forms = [self._copySessionToForm(session, mask) for session in sessions if session]
 
-        for key in key_array:
+        # return all the sessions in the wishlist
+        return SessionForms(items=Forms)
 
-            item = WishList.query(ancestor=ndb.Key(urlsafe=key))
-            print item.ancestor
-            items.append(item.ancestor)
 
-        # Calls specific session in query from all the encoded keys in the key_array
-        Forms = []
-        for key in key_array:
-            item = ndb.Key(urlsafe=key)
-            print item
-            print "another item"
-            session = item.get()
-            if session:
-                Forms.append(self._copySessionToForm(session))
+    # Recommendations are precomputed per session by the
+    # /crons/build_recommendations job, so this is one wishlist query plus
+    # one batched lookup of the saved sessions' rows.
+    @endpoints.method(FIELDS_REQUEST, SessionForms,
+            path='getSessionRecommendations',
+            http_method='POST', name='getSessionRecommendations')
+    @ratelimit.limited
+    def getSessionRecommendations(self, request):
+        """Return sessions often wishlisted together with the user's
+        wishlisted sessions."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+        mask = fieldmask.parse(request.fields, SessionForm)
+
+        saved = [w.sessionKey for w in WishList.query(WishList.userID == user_id)]
+        recommended = recommendations.recommend(saved)
+        sessions = entitycache.get_multi([ndb.Key(urlsafe=key) for key in recommended])
+        return SessionForms(
+            items=[self._copySessionToForm(sess, mask) for sess in sessions if sess]
+        )
 
-        # return all the sessions in the wishlist
-        return SessionForms(items=Forms)
 
 
 
 
+    # Leaderboards are kept up to date by the /crons/flush_trending job, so
+    # this is one memcache get (or one get by key on a miss).
+    @endpoints.method(TRENDING_REQUEST, TrendingSessionsForm,
+            path='trending',
+            http_method='GET', name='getTrendingSessions')
+    @ratelimit.limited
+    def getTrendingSessions(self, request):
+        """Return the most wishlisted sessions of a conference, or of all
+        conferences if no key is given."""
+        board_id = trending.GLOBAL
+        if request.websafeConferenceKey:
+            board_id = self._parseKey(request.websafeConferenceKey, 'Conference').urlsafe()
+        entries = trending.top(board_id, request.limit or trending.TOP_K)
+        return TrendingSessionsForm(
+            items=[TrendingSession(websafeKey=k, name=name, wishlistCount=n)
+                   for k, name, n in entries]
+        )
+
 
     # Put in the Session Key to delete the session for the wishlist
     @endpoints.method(StringMessage, StringMessage,
                 path='deleteSessionInWishlist',
                 http_method='POST', name='deleteSessionInWishlist')
+    @ratelimit.limited
     def deleteSessionInWishlist(self, request):
         """Delete sessions in users wishlist."""
         user = endpoints.get_current_user()
@@ -500,11 +854,13 @@ class ConferenceApi(remote.Service):
         # print key
         # print "I just used the key"
         testQ = WishList.query()
-        filtered = testQ.filter(WishList.sessionKey == request.data)
-        # print filtered
-        # p = testQ.filter(WishList.sessionKey == request.data and WishList.userID == user_id)
+        # only the caller's own items
+        filtered = testQ.filter(WishList.sessionKey == request.data,
+                                WishList.userID == user_id)
         for t in filtered:
-            t.key.delete()
+            # leaves a tombstone for the owner's getChangesSince feed
+            changes.delete(t.key, user_id)
+            trending.record(t.sessionKey, -1)
 
         websafeKey = StringMessage()
         # Fedback to user, confirming item in wishlist was deleted.
@@ -519,64 +875,52 @@ class ConferenceApi(remote.Service):
     # This retreives all the sessions (without regard for conference) before the noon hour and includes those that have no specified time
     # It was easy enough to design it, simply like getting sessions of a type but just using start time
     # and then filtering with a less than before 12
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(SCAN_REQUEST, SessionForms,
                 path='getAllMorningSessions',
                 http_method='POST', name='getAllMorningSessions')
+    @deadline.budgeted
+    @ratelimit.limited
     def getAllMorningSessions(self, request):
         """Returns all sessions in all conferences before 12pm."""
+        mask = fieldmask.parse(request.fields, SessionForm)
 
         # create ancestor query for all key matches for this user
-        sess = Session.query()
+        sess = self._sessionQuery(mask)
         speaking = sess.filter(Session.startTime < 12)
-        for q in speaking:
-            print q
-            print " below this another one:"
-
-        # return message_types.VoidMessage
-        return SessionForms(
-            items=[self._copySessionToForm(sf) for sf in speaking]
-        )
+        return self._scanSessions(speaking, request.pageToken, mask)
 
 
     # Same setup as the above endpoint except using greater than or equal to 12 o'clock, based on 1-24 hours
     # military time essentially
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(SCAN_REQUEST, SessionForms,
                 path='getAllAfternoonSessions',
                 http_method='POST', name='getAllAfternoonSessions')
+    @deadline.budgeted
+    @ratelimit.limited
     def getAllAfternoonSessions(self, request):
         """Returns all sessions in all conferences after 12pm."""
+        mask = fieldmask.parse(request.fields, SessionForm)
 
-        sess = Session.query()
+        sess = self._sessionQuery(mask)
         speaking = sess.filter(Session.startTime >= 12)
-        for q in speaking:
-            print q
-            print " below this another one:"
-
-        # return message_types.VoidMessage
-        return SessionForms(
-            items=[self._copySessionToForm(sf) for sf in speaking]
-        )
+        return self._scanSessions(speaking, request.pageToken, mask)
 
 
 
     # Same as the time filter but just added an "and" statement. Assuming Workshops are assigned with "Workshop" as the
     # Session.type, than it's simply a matter of avoiding all sessions with that as the text.
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(SCAN_REQUEST, SessionForms,
                 path='getNoneWorkshopsBefore7',
                 http_method='POST', name='getNoneWorkshopsBefore7')
+    @deadline.budgeted
+    @ratelimit.limited
     def getNoneWorkshopsBefore7(self, request):
         """Returns all sessions in all conferences before 7pm and that are not a 'Workshop'."""
+        mask = fieldmask.parse(request.fields, SessionForm)
 
         sess = Session.query()
         speaking = sess.filter(Session.startTime < 19 and Session.typeOfSession != "Workshop")
-        for q in speaking:
-            print q
-            print " below this another one:"
-
-        # return message_types.VoidMessage
-        return SessionForms(
-            items=[self._copySessionToForm(sf) for sf in speaking]
-        )
+        return self._scanSessions(speaking, request.pageToken, mask)
 
 # - - - - - - - - - - Task 4 - - - - - - - - - - - - - - - - - - - -
 
@@ -590,9 +934,14 @@ class ConferenceApi(remote.Service):
     @endpoints.method(message_types.VoidMessage, StringMessage,
         path='conference/getFeaturedSpeaker',
         http_method='GET', name='getFeaturedSpeaker')
+    @ratelimit.limited
     def getFeaturedSpeaker(self, request):
         """Retrieves speaker from memcache."""
-        return StringMessage(data=memcache.get(FEATURED_SPEAKER) or "")
+        data = memcache.get(FEATURED_SPEAKER) or ""
+        etag = etags.compute(data)
+        if etags.isCurrent(self, etag):
+            return StringMessage(data='', etag=etag, unchanged=True)
+        return StringMessage(data=data, etag=etag)
 
 
 
@@ -601,32 +950,263 @@ class ConferenceApi(remote.Service):
 
 
 
+    @ndb.transactional()
+    def _markConferenceDeleted(self, websafeConferenceKey, user_id):
+        """Flag a conference deleted; False if it already was."""
+        conf = ndb.Key(urlsafe=websafeConferenceKey).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can delete the conference.')
+        if conf.deleted:
+            return False
+        conf.deleted = True
+        conf.put()
+        # the cleanup task only starts if the flag commits
+        deletion.enqueue(websafeConferenceKey)
+        return True
+
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+            path='conference/{websafeConferenceKey}/delete',
+            http_method='POST', name='deleteConference')
+    @ratelimit.limited
+    def deleteConference(self, request):
+        """Delete a conference; its sessions, wishlist entries and
+        registrations are removed by a background task."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        wsck = ndb.Key(urlsafe=request.websafeConferenceKey).urlsafe()
+        retval = self._markConferenceDeleted(wsck, user_id)
+        entitycache.invalidate(ndb.Key(urlsafe=wsck))
+        etags.invalidate(etags.conferenceTag(wsck), etags.sessionsTag(wsck))
+        return BooleanMessage(data=retval)
+
+
+    @endpoints.method(CONF_METRICS_REQUEST, ConferenceMetricsForm,
+            path='conference/{websafeConferenceKey}/metrics',
+            http_method='GET', name='getConferenceMetrics')
+    @ratelimit.limited
+    def getConferenceMetrics(self, request):
+        """Return registrations, cancellations and wishlist adds per hour
+        (or day) for the organizer of a conference."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf = entitycache.get(c_key)
+        if not conf or conf.deleted:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can view conference metrics.')
+
+        resolution = request.resolution or 'hour'
+        if resolution not in metrics.RESOLUTIONS:
+            raise endpoints.BadRequestException(
+                "resolution must be 'hour' or 'day'.")
+        days = max(1, min(request.days or metrics.COMPACT_AFTER_DAYS, metrics.MAX_DAYS))
+
+        wsck = c_key.urlsafe()
+        rollup = metrics.rollup(wsck, resolution, days)
+        return ConferenceMetricsForm(
+            websafeConferenceKey=wsck,
+            resolution=resolution,
+            points=[MetricPoint(bucket=bucket.isoformat(),
+                                registrations=counts['registrations'],
+                                cancellations=counts['cancellations'],
+                                wishlistAdds=counts['wishlist'])
+                    for bucket, counts in rollup['points']],
+            sessions=[SessionPopularity(websafeKey=key, wishlistAdds=n)
+                      for key, n in rollup['sessions']],
+        )
+
+
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='PUT', name='updateConference')
+    @ratelimit.limited
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
         return self._updateConferenceObject(request)
 
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    @endpoints.method(CONF_FIELDS_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
+    @ratelimit.limited
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        mask = fieldmask.parse(request.fields, ConferenceForm)
+        tag_key = etags.conferenceTag(c_key.urlsafe())
+        if etags.isCached(self, tag_key, mask):
+            return ConferenceForm(etag=etags.requested(self), unchanged=True)
+
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
+        conf = entitycache.get(c_key)
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+        prof = entitycache.get(conf.key.parent())
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cf = self._copyConferenceToForm(conf, getattr(prof, 'displayName'), mask)
+        cf.etag = etags.variant(etags.remember(
+            tag_key, conf.version, getattr(prof, 'version', 0)), mask)
+        return cf
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    def _parseKey(self, websafeKey, kind):
+        """Return the ndb.Key for websafeKey; BadRequestException if it
+        doesn't parse or is of another kind."""
+        try:
+            key = ndb.Key(urlsafe=websafeKey)
+        except Exception:
+            key = None
+        if not key or key.kind() != kind:
+            raise endpoints.BadRequestException(
+                'Invalid %s key: %s' % (kind, websafeKey))
+        return key
+
+
+    def _batchKeys(self, websafeKeys, kind):
+        """Return [(websafeKey, ndb.Key or None)] in request order; keys
+        that don't parse or are of another kind map to None."""
+        if len(websafeKeys) > MAX_BATCH_KEYS:
+            raise endpoints.BadRequestException(
+                'At most %d keys per call.' % MAX_BATCH_KEYS)
+        keys = []
+        for wsk in websafeKeys:
+            try:
+                key = ndb.Key(urlsafe=wsk)
+            except Exception:
+                key = None
+            keys.append((wsk, key if key and key.kind() == kind else None))
+        return keys
+
+
+    def _getBatch(self, keys):
+        """Return {ndb.Key: entity} for the distinct keys, in one batch."""
+        unique = list(set(key for _, key in keys if key))
+        return dict(zip(unique, entitycache.get_multi(unique)))
+
+
+    # One batched get for the conferences and one for their organizers,
+    # instead of a getConference round trip per key.
+    @endpoints.method(KeysForm, ConferenceForms,
+            path='getConferencesByKeys',
+            http_method='POST', name='getConferencesByKeys')
+    @ratelimit.limited
+    def getConferencesByKeys(self, request):
+        """Return conferences for a list of websafe keys, in request order;
+        keys with no conference are listed in missingKeys."""
+        mask = fieldmask.parse(request.fields, ConferenceForm)
+        keys = self._batchKeys(request.websafeKeys, 'Conference')
+        found = self._getBatch(keys)
+        confs = [(wsk, found.get(key)) for wsk, key in keys]
+
+        wanted = fieldmask.wants(mask, 'organizerDisplayName') or \
+            fieldmask.wants(mask, 'etag')
+        organizers = {}
+        if wanted:
+            p_keys = list(set(conf.key.parent() for _, conf in confs if conf))
+            organizers = dict(zip(p_keys, entitycache.get_multi(p_keys)))
+
+        forms = ConferenceForms()
+        for wsk, conf in confs:
+            if not conf or conf.deleted:
+                forms.missingKeys.append(wsk)
+                continue
+            prof = organizers.get(conf.key.parent())
+            cf = self._copyConferenceToForm(conf, getattr(prof, 'displayName', None), mask)
+            if fieldmask.wants(mask, 'etag'):
+                # same tag getConference hands out for this conference
+                cf.etag = etags.compute(conf.version, getattr(prof, 'version', 0))
+            forms.items.append(cf)
+        return forms
+
+
+    @endpoints.method(KeysForm, SessionForms,
+            path='getSessionsByKeys',
+            http_method='POST', name='getSessionsByKeys')
+    @ratelimit.limited
+    def getSessionsByKeys(self, request):
+        """Return sessions for a list of websafe keys, in request order;
+        keys with no session are listed in missingKeys."""
+        mask = fieldmask.parse(request.fields, SessionForm)
+        keys = self._batchKeys(request.websafeKeys, 'Session')
+        found = self._getBatch(keys)
+
+        forms = SessionForms()
+        for wsk, key in keys:
+            sess = found.get(key)
+            if sess:
+                forms.items.append(self._copySessionToForm(sess, mask))
+            else:
+                forms.missingKeys.append(wsk)
+        return forms
+
+
+    def _copyChangeToForm(self, entity, names):
+        """Copy a changed entity (or its Tombstone) to a ChangeForm."""
+        cf = ChangeForm(changeSeq=entity.changeSeq)
+        if isinstance(entity, Tombstone):
+            cf.kind, cf.websafeKey, cf.deleted = entity.kind, entity.key.id(), True
+            return cf
+        cf.kind, cf.websafeKey = entity.key.kind(), entity.key.urlsafe()
+        if isinstance(entity, Conference):
+            cf.deleted = entity.deleted
+            if not entity.deleted:
+                cf.conference = self._copyConferenceToForm(
+                    entity, names.get(entity.organizerUserId))
+        elif isinstance(entity, Session):
+            cf.session = self._copySessionToForm(entity)
+        else:
+            cf.wishlist = WishListForm(sessionKey=entity.sessionKey)
+        return cf
+
+
+    # Offline clients keep a local copy and ask only for what changed
+    # since their last sync token; see changes.py.
+    @endpoints.method(CHANGES_REQUEST, ChangesForm,
+            path='changes',
+            http_method='GET', name='getChangesSince')
+    @ratelimit.limited
+    def getChangesSince(self, request):
+        """Return Conference, Session and (signed in) WishList changes
+        after syncToken, oldest first.  Start with no token, follow
+        syncToken while more is set, keep the last one for next time; on
+        resync, drop local data and start over."""
+        user = endpoints.get_current_user()
+        user_id = getUserId(user) if user else None
+        try:
+            entities, token, more, resync = changes.since(
+                request.syncToken, user_id, request.pageSize)
+        except changes.BadSyncToken as e:
+            raise endpoints.BadRequestException(str(e))
+
+        names = self._organizerNames(
+            [e for e in entities if isinstance(e, Conference) and not e.deleted], None)
+        return ChangesForm(
+            items=[self._copyChangeToForm(e, names) for e in entities],
+            syncToken=token,
+            more=more,
+            resync=resync,
+        )
+
+
+    @endpoints.method(FIELDS_REQUEST, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
+    @ratelimit.limited
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
@@ -635,39 +1215,130 @@ class ConferenceApi(remote.Service):
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
 
+        mask = fieldmask.parse(request.fields, ConferenceForm)
+
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        confs = self._conferenceQuery(mask, ancestor=ndb.Key(Profile, user_id))
+        prof = None
+        if fieldmask.wants(mask, 'organizerDisplayName'):
+            prof = ndb.Key(Profile, user_id).get()
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName', None), mask)
+                   for conf in confs if not conf.deleted]
         )
 
 
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
+    def _dateRange(self, date_filters):
+        """Return (first start date, last end date, in-memory predicate)
+        for date range filters; (None, None, predicate) if none can match."""
+        lo = hi = None
+        for filtr in date_filters:
+            # a conference is in the buckets of every day it runs, so an
+            # exact date only needs that day's buckets
+            if filtr["operator"] == "=" or filtr["field"] == "startDate":
+                lo = max(lo, filtr["value"]) if lo else filtr["value"]
+            if filtr["operator"] == "=" or filtr["field"] == "endDate":
+                hi = min(hi, filtr["value"]) if hi else filtr["value"]
+        lo = lo or hi - timedelta(days=MAX_DATE_RANGE_DAYS)
+        hi = hi or lo + timedelta(days=MAX_DATE_RANGE_DAYS)
+        if hi < lo:
+            return None, None, lambda conf: False
+
+        compare = {
+            '=': lambda a, b: a == b,
+            '>': lambda a, b: a > b,
+            '>=': lambda a, b: a >= b,
+            '<': lambda a, b: a < b,
+            '<=': lambda a, b: a <= b,
+        }
+
+        def keep(conf):
+            # trim the bucket edges to the exact requested range
+            dates = {"startDate": conf.startDate,
+                     "endDate": conf.endDate or conf.startDate}
+            return all(dates[f["field"]] and
+                       compare[f["operator"]](dates[f["field"]], f["value"])
+                       for f in date_filters)
+        return lo, hi, keep
+
+
+    def _getQuery(self, request, mask=None):
+        """Return the disjunct queries for the submitted filters, a predicate
+        that trims results to any requested date range, and the sort key
+        all the queries are ordered by."""
+        # unfiltered listings are the ones the projection index covers
+        if request.filters:
+            q = Conference.query()
+        else:
+            q = self._conferenceQuery(mask)
+        inequality_filter, filters, date_filters = self._formatFilters(request.filters)
+
+        # each multi-valued filter (and a date range) is one OR dimension
+        dimensions = []
+        keep = lambda conf: True
+        if date_filters:
+            lo, hi, keep = self._dateRange(date_filters)
+            if lo is None:
+                return [], keep, None
+            if (hi - lo).days <= WEEK_BUCKET_MAX_DAYS:
+                buckets = weekBuckets(lo, hi)
+            else:
+                buckets = monthBuckets(lo, hi)
+            others = 1
+            for filtr in filters:
+                others *= len(filtr["values"])
+            if len(buckets) * others <= MAX_DISJUNCTS:
+                dimensions.append(("dateBuckets", buckets))
+            elif not inequality_filter:
+                # too many buckets to OR together: a matching conference
+                # starts within lo..hi, so range on startDate and let keep
+                # trim the rest
+                inequality_filter = "startDate"
+                q = q.filter(Conference.startDate >= lo, Conference.startDate <= hi)
+            # else the inequality slot is taken; keep alone applies the range
 
         # If exists, sort on inequality filter first
         if not inequality_filter:
             q = q.order(Conference.name)
+            sort_key = lambda conf: (conf.name, conf.key.flat())
         else:
             q = q.order(ndb.GenericProperty(inequality_filter))
             q = q.order(Conference.name)
 
+            def sort_key(conf):
+                value = getattr(conf, inequality_filter)
+                # repeated properties sort on their smallest value
+                if isinstance(value, list):
+                    value = min(value) if value else None
+                return (value, conf.name, conf.key.flat())
+
         for filtr in filters:
             if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
+                filtr["values"] = [int(v) for v in filtr["values"]]
+            if len(filtr["values"]) > 1:
+                dimensions.append((filtr["field"], filtr["values"]))
+                continue
+            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["values"][0])
             q = q.filter(formatted_query)
-        return q
+
+        queries = [q]
+        if dimensions:
+            fields = [field for field, _ in dimensions]
+            combos = list(itertools.product(*[values for _, values in dimensions]))
+            if len(combos) > MAX_DISJUNCTS:
+                raise endpoints.BadRequestException(
+                    "Filters expand to more than %d queries." % MAX_DISJUNCTS)
+            queries = [q.filter(*[ndb.query.FilterNode(f, "=", v) for f, v in zip(fields, combo)])
+                       for combo in combos]
+        return queries, keep, sort_key
 
 
     def _formatFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
         formatted_filters = []
+        date_filters = []
         inequality_field = None
 
         for f in filters:
@@ -679,6 +1350,30 @@ class ConferenceApi(remote.Service):
             except KeyError:
                 raise endpoints.BadRequestException("Filter contains invalid field or operator.")
 
+            # value plus values (de-duplicated, in order) are OR'ed together
+            filtr["values"] = list(itertools.chain(
+                [filtr["value"]] if filtr["value"] is not None else [], filtr["values"]))
+            filtr["values"] = sorted(set(filtr["values"]), key=filtr["values"].index)
+            if not filtr["values"]:
+                raise endpoints.BadRequestException("Filter needs a value.")
+            if len(filtr["values"]) > 1 and filtr["operator"] != "=":
+                raise endpoints.BadRequestException("Multiple values are only allowed with EQ.")
+
+            # date ranges are bucket lookups, not inequalities
+            if filtr["field"] in DATE_RANGE_OPERATORS:
+                if len(filtr["values"]) > 1:
+                    raise endpoints.BadRequestException("Date filters take a single value.")
+                filtr["value"] = filtr["values"][0]
+                if filtr["operator"] not in DATE_RANGE_OPERATORS[filtr["field"]]:
+                    raise endpoints.BadRequestException(
+                        "START_DATE takes EQ/GT/GTEQ and END_DATE takes EQ/LT/LTEQ.")
+                try:
+                    filtr["value"] = datetime.strptime(filtr["value"][:10], "%Y-%m-%d").date()
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException("Date filters take YYYY-MM-DD values.")
+                date_filters.append(filtr)
+                continue
+
             # Every operation except "=" is an inequality
             if filtr["operator"] != "=":
                 # check if inequality operation has been used in previous filters
@@ -690,31 +1385,49 @@ class ConferenceApi(remote.Service):
                     inequality_field = filtr["field"]
 
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        return (inequality_field, formatted_filters, date_filters)
 
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
             path='queryConferences',
             http_method='POST',
             name='queryConferences')
+    @deadline.budgeted
+    @ratelimit.limited
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        """Query for conferences.  Filters may carry several EQ values, which
+        are OR'ed; pageSize/pageToken page through the merged results.
+        Without a pageSize, results are read until the request budget runs
+        out or deadline.MAX_ITEMS are read, then returned with partial=True
+        and a nextPageToken."""
+        mask = fieldmask.parse(request.fields, ConferenceForm)
+        queries, keep, sort_key = self._getQuery(request, mask)
+        conferences, next_token, partial = [], None, False
+        if queries:
+            try:
+                if request.pageSize:
+                    conferences, next_token = fanout.fetch(
+                        queries, sort_key, min(request.pageSize, MAX_PAGE_SIZE),
+                        request.pageToken)
+                else:
+                    # everything, unless the request budget runs out first
+                    conferences, next_token, partial = deadline.collect(
+                        lambda token: fanout.fetch(queries, sort_key,
+                                                   deadline.BATCH_SIZE, token),
+                        request.pageToken)
+            except fanout.BadPageToken as e:
+                raise endpoints.BadRequestException(str(e))
+            conferences = [conf for conf in conferences if keep(conf) and not conf.deleted]
+
+        # need to fetch organiser displayName from profiles (unless masked out)
+        names = self._organizerNames(conferences, mask)
 
         # return individual ConferenceForm object per Conference
         return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
+                items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId), mask)
+                       for conf in conferences],
+                nextPageToken=next_token,
+                partial=partial,
         )
 
 
@@ -740,8 +1453,12 @@ class ConferenceApi(remote.Service):
         return pf
 
 
-    def _getProfileFromUser(self):
-        """Return user Profile from datastore, creating new one if non-existent."""
+    def _getProfileFromUser(self, uow=None):
+        """Return user Profile from datastore, creating new one if non-existent.
+
+        With a UnitOfWork the profile is tracked, and a new one is only
+        written when the unit of work commits.
+        """
         # make sure user is authed
         user = endpoints.get_current_user()
         if not user:
@@ -759,7 +1476,13 @@ class ConferenceApi(remote.Service):
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
+            if uow:
+                uow.add(profile)
+            else:
+                profile.put()
+                entitycache.invalidate(p_key)
+        elif uow:
+            uow.track(profile)
 
         return profile      # return Profile
 
@@ -767,7 +1490,9 @@ class ConferenceApi(remote.Service):
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
         # get user Profile
-        prof = self._getProfileFromUser()
+        uow = unitofwork.UnitOfWork()
+        prof = self._getProfileFromUser(uow)
+        displayName = prof.displayName
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
@@ -780,7 +1505,14 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, str(val).upper())
                         #else:
                         #    setattr(prof, field, val)
-                        prof.put()
+
+        # one write for all changed fields (or the new profile), none otherwise
+        if uow.commit():
+            entitycache.invalidate(prof.key)
+            # organizer display name is part of each conference tag
+            if prof.displayName != displayName:
+                conf_keys = Conference.query(ancestor=prof.key).fetch(keys_only=True)
+                etags.invalidate(*[etags.conferenceTag(k.urlsafe()) for k in conf_keys])
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -788,6 +1520,7 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
+    @ratelimit.limited
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
@@ -795,6 +1528,7 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
             path='profile', http_method='POST', name='saveProfile')
+    @ratelimit.limited
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
@@ -827,12 +1561,35 @@ class ConferenceApi(remote.Service):
         return announcement
 
 
+    @staticmethod
+    def _cacheFeaturedSpeaker():
+        """Recompute the featured speaker from the most recently written
+        session's conference & assign to memcache; used by warmup.
+        """
+        latest = Session.query().order(-Session.updated).get()
+        if not latest:
+            return ""
+        speaker = latest.speaker
+        count = Session.query(ancestor=latest.key.parent()).filter(
+            Session.speaker == speaker).count(limit=2)
+        # same rule as createSession: speaking at least twice
+        if count > 1:
+            memcache.set(FEATURED_SPEAKER, speaker)
+            return speaker
+        return ""
+
+
     @endpoints.method(message_types.VoidMessage, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
+    @ratelimit.limited
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        data = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or ""
+        etag = etags.compute(data)
+        if etags.isCurrent(self, etag):
+            return StringMessage(data='', etag=etag, unchanged=True)
+        return StringMessage(data=data, etag=etag)
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
@@ -842,13 +1599,14 @@ class ConferenceApi(remote.Service):
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
         retval = None
-        prof = self._getProfileFromUser() # get user Profile
+        uow = unitofwork.UnitOfWork()
+        prof = self._getProfileFromUser(uow) # get user Profile
 
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
-        if not conf:
+        conf = uow.track(ndb.Key(urlsafe=wsck).get())
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
 
@@ -881,33 +1639,36 @@ class ConferenceApi(remote.Service):
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
+        # write changed entities back to the datastore in one batch & return
+        written = uow.commit()
+        if retval:
+            # counted by a task that only runs if this transaction commits
+            metrics.record('registrations' if reg else 'cancellations', wsck)
+        entitycache.invalidate(*written)
+        if conf.key in written:
+            etags.invalidate(etags.conferenceTag(conf.key.urlsafe()))
         return BooleanMessage(data=retval)
 
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(FIELDS_REQUEST, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
+    @ratelimit.limited
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
+        mask = fieldmask.parse(request.fields, ConferenceForm)
         prof = self._getProfileFromUser() # get user Profile
         conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        # skip conferences deleted (or being deleted) since registration
+        conferences = [conf for conf in ndb.get_multi(conf_keys)
+                       if conf and not conf.deleted]
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        # get organizers (unless masked out)
+        names = self._organizerNames(conferences, mask)
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
+        return ConferenceForms(items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId), mask)\
          for conf in conferences]
         )
 
@@ -915,6 +1676,8 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
+    @ratelimit.limited
+    @idempotency.idempotent
     def registerForConference(self, request):
         """Register user for selected conference."""
         return self._conferenceRegistration(request)
@@ -923,6 +1686,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='DELETE', name='unregisterFromConference')
+    @ratelimit.limited
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
@@ -931,6 +1695,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='filterPlayground',
             http_method='GET', name='filterPlayground')
+    @ratelimit.limited
     def filterPlayground(self, request):
         """Filter Playground"""
         q = Conference.query()
@@ -953,4 +1718,4 @@ class ConferenceApi(remote.Service):
 
 
 
-api = endpoints.api_server([ConferenceApi]) # register API
+api = profiling.middleware(endpoints.api_server([ConferenceApi])) # register API
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""
+deadline.py -- request time budgets for long-running list endpoints
+
+A Budget starts when an endpoint method decorated with @budgeted is
+entered, ahead of rate limiting and the method body, and ends
+SAFETY_MARGIN seconds before the request deadline, which leaves time to
+serialize what was gathered and covers what the framework spent before
+the method was called.  collect() reads a query batch by batch and stops
+before a batch that probably wouldn't finish inside the budget, or once
+it holds MAX_ITEMS, returning the results so far with a continuation
+token instead of letting the request die with a DeadlineExceededError
+or build a response too big for the instance.
+
+    items, token, partial = deadline.collect(deadline.queryPages(q), token)
+
+"""
+
+import functools
+import threading
+import time
+
+import endpoints
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
+
+# App Engine cuts front-end requests (and Endpoints calls) off at 60s
+REQUEST_DEADLINE_SECONDS = 60
+SAFETY_MARGIN_SECONDS = 15
+BATCH_SIZE = 200
+# most items one response carries, a whole number of batches
+MAX_ITEMS = 5 * BATCH_SIZE
+
+_active = threading.local()
+
+
+class Budget(object):
+    """Time left for the current request, minus a safety margin."""
+
+    def __init__(self, seconds=REQUEST_DEADLINE_SECONDS - SAFETY_MARGIN_SECONDS):
+        self.stop = time.time() + seconds
+        self.slowest = 0.0
+
+    def timed(self, func, *args):
+        """Call func, remembering the slowest call seen."""
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.slowest = max(self.slowest, time.time() - start)
+
+    def expired(self):
+        """True if another call as slow as the slowest so far would end
+        past the budget."""
+        return time.time() + self.slowest >= self.stop
+
+
+def budgeted(func):
+    """Start the request's Budget on entry to an API method.
+
+    Apply right below @endpoints.method, above @ratelimit.limited.
+    """
+    @functools.wraps(func)
+    def wrapper(self, request):
+        _active.budget = Budget()
+        try:
+            return func(self, request)
+        finally:
+            _active.budget = None
+    return wrapper
+
+
+def current():
+    """Return the running request's Budget, or a new one outside
+    @budgeted methods."""
+    return getattr(_active, 'budget', None) or Budget()
+
+
+def queryPages(query, batch_size=BATCH_SIZE):
+    """Return fetch_page(token) -> (items, next token or None) for query.
+    A token that isn't a cursor of this query is a BadRequestException."""
+    def fetch_page(token):
+        try:
+            cursor = Cursor(urlsafe=token) if token else None
+            items, next_cursor, more = query.fetch_page(batch_size, start_cursor=cursor)
+        except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+            if not token:
+                raise
+            raise endpoints.BadRequestException('Invalid page token.')
+        return items, next_cursor.urlsafe() if (more and next_cursor) else None
+    return fetch_page
+
+
+def collect(fetch_page, token=None, budget=None, max_items=MAX_ITEMS):
+    """Read pages from token on until they run out, the budget does or
+    max_items are read.
+
+    Returns (items, next token or None, partial); partial is True when
+    the budget or max_items stopped the read early.
+    """
+    budget = budget or current()
+    items = []
+    while True:
+        page, token = budget.timed(fetch_page, token)
+        items.extend(page)
+        if not token:
+            return items, None, False
+        if budget.expired() or len(items) >= max_items:
+            return items, token, True
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+deletion.py -- chained task-queue cleanup of deleted conferences
+
+deleteConference only marks the Conference deleted; this job then
+removes everything that hangs off it in bounded batches, chaining a new
+task before the request deadline:
+
+    1. 'subtree'       Sessions, their WishList children and any other
+                       descendants, via keys-only ancestor queries, plus
+                       the sessions' recommendation rows and wishlist
+                       count shards
+    2. 'registrations' the conference's key in every
+                       Profile.conferenceKeysToAttend, one transaction
+                       per profile so concurrent profile writes survive
+    3. 'metrics'       the conference's MetricShards
+    4. the Conference itself, its facet shards, leaderboard and cached
+       copies, leaving a Tombstone for getChangesSince
+
+Every batch can safely run twice, so task retries are harmless.
+
+"""
+
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import changes
+import entitycache
+import etags
+import facets
+import recommendations
+import trending
+from models import MetricShard
+from models import Profile
+
+TASK_URL = '/tasks/delete_conference'
+BATCH_SIZE = 200
+SLICE_SECONDS = 60
+
+
+def enqueue(websafeKey, phase='subtree', cursor=''):
+    """Queue a cleanup slice; transactional when called in a transaction."""
+    taskqueue.add(url=TASK_URL, transactional=ndb.in_transaction(), params={
+        'websafeConferenceKey': websafeKey, 'phase': phase, 'cursor': cursor})
+
+
+def _deleteSubtree(c_key, deadline):
+    """Delete descendants of c_key; return False if time ran out first."""
+    q = ndb.Query(ancestor=c_key)
+    while time.time() < deadline:
+        keys = [k for k in q.fetch(BATCH_SIZE + 1, keys_only=True) if k != c_key]
+        if not keys:
+            return True
+        keys = keys[:BATCH_SIZE]
+        sessionKeys = [k.urlsafe() for k in keys if k.kind() == 'Session']
+        recommendations.forget(sessionKeys)
+        trending.forgetSessions(sessionKeys)
+        # delete before bumping the cache version, so a concurrent read
+        # can't cache a session that is about to go under the new version
+        ndb.delete_multi(keys)
+        entitycache.invalidate(*keys)
+    return False
+
+
+@ndb.transactional()
+def _unregister(p_key, websafeKey):
+    """Remove websafeKey from one profile, re-read inside the transaction."""
+    prof = p_key.get()
+    if prof and websafeKey in prof.conferenceKeysToAttend:
+        prof.conferenceKeysToAttend = [
+            k for k in prof.conferenceKeysToAttend if k != websafeKey]
+        prof.put()
+
+
+def _purgeRegistrations(websafeKey, cursor, deadline):
+    """Remove websafeKey from attendee profiles; return the resume cursor,
+    or None once every profile has been processed."""
+    q = Profile.query(Profile.conferenceKeysToAttend == websafeKey)
+    start = Cursor(urlsafe=cursor) if cursor else None
+    while time.time() < deadline:
+        keys, start, more = q.fetch_page(BATCH_SIZE, start_cursor=start,
+                                         keys_only=True)
+        for p_key in keys:
+            _unregister(p_key, websafeKey)
+        entitycache.invalidate(*keys)
+        if not more or not start:
+            return None
+    return start.urlsafe()
+
+
+def _deleteMetrics(websafeKey, cursor, deadline):
+    """Delete the conference's metric shards; return the resume cursor, or
+    None once all are gone."""
+    q = MetricShard.query(MetricShard.conferenceKey == websafeKey)
+    start = Cursor(urlsafe=cursor) if cursor else None
+    while time.time() < deadline:
+        keys, start, more = q.fetch_page(BATCH_SIZE, start_cursor=start,
+                                         keys_only=True)
+        ndb.delete_multi(keys)
+        if not more or not start:
+            return None
+    return start.urlsafe()
+
+
+def run(websafeKey, phase, cursor=''):
+    """Run one slice of the cleanup and chain the next one if needed."""
+    c_key = ndb.Key(urlsafe=websafeKey)
+    deadline = time.time() + SLICE_SECONDS
+
+    if phase == 'subtree':
+        if not _deleteSubtree(c_key, deadline):
+            return enqueue(websafeKey, 'subtree')
+        phase, cursor = 'registrations', ''
+
+    if phase == 'registrations':
+        cursor = _purgeRegistrations(websafeKey, cursor, deadline)
+        if cursor:
+            return enqueue(websafeKey, 'registrations', cursor)
+        phase, cursor = 'metrics', ''
+
+    if phase == 'metrics':
+        cursor = _deleteMetrics(websafeKey, cursor, deadline)
+        if cursor:
+            return enqueue(websafeKey, 'metrics', cursor)
+
+    # sync clients learn of the deletion (and so of the sessions and
+    # wishlist entries under it) from the conference's tombstone, written
+    # in the same transaction as the delete
+    changes.delete(c_key)
+    ndb.delete_multi(facets.shardKeys(c_key))
+    facets.forget(c_key)
+    trending.forget(websafeKey)
+    entitycache.invalidate(c_key)
+    etags.invalidate(etags.conferenceTag(websafeKey),
+                     etags.sessionsTag(websafeKey))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+entitycache.py -- read-through entity cache shared across requests
+
+ndb's in-context cache only lives for a single request, so hot entities
+(a conference, its sessions, organizer profiles) are re-read from the
+datastore on every call.  This module keeps a bounded in-process LRU in
+front of memcache in front of the datastore.
+
+Every cached key has a version counter stored in memcache.  Cached copies
+are stored under (key, version), so bumping the version on a write makes
+every instance's local copy unreachable without having to reach into
+other instances' memory.  Versions are seeded from the clock, so a
+counter evicted from memcache never comes back as a value an older copy
+was stored under.
+
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+LOCAL_CACHE_SIZE = 2000
+MEMCACHE_TIME = 60 * 60
+VERSION_PREFIX = 'ENTITY_VER:'
+ENTITY_PREFIX = 'ENTITY:'
+
+_lock = threading.Lock()
+_local = OrderedDict()
+_stats = {
+    'local_hits': 0,
+    'memcache_hits': 0,
+    'misses': 0,
+    'evictions': 0,
+    'invalidations': 0,
+}
+
+
+def _count(name, n=1):
+    with _lock:
+        _stats[name] += n
+
+
+def _versionKey(key):
+    return VERSION_PREFIX + key.urlsafe()
+
+
+def _entityKey(key, version):
+    return '%s%s:%s' % (ENTITY_PREFIX, key.urlsafe(), version)
+
+
+def _localGet(cache_key):
+    with _lock:
+        entity = _local.pop(cache_key, None)
+        if entity is not None:
+            # re-insert to mark as most recently used
+            _local[cache_key] = entity
+        return entity
+
+
+def _localPut(cache_key, entity):
+    with _lock:
+        _local.pop(cache_key, None)
+        _local[cache_key] = entity
+        while len(_local) > LOCAL_CACHE_SIZE:
+            _local.popitem(last=False)
+            _stats['evictions'] += 1
+
+
+def _getVersions(keys):
+    """Return {version key: version}, seeding counters that are missing."""
+    version_keys = [_versionKey(k) for k in keys]
+    versions = memcache.get_multi(version_keys)
+    unseeded = [vk for vk in version_keys if vk not in versions]
+    if unseeded:
+        seed = int(time.time() * 1000000)
+        memcache.add_multi(dict((vk, seed) for vk in unseeded))
+        # another instance may have won the add; read back what stuck
+        versions.update(memcache.get_multi(unseeded))
+    return versions
+
+
+def get(key):
+    """Return the entity for key through the cache, or None."""
+    return get_multi([key])[0]
+
+
+def get_multi(keys):
+    """Resolve keys through local LRU, memcache and finally the datastore.
+
+    Returns a list aligned with keys; missing entities are None.
+    """
+    if not keys:
+        return []
+    unique = list(OrderedDict.fromkeys(keys))
+
+    # one memcache RPC for the current versions of every key
+    versions = _getVersions(unique)
+    cache_keys = {}
+    for k in unique:
+        cache_keys[k] = _entityKey(k, versions.get(_versionKey(k), 0))
+
+    found = {}
+    remote = []
+    for k in unique:
+        entity = _localGet(cache_keys[k])
+        if entity is not None:
+            found[k] = entity
+        else:
+            remote.append(k)
+    _count('local_hits', len(found))
+
+    if remote:
+        cached = memcache.get_multi([cache_keys[k] for k in remote])
+        missing = []
+        for k in remote:
+            entity = cached.get(cache_keys[k])
+            if entity is not None:
+                found[k] = entity
+                _localPut(cache_keys[k], entity)
+            else:
+                missing.append(k)
+        _count('memcache_hits', len(remote) - len(missing))
+
+        if missing:
+            # batched fill for everything neither cache had
+            _count('misses', len(missing))
+            to_cache = {}
+            for k, entity in zip(missing, ndb.get_multi(missing)):
+                if entity is None:
+                    continue
+                found[k] = entity
+                _localPut(cache_keys[k], entity)
+                to_cache[cache_keys[k]] = entity
+            if to_cache:
+                memcache.set_multi(to_cache, time=MEMCACHE_TIME)
+
+    return [found.get(k) for k in keys]
+
+
+def invalidate(*keys):
+    """Bump the version of each key so cached copies are no longer read.
+
+    Inside a transaction the bump is deferred until the commit succeeds,
+    so a concurrent reader cannot re-cache the pre-commit value.
+    """
+    keys = [k for k in keys if k is not None]
+    if not keys:
+        return
+
+    def bump():
+        seed = int(time.time() * 1000000)
+        for k in keys:
+            memcache.incr(_versionKey(k), initial_value=seed)
+        _count('invalidations', len(keys))
+
+    ndb.get_context().call_on_commit(bump)
+
+
+def stats():
+    """Return a snapshot of hit/miss/eviction counters for this instance."""
+    with _lock:
+        snapshot = dict(_stats)
+        snapshot['local_size'] = len(_local)
+    lookups = (snapshot['local_hits'] + snapshot['memcache_hits'] +
+               snapshot['misses'])
+    snapshot['hit_ratio'] = (
+        float(snapshot['local_hits'] + snapshot['memcache_hits']) / lookups
+        if lookups else 0.0)
+    return snapshot
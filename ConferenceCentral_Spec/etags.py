@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+etags.py -- conditional GET support for polled ConferenceApi reads
+
+ETags are derived from the version counters on Conference, Session and
+Profile and remembered in memcache per conference subtree.  A poll whose
+If-None-Match header matches the remembered tag is answered before any
+entity is fetched or any form is serialized, with an empty form flagged
+unchanged=true.  (Endpoints can't send a 304: it maps 3xx service
+exceptions to 404.)
+
+"""
+
+import hashlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+ETAG_PREFIX = 'ETAG:'
+MEMCACHE_TIME = 60 * 60
+# after an invalidation, refuse to re-remember a tag for this long so a
+# reader that computed it from pre-write data cannot put it back
+INVALIDATION_LOCK_SECONDS = 5
+
+
+def conferenceTag(websafeKey):
+    """Memcache key for the tag of one conference (plus organizer name)."""
+    return '%sconf:%s' % (ETAG_PREFIX, websafeKey)
+
+
+def sessionsTag(websafeKey):
+    """Memcache key for the tag of a conference's session list."""
+    return '%ssessions:%s' % (ETAG_PREFIX, websafeKey)
+
+
+def tagsForKeys(keys):
+    """Return the tag keys that cover the given Conference/Session keys."""
+    tags = set()
+    for key in keys:
+        if key.kind() == 'Conference':
+            tags.add(conferenceTag(key.urlsafe()))
+        elif key.kind() == 'Session':
+            tags.add(sessionsTag(key.parent().urlsafe()))
+    return list(tags)
+
+
+def compute(*parts):
+    """Return a quoted ETag over the given version parts."""
+    return '"%s"' % hashlib.md5(repr(parts)).hexdigest()
+
+
+def requested(service):
+    """Return the If-None-Match value sent to a protorpc service, or None."""
+    headers = getattr(service.request_state, 'headers', None)
+    if headers is None:
+        return None
+    return headers.get('If-None-Match')
+
+
+def variant(etag, mask=None):
+    """Return the tag of the representation trimmed to a field mask."""
+    if not etag or mask is None:
+        return etag
+    return compute(etag, sorted(mask))
+
+
+def isCached(service, tag_key, mask=None):
+    """True if the client already holds tag_key's tag (for the same field
+    mask)."""
+    sent = requested(service)
+    return bool(sent) and variant(memcache.get(tag_key), mask) == sent
+
+
+def isCurrent(service, etag):
+    """True if the client already holds etag."""
+    return bool(etag) and requested(service) == etag
+
+
+def remember(tag_key, *parts):
+    """Compute the tag for parts, remember it under tag_key and return it."""
+    etag = compute(*parts)
+    memcache.add(tag_key, etag, time=MEMCACHE_TIME)
+    return etag
+
+
+def invalidate(*tag_keys):
+    """Forget remembered tags once the current write (or transaction) commits."""
+    tag_keys = list(tag_keys)
+    if tag_keys:
+        ndb.get_context().call_on_commit(
+            lambda: memcache.delete_multi(
+                tag_keys, seconds=INVALIDATION_LOCK_SECONDS))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+facets.py -- incrementally maintained per-conference session facets
+
+Session counts by type, speaker, day and time bucket are kept in a small
+set of root-level SessionFacetShard entities per conference.  Each new
+session increments one randomly chosen shard, so concurrent session
+creation does not serialize on a single entity group; a read is one
+batched get of all shards (usually served from memcache).
+
+"""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Session
+from models import SessionFacetShard
+
+NUM_SHARDS = 5
+MEMCACHE_PREFIX = 'FACETS:'
+LOCK_SECONDS = 5
+FACETS = ('byType', 'bySpeaker', 'byDay', 'byTimeBucket')
+
+
+def shardKeys(c_key):
+    return [ndb.Key(SessionFacetShard, '%s:%d' % (c_key.urlsafe(), n))
+            for n in range(NUM_SHARDS)]
+
+
+def _values(sess):
+    """Return {facet: value} for one session."""
+    return {
+        'byType': sess.typeOfSession or 'unspecified',
+        'bySpeaker': sess.speaker,
+        'byDay': str(sess.date) if sess.date else 'unscheduled',
+        'byTimeBucket': sess.timeBucket,
+    }
+
+
+def _add(counts, sess, delta=1):
+    for facet, value in _values(sess).items():
+        counts[facet][value] = counts[facet].get(value, 0) + delta
+
+
+def record(sess, delta=1):
+    """Add (or with delta=-1 remove) one session in its conference facets."""
+    c_key = sess.key.parent()
+    shard_key = random.choice(shardKeys(c_key))
+
+    @ndb.transactional()
+    def txn():
+        shard = shard_key.get() or SessionFacetShard(
+            key=shard_key, conferenceKey=c_key)
+        counts = dict((f, dict(getattr(shard, f) or {})) for f in FACETS)
+        _add(counts, sess, delta)
+        for facet in FACETS:
+            setattr(shard, facet, dict(
+                (v, n) for v, n in counts[facet].items() if n > 0))
+        shard.put()
+    txn()
+    # lock the merged entry briefly so a concurrent reader can't re-add
+    # counts it merged before this increment
+    forget(c_key)
+
+
+def get(c_key):
+    """Return merged {facet: {value: count}} for a conference."""
+    cache_key = MEMCACHE_PREFIX + c_key.urlsafe()
+    counts = memcache.get(cache_key)
+    if counts is not None:
+        return counts
+    counts = dict((f, {}) for f in FACETS)
+    for shard in ndb.get_multi(shardKeys(c_key)):
+        if not shard:
+            continue
+        for facet in FACETS:
+            for value, n in (getattr(shard, facet) or {}).items():
+                counts[facet][value] = counts[facet].get(value, 0) + n
+    memcache.add(cache_key, counts)
+    return counts
+
+
+def forget(c_key):
+    """Drop the cached merged counts for a conference."""
+    memcache.delete(MEMCACHE_PREFIX + c_key.urlsafe(), seconds=LOCK_SECONDS)
+
+
+def rebuild(c_key):
+    """Recount a conference's facets from its session subtree.
+
+    Used to backfill conferences whose sessions predate the aggregates.
+    """
+    counts = dict((f, {}) for f in FACETS)
+    for sess in Session.query(ancestor=c_key):
+        _add(counts, sess)
+    keys = shardKeys(c_key)
+
+    @ndb.transactional(xg=True)
+    def txn():
+        shards = [SessionFacetShard(key=k, conferenceKey=c_key) for k in keys]
+        for facet in FACETS:
+            setattr(shards[0], facet, counts[facet])
+        ndb.put_multi(shards)
+    txn()
+    forget(c_key)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+fanout.py -- run disjunct queries concurrently and merge them in order
+
+An OR across filter values (city London or Paris, topic A or B, several
+date buckets) becomes one query per combination.  Every query shares the
+same sort order; their pages are fetched concurrently with
+fetch_page_async, merged on a sort key and de-duplicated by entity key.
+
+The page token records, per disjunct, the cursor its last fetch started
+from and how many results past that cursor have been consumed, so the
+next page resumes each disjunct exactly where the merge stopped.
+
+"""
+
+import base64
+import json
+
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
+
+
+class BadPageToken(ValueError):
+    """Raised for a page token that doesn't fit the query."""
+
+
+def _encode(states):
+    return base64.urlsafe_b64encode(json.dumps(states))
+
+
+def _decode(token, count):
+    try:
+        states = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        raise BadPageToken('Malformed page token.')
+    if not isinstance(states, list) or len(states) != count:
+        raise BadPageToken('Page token does not match these filters.')
+    try:
+        return [[Cursor(urlsafe=cursor) if cursor else None, int(skip), bool(done)]
+                for cursor, skip, done in states]
+    except (TypeError, ValueError, datastore_errors.BadValueError):
+        raise BadPageToken('Malformed page token.')
+
+
+def fetch(queries, sort_key, page_size=None, token=None):
+    """Return (merged entities, next page token or None).
+
+    Without page_size every disjunct is read to the end.
+    """
+    if token:
+        states = _decode(token, len(queries))
+    else:
+        states = [[None, 0, False] for _ in queries]
+
+    futures = []
+    for q, (cursor, skip, done) in zip(queries, states):
+        if done:
+            futures.append(None)
+        elif page_size is None:
+            futures.append(q.fetch_async())
+        else:
+            futures.append(q.fetch_page_async(
+                page_size, offset=skip, start_cursor=cursor))
+
+    buffers = []
+    for future in futures:
+        if future is None:
+            buffers.append(([], None, False))
+        elif page_size is None:
+            buffers.append((future.get_result(), None, False))
+        else:
+            try:
+                buffers.append(future.get_result())
+            except datastore_errors.BadRequestError:
+                # a cursor from some other query
+                if not token:
+                    raise
+                raise BadPageToken('Page token does not match these filters.')
+
+    heads = [0] * len(queries)
+    merged = []
+    seen = set()
+
+    def candidates():
+        return [i for i, (items, _, _) in enumerate(buffers)
+                if heads[i] < len(items)]
+
+    while page_size is None or len(merged) < page_size:
+        live = candidates()
+        # a drained buffer with more results behind it could hold the next
+        # smallest item; stop the page there rather than guess
+        if not live or any(heads[i] >= len(items) and more
+                           for i, (items, _, more) in enumerate(buffers)):
+            break
+        best = min(live, key=lambda i: sort_key(buffers[i][0][heads[i]]))
+        entity = buffers[best][0][heads[best]]
+        heads[best] += 1
+        if entity.key not in seen:
+            seen.add(entity.key)
+            merged.append(entity)
+
+    # consume duplicates of emitted entities still waiting at the heads
+    for i, (items, _, _) in enumerate(buffers):
+        while heads[i] < len(items) and items[heads[i]].key in seen:
+            heads[i] += 1
+
+    if page_size is None:
+        return merged, None
+
+    next_states = []
+    for (cursor, skip, done), (items, next_cursor, more), head in zip(
+            states, buffers, heads):
+        cursor = cursor.urlsafe() if cursor else ''
+        if done:
+            next_states.append([cursor, skip, True])
+        elif head >= len(items):
+            if more and next_cursor:
+                next_states.append([next_cursor.urlsafe(), 0, False])
+            else:
+                next_states.append(['', 0, True])
+        else:
+            next_states.append([cursor, skip + head, False])
+
+    if all(done for _, _, done in next_states):
+        return merged, None
+    return merged, _encode(next_states)
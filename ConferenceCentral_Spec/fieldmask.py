@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+"""
+fieldmask.py -- optional response field masks for ConferenceApi reads
+
+A mask is a comma separated list of form field names, for example
+fields=name,city,startDate.  The copy-to-form helpers only read and
+convert masked fields, and reads whose mask is covered by a projection
+index fetch just those properties from the index instead of whole
+entities.
+
+"""
+
+import endpoints
+
+
+def parse(mask, form_cls):
+    """Return the set of field names in mask, or None for every field."""
+    if not mask:
+        return None
+    names = set(name.strip() for name in mask.split(',') if name.strip())
+    unknown = names - set(field.name for field in form_cls.all_fields())
+    if unknown:
+        raise endpoints.BadRequestException(
+            'Unknown fields in mask: %s' % ', '.join(sorted(unknown)))
+    return frozenset(names)
+
+
+def fieldsOf(form_cls, mask):
+    """Return the fields of form_cls selected by mask, in field order."""
+    return [field for field in form_cls.all_fields()
+            if mask is None or field.name in mask]
+
+
+def wants(mask, name):
+    """True if the named field is part of the response."""
+    return mask is None or name in mask
+
+
+def covered(mask, covering):
+    """True if every masked field can be filled from a covering projection."""
+    return mask is not None and mask <= covering
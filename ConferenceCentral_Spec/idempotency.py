@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""
+idempotency.py -- replay recorded responses for retried API calls
+
+A client that may retry a call sends an Idempotency-Key header.  The
+first successful response for (user, method, key) is recorded in
+memcache and in a short-lived IdempotencyRecord entity; a retry within
+WINDOW_SECONDS gets the recorded response back without running the
+method again, so no ids are allocated, nothing is written twice and no
+second confirmation email is queued.
+
+While the first call is still running, a concurrent retry is rejected
+with 409 instead of being run in parallel.
+
+"""
+
+import functools
+import hashlib
+from datetime import datetime
+from datetime import timedelta
+
+import endpoints
+from protorpc import protojson
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import models
+from models import ConflictException
+from models import IdempotencyRecord
+
+HEADER = 'Idempotency-Key'
+WINDOW_SECONDS = 24 * 60 * 60
+# how long a running call holds its key before a retry may run it again
+IN_PROGRESS_SECONDS = 60
+MEMCACHE_PREFIX = 'IDEMPOTENCY:'
+IN_PROGRESS = 'IN_PROGRESS'
+PURGE_BATCH = 500
+
+
+def _recordId(method, key):
+    user = endpoints.get_current_user()
+    caller = user.email() if user else ''
+    return hashlib.sha1('%s\n%s\n%s' % (caller, method, key)).hexdigest()
+
+
+def _decode(recorded):
+    response_type, body = recorded
+    return protojson.decode_message(getattr(models, response_type), body)
+
+
+def _lookup(record_id):
+    """Return the recorded (type, body) for record_id, or None."""
+    recorded = memcache.get(MEMCACHE_PREFIX + record_id)
+    if recorded is not None:
+        return recorded
+    record = IdempotencyRecord.get_by_id(record_id)
+    if record and record.expires > datetime.utcnow():
+        recorded = (record.responseType, record.response)
+        memcache.set(MEMCACHE_PREFIX + record_id, recorded,
+                     time=WINDOW_SECONDS)
+        return recorded
+    return None
+
+
+def _record(record_id, response):
+    recorded = (type(response).__name__, protojson.encode_message(response))
+    IdempotencyRecord(
+        id=record_id, responseType=recorded[0], response=recorded[1],
+        expires=datetime.utcnow() + timedelta(seconds=WINDOW_SECONDS)).put()
+    memcache.set(MEMCACHE_PREFIX + record_id, recorded, time=WINDOW_SECONDS)
+
+
+def idempotent(func):
+    """Replay the recorded response for a repeated Idempotency-Key.
+
+    Apply below @endpoints.method; calls without the header run as usual.
+    """
+    @functools.wraps(func)
+    def wrapper(self, request):
+        headers = getattr(self.request_state, 'headers', None)
+        key = headers.get(HEADER) if headers is not None else None
+        if not key:
+            return func(self, request)
+
+        record_id = _recordId(func.__name__, key)
+        recorded = _lookup(record_id)
+        if recorded is not None:
+            return _decode(recorded)
+        lock_key = MEMCACHE_PREFIX + 'lock:' + record_id
+        if not memcache.add(lock_key, IN_PROGRESS, time=IN_PROGRESS_SECONDS):
+            raise ConflictException(
+                'A request with this %s is still in progress.' % HEADER)
+        try:
+            # the first call may have finished between the lookup and the lock
+            recorded = _lookup(record_id)
+            if recorded is not None:
+                return _decode(recorded)
+            response = func(self, request)
+            _record(record_id, response)
+            return response
+        finally:
+            memcache.delete(lock_key)
+    return wrapper
+
+
+def purgeExpired():
+    """Delete expired records; used by the purge cron job."""
+    q = IdempotencyRecord.query(IdempotencyRecord.expires < datetime.utcnow())
+    deleted = 0
+    while True:
+        keys = q.fetch(PURGE_BATCH, keys_only=True)
+        if not keys:
+            return deleted
+        ndb.delete_multi(keys)
+        deleted += len(keys)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+identity.py -- email to user id mapping for getUserId's custom mode
+
+Each normalized email owns one EmailIndex entity, keyed by the email, that
+holds the user id minted for it on first login.  Creation is
+transactional, so concurrent first logins agree on a single id.  The
+mapping never changes once written, so it is cached without
+invalidation: an in-process LRU, then memcache, then one get by key.
+
+"""
+
+import threading
+import uuid
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import EmailIndex
+
+LOCAL_CACHE_SIZE = 10000
+MEMCACHE_PREFIX = 'USERID:'
+
+_lock = threading.Lock()
+_local = OrderedDict()
+
+
+def normalize(email):
+    """Return the canonical form an email is indexed under."""
+    return email.strip().lower()
+
+
+def _localGet(email):
+    with _lock:
+        user_id = _local.pop(email, None)
+        if user_id is not None:
+            # re-insert to mark as most recently used
+            _local[email] = user_id
+        return user_id
+
+
+def _localPut(email, user_id):
+    with _lock:
+        _local.pop(email, None)
+        _local[email] = user_id
+        while len(_local) > LOCAL_CACHE_SIZE:
+            _local.popitem(last=False)
+
+
+@ndb.transactional()
+def _claim(key):
+    """Return the user id for key, minting and storing one if needed."""
+    index = key.get()
+    if index is None:
+        index = EmailIndex(key=key, userId=uuid.uuid4().hex)
+        index.put()
+    return index.userId
+
+
+# getUserId is called inside callers' transactions too; the EmailIndex
+# is its own entity group, so keep its reads and _claim out of them
+@ndb.non_transactional
+def userIdForEmail(email):
+    """Return the stable user id for email, creating it on first use."""
+    email = normalize(email)
+    user_id = _localGet(email)
+    if user_id is not None:
+        return user_id
+
+    user_id = memcache.get(MEMCACHE_PREFIX + email)
+    if user_id is None:
+        key = ndb.Key(EmailIndex, email)
+        index = key.get()
+        user_id = index.userId if index else _claim(key)
+        memcache.set(MEMCACHE_PREFIX + email, user_id)
+    _localPut(email, user_id)
+    return user_id
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+
+"""
+loadgen.py -- open-loop mixed-workload load generator
+
+    python loadgen.py --sdk ~/google_appengine --rates 10,25,50,100 \
+        --duration 10 --threads 64 --mix registerForConference=4,getAnnouncement=4
+
+Runs conference.api and main.app in-process against the local testbed
+stubs.  Each load step issues requests at a fixed arrival rate (evenly
+spaced, or Poisson with --poisson) no matter how fast earlier requests
+finish, so queueing shows up as latency instead of silently lowering
+the offered load.  Latency is measured from each request's scheduled
+arrival time.
+
+Per step it reports throughput, latency percentiles, error counts by
+HTTP status, datastore transactions and commit collisions (every
+collision is a transaction ndb retries or gives up on), and the
+memcache get hit ratio.  --hot-conferences focuses registrations on a
+few Conference entity groups; --flush-interval empties memcache
+periodically to expose cache stampedes.
+
+Authentication is replaced by one simulated user per request, drawn
+from --users, since the stubs can't verify OAuth tokens.
+
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import Queue
+
+# weights of the default mix; name=weight pairs in --mix override them
+DEFAULT_MIX = {
+    'registerForConference': 3,
+    'unregisterFromConference': 2,
+    'getAnnouncement': 4,
+    'getConference': 4,
+    'getConferenceSessions': 3,
+    'queryConferences': 2,
+    'addSessionToWishlist': 2,
+    'getProfile': 2,
+    'setAnnouncement': 1,
+}
+
+_identity = threading.local()
+
+
+def setupSdk(sdk):
+    """Put the App Engine SDK and its bundled libraries on sys.path."""
+    if sdk:
+        sys.path.insert(0, os.path.expanduser(sdk))
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+def _activateTestbed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id='loadgen', overwrite=True)
+    # high-replication behaviour: queries see writes after a delay
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=0.5))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+    bed.init_mail_stub()
+    bed.init_app_identity_stub()
+    bed.init_urlfetch_stub()
+    bed.init_user_stub()
+    return bed
+
+
+class Counters(object):
+    """RPC counters fed by apiproxy hooks, shared by all worker threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.values = dict.fromkeys(
+                ('transactions', 'collisions', 'memcache_gets',
+                 'memcache_hits'), 0)
+
+    def add(self, **deltas):
+        with self._lock:
+            for name, n in deltas.items():
+                self.values[name] += n
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.values)
+
+    def postCall(self, service, call, request, response, rpc=None, error=None):
+        if service == 'datastore_v3':
+            if call == 'BeginTransaction' and error is None:
+                self.add(transactions=1)
+            elif call == 'Commit' and error is not None:
+                self.add(collisions=1)
+        elif service == 'memcache' and call == 'Get' and error is None:
+            self.add(memcache_gets=request.key_size(),
+                     memcache_hits=response.item_size())
+
+
+class Step(object):
+    """Latencies and outcomes collected during one load step."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.statuses = {}
+        self.by_op = {}
+
+    def record(self, op, status, latency):
+        with self._lock:
+            self.latencies.append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.by_op.setdefault(op, []).append(latency)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def _seed(conferences, sessions, users, rnd):
+    """Create profiles, conferences and sessions; return the key lists."""
+    from google.appengine.ext import ndb
+    from models import Conference, Profile, Session
+
+    profiles = [Profile(id=u, displayName=u, mainEmail=u, teeShirtSize='NOT_SPECIFIED')
+                for u in users]
+    ndb.put_multi(profiles)
+    confs = []
+    for i in range(conferences):
+        organizer = rnd.choice(users)
+        confs.append(Conference(
+            parent=ndb.Key(Profile, organizer), name='Conference %d' % i,
+            organizerUserId=organizer, city=rnd.choice(['London', 'Paris', 'Tokyo']),
+            topics=['Topic %d' % (i % 5)], month=1 + i % 12,
+            maxAttendees=len(users), seatsAvailable=len(users)))
+    conf_keys = ndb.put_multi(confs)
+    sess = []
+    for c_key in conf_keys:
+        for j in range(sessions):
+            sess.append(Session(
+                parent=c_key, name='Session %d' % j,
+                speaker='Speaker %d' % rnd.randint(0, 20),
+                typeOfSession=rnd.choice(['Talk', 'Workshop']),
+                startTime=rnd.randint(8, 20), duration=60,
+                websafeKey=c_key.urlsafe()))
+    session_keys = ndb.put_multi(sess)
+    return ([k.urlsafe() for k in conf_keys], [k.urlsafe() for k in session_keys])
+
+
+class Workload(object):
+    """Builds (op, app, path, body) requests for a weighted operation mix."""
+
+    def __init__(self, mix, users, conf_keys, session_keys, hot, seed):
+        self.rnd = random.Random(seed)
+        self.ops = sorted(mix)
+        self.weights = [mix[op] for op in self.ops]
+        self.users = users
+        self.conf_keys = conf_keys
+        self.hot = conf_keys[:hot] if hot else conf_keys
+        self.session_keys = session_keys
+
+    def _pick(self):
+        point = self.rnd.uniform(0, sum(self.weights))
+        for op, weight in zip(self.ops, self.weights):
+            point -= weight
+            if point <= 0:
+                return op
+        return self.ops[-1]
+
+    def next(self):
+        op = self._pick()
+        user = self.rnd.choice(self.users)
+        if op == 'setAnnouncement':
+            return op, user, 'main', '/crons/set_announcement', None
+        body = {}
+        if op in ('registerForConference', 'unregisterFromConference'):
+            body['websafeConferenceKey'] = self.rnd.choice(self.hot)
+        elif op == 'getConference':
+            body['websafeConferenceKey'] = self.rnd.choice(self.conf_keys)
+        elif op == 'getConferenceSessions':
+            body['data'] = self.rnd.choice(self.conf_keys)
+        elif op == 'queryConferences':
+            body['filters'] = [{'field': 'CITY', 'operator': 'EQ',
+                                'value': self.rnd.choice(['London', 'Paris'])}]
+        elif op == 'addSessionToWishlist':
+            body['sessionKey'] = self.rnd.choice(self.session_keys)
+        return op, user, 'api', '/_ah/spi/ConferenceApi.%s' % op, body
+
+
+def _call(apps, app, path, body):
+    """Run one request through a WSGI app; return the HTTP status code."""
+    import webapp2
+    from google.appengine.ext import ndb
+    # a fresh ndb context per request, as in production
+    ndb.set_context(None)
+    if body is None:
+        req = webapp2.Request.blank(path)
+    else:
+        req = webapp2.Request.blank(path, headers={
+            'Content-Type': 'application/json',
+            'X-Appengine-Peer': 'apiserving'})
+        req.method = 'POST'
+        req.body = json.dumps(body)
+    return req.get_response(apps[app]).status_int
+
+
+def _worker(apps, work, step_ref):
+    from google.appengine.api import users
+    while True:
+        item = work.get()
+        if item is None:
+            return
+        scheduled, (op, user, app, path, body) = item
+        _identity.user = users.User(email=user, _auth_domain='gmail.com')
+        try:
+            status = _call(apps, app, path, body)
+        except Exception as e:
+            status = type(e).__name__
+        step_ref[0].record(op, status, time.time() - scheduled)
+
+
+def _flusher(interval, stop):
+    from google.appengine.api import memcache
+    while not stop.wait(interval):
+        memcache.flush_all()
+
+
+def runStep(rate, duration, workload, work, step_ref, poisson, rnd):
+    """Offer rate requests/second for duration seconds; return the Step."""
+    step = step_ref[0] = Step(rate)
+    start = time.time()
+    arrival = start
+    issued = 0
+    while arrival < start + duration:
+        delay = arrival - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        work.put((arrival, workload.next()))
+        issued += 1
+        arrival += rnd.expovariate(rate) if poisson else 1.0 / rate
+    # wait for the step's backlog to drain before reporting it
+    while len(step.latencies) < issued:
+        time.sleep(0.01)
+    step.elapsed = time.time() - start
+    return step
+
+
+def report(step, counters):
+    done = len(step.latencies)
+    errors = sum(n for status, n in step.statuses.items() if status != 200)
+    lat = [1000 * l for l in step.latencies]
+    gets = counters['memcache_gets']
+    print('rate %6.1f/s  done %6d  throughput %7.1f/s  errors %5.1f%%' % (
+        step.rate, done, done / step.elapsed, 100.0 * errors / max(done, 1)))
+    print('  latency ms  p50 %8.1f  p90 %8.1f  p99 %8.1f  max %8.1f' % (
+        percentile(lat, 50), percentile(lat, 90), percentile(lat, 99),
+        max(lat) if lat else 0.0))
+    print('  transactions %6d  collisions %6d  memcache hit %5.1f%%' % (
+        counters['transactions'], counters['collisions'],
+        100.0 * counters['memcache_hits'] / gets if gets else 0.0))
+    print('  statuses %s' % ', '.join(
+        '%s=%d' % item for item in sorted(step.statuses.items())))
+    for op in sorted(step.by_op):
+        ops = [1000 * l for l in step.by_op[op]]
+        print('    %-26s %6d  p50 %8.1f  p99 %8.1f' % (
+            op, len(ops), percentile(ops, 50), percentile(ops, 99)))
+
+
+def _parseMix(spec):
+    mix = dict(DEFAULT_MIX)
+    if spec:
+        mix = {}
+        for pair in spec.split(','):
+            op, _, weight = pair.partition('=')
+            if op not in DEFAULT_MIX:
+                raise ValueError('unknown operation: %s' % op)
+            mix[op] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sdk', help='App Engine SDK directory')
+    parser.add_argument('--rates', default='10,25,50,100',
+                        help='requests/second for each load step')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--mix', help='op=weight,... (default: %s)' % ','.join(
+        '%s=%s' % item for item in sorted(DEFAULT_MIX.items())))
+    parser.add_argument('--poisson', action='store_true',
+                        help='exponential inter-arrival times')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--conferences', type=int, default=20)
+    parser.add_argument('--sessions', type=int, default=10)
+    parser.add_argument('--hot-conferences', type=int, default=1,
+                        help='registrations target only the first N conferences')
+    parser.add_argument('--flush-interval', type=float, default=0,
+                        help='flush memcache every N seconds (0: never)')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    try:
+        mix = _parseMix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        setupSdk(args.sdk)
+    except ImportError:
+        parser.error('App Engine SDK not found; pass its directory with --sdk')
+    bed = _activateTestbed()
+    try:
+        import endpoints
+        from google.appengine.api import apiproxy_stub_map
+        endpoints.get_current_user = lambda: getattr(_identity, 'user', None)
+        import conference
+        import main as handlers
+
+        counters = Counters()
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'loadgen_post', counters.postCall)
+
+        rnd = random.Random(args.seed)
+        users = ['user%d@example.com' % i for i in range(args.users)]
+        conf_keys, session_keys = _seed(args.conferences, args.sessions, users, rnd)
+        workload = Workload(mix, users, conf_keys, session_keys,
+                            args.hot_conferences, args.seed)
+        apps = {'api': conference.api, 'main': handlers.app}
+
+        work = Queue.Queue()
+        step_ref = [None]
+        workers = [threading.Thread(target=_worker, args=(apps, work, step_ref))
+                   for _ in range(args.threads)]
+        stop = threading.Event()
+        if args.flush_interval:
+            workers.append(threading.Thread(
+                target=_flusher, args=(args.flush_interval, stop)))
+        for t in workers:
+            t.daemon = True
+            t.start()
+
+        for rate in [float(r) for r in args.rates.split(',')]:
+            counters.reset()
+            step = runStep(rate, args.duration, workload, work, step_ref,
+                           args.poisson, rnd)
+            report(step, counters.snapshot())
+        stop.set()
+        for _ in range(args.threads):
+            work.put(None)
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
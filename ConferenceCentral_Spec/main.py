@@ -12,10 +12,28 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+from datetime import datetime
+
+import endpoints
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from protorpc import messages
 from conference import ConferenceApi
+import backfills
+import bulkapi
+import changes
+import deletion
+import entitycache
+import idempotency
+import mapper
+import metrics
+import profiling
+import recommendations
+import trending
+import unitofwork
+import warmup
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -24,6 +42,81 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
+class PurgeIdempotencyRecordsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Delete expired idempotency records."""
+        idempotency.purgeExpired()
+        self.response.set_status(204)
+
+
+class PurgeTombstonesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Delete sync tombstones past their retention."""
+        changes.purgeTombstones()
+        self.response.set_status(204)
+
+
+class PurgeTombstonesTaskHandler(webapp2.RequestHandler):
+    def post(self):
+        """Continue deleting expired sync tombstones from a cursor."""
+        changes.purgeTombstones(self.request.get('cursor'),
+                                int(self.request.get('cutoff')))
+
+
+class BuildRecommendationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start rebuilding session recommendations from all wishlists."""
+        recommendations.startRebuild()
+        self.response.set_status(204)
+
+
+class BuildRecommendationsTaskHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run one slice of a recommendations rebuild."""
+        recommendations.runRebuild(int(self.request.get('generation')),
+                                   self.request.get('phase'),
+                                   self.request.get('cursor'),
+                                   int(self.request.get('slice') or 0))
+
+
+class UpdateRecommendationsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Fold a new wishlist entry into session recommendations."""
+        recommendations.update(self.request.get('sessionKey'),
+                               self.request.get('userID'))
+
+
+class CompactMetricsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Fold old hourly metric shards into daily counts."""
+        metrics.compact()
+        self.response.set_status(204)
+
+
+class CompactMetricsTaskHandler(webapp2.RequestHandler):
+    def post(self):
+        """Continue folding old hourly metric shards from a cursor."""
+        metrics.compact(self.request.get('cursor'), datetime.strptime(
+            self.request.get('cutoff'), metrics.TIME_FORMAT))
+
+
+class RecordMetricHandler(webapp2.RequestHandler):
+    def post(self):
+        """Count one registration or wishlist event."""
+        metrics.increment(self.request.get('metric'),
+                          self.request.get('conferenceKey'),
+                          self.request.get('sessionKey'),
+                          self.request.get('at'),
+                          self.request.get('event'))
+
+
+class FlushTrendingHandler(webapp2.RequestHandler):
+    def get(self):
+        """Flush buffered wishlist deltas into the trending leaderboards."""
+        trending.flush()
+        self.response.set_status(204)
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
         """Send email confirming Conference creation."""
@@ -38,7 +131,123 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 
-app = webapp2.WSGIApplication([
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Preload the API and prime hot caches on instance start."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(warmup.warm()))
+
+
+class DeleteConferenceHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run one slice of a deleted conference's cleanup."""
+        deletion.run(self.request.get('websafeConferenceKey'),
+                     self.request.get('phase'),
+                     self.request.get('cursor'))
+
+
+class MapperTaskHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run one slice of a mapper shard."""
+        mapper.run(self.request.get('status'), self.request.get('cursor'))
+
+
+class MapperAdminHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report progress & throughput of mapper jobs."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'mappers': sorted(mapper.MAPPERS),
+            'jobs': mapper.progress(),
+        }))
+
+    def post(self):
+        """Start a registered mapper job."""
+        name = self.request.get('mapper')
+        if name not in mapper.MAPPERS:
+            self.abort(400, 'Unknown mapper: %s' % name)
+        job = mapper.start(name,
+                           shards=int(self.request.get('shards', 1)),
+                           batch_size=int(self.request.get('batch_size', 100)))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'job': job}))
+
+
+class ProfilesAdminHandler(webapp2.RequestHandler):
+    def get(self):
+        """List stored slow-request profiles, or show one with ?id=."""
+        capture_id = self.request.get('id')
+        if capture_id:
+            capture = profiling.capture(capture_id)
+            if capture is None:
+                self.abort(404, 'No profile capture: %s' % capture_id)
+            body = capture
+        else:
+            body = {'sample_rate': profiling.SAMPLE_RATE,
+                    'threshold_ms': profiling.THRESHOLD_MS,
+                    'captures': profiling.captures()}
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(body))
+
+
+class BulkApiHandler(webapp2.RequestHandler):
+    def get(self, name):
+        """Serve a ConferenceApi list method as JSON or protobuf."""
+        self._serve(name)
+
+    def post(self, name):
+        """Serve a ConferenceApi list method as JSON or protobuf."""
+        self._serve(name)
+
+    def _serve(self, name):
+        if name not in bulkapi.METHODS:
+            self.abort(404, 'Unknown list method: %s' % name)
+        content_type = bulkapi.negotiate(self.request)
+        try:
+            message = bulkapi.decodeRequest(name, self.request)
+            response = bulkapi.invoke(name, message, self.request)
+        except (ValueError, messages.Error) as e:
+            self.abort(400, str(e))
+        except endpoints.ServiceException as e:
+            self.abort(e.http_status, str(e))
+        self.response.headers['Content-Type'] = content_type
+        self.response.headers['Vary'] = 'Accept'
+        self.response.write(bulkapi.encode(response, content_type))
+
+
+class EntityCacheStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report entity cache hit/miss/eviction counters for this instance."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(entitycache.stats()))
+
+
+class WriteStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report coalesced and skipped entity writes for this instance."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(unitofwork.stats()))
+
+
+app = profiling.middleware(webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/purge_idempotency_records', PurgeIdempotencyRecordsHandler),
+    ('/crons/purge_tombstones', PurgeTombstonesHandler),
+    ('/crons/build_recommendations', BuildRecommendationsHandler),
+    ('/crons/compact_metrics', CompactMetricsHandler),
+    ('/crons/flush_trending', FlushTrendingHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-], debug=True)
+    ('/admin/entity_cache_stats', EntityCacheStatsHandler),
+    ('/_ah/warmup', WarmupHandler),
+    ('/tasks/mapper', MapperTaskHandler),
+    ('/tasks/delete_conference', DeleteConferenceHandler),
+    ('/tasks/update_recommendations', UpdateRecommendationsHandler),
+    ('/tasks/build_recommendations', BuildRecommendationsTaskHandler),
+    ('/tasks/record_metric', RecordMetricHandler),
+    ('/tasks/compact_metrics', CompactMetricsTaskHandler),
+    ('/tasks/purge_tombstones', PurgeTombstonesTaskHandler),
+    ('/admin/mappers', MapperAdminHandler),
+    ('/admin/profiles', ProfilesAdminHandler),
+    ('/admin/write_stats', WriteStatsHandler),
+    (r'/bulk/(\w+)', BulkApiHandler),
+], debug=True))
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""
+mapper.py -- checkpointed batch mapper driven through the task queue
+
+A mapper applies a registered function to every entity of a kind, one
+batch at a time.  Progress is checkpointed in a MapperStatus entity per
+shard: each task carries the cursor it expects to resume from, and the
+checkpoint only advances, in a transaction, if it still holds that
+cursor, so a retried or duplicated task never advances a shard twice.
+Tasks chain a follow-up task well before the request deadline.
+
+A batch's writes are not part of that transaction: they are made
+first, and the checkpoint after them.  Mapped functions must therefore
+be idempotent, since a batch whose task fails or is duplicated before
+its checkpoint commits is written again from the same cursor.
+
+"""
+
+import logging
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import entitycache
+import etags
+from models import MapperStatus
+
+TASK_URL = '/tasks/mapper'
+# stop taking new batches this long into a task and chain a follow-up
+SLICE_SECONDS = 60
+# oversampling of __scatter__ keys used to pick shard split points
+SCATTER_OVERSAMPLE = 32
+
+MAPPERS = {}
+
+
+def register(name, kind, batch=False):
+    """Register a mapper function under name for entities of kind.
+
+    The function takes one entity and returns it (or any entities) to be
+    written, or None.  With batch=True it takes the whole list of entities
+    of a batch instead and does its own writes.
+    """
+    def decorator(func):
+        MAPPERS[name] = (kind, func, batch)
+        return func
+    return decorator
+
+
+def _splitPoints(kind, shards):
+    """Return shards-1 ordered keys that divide kind into key ranges."""
+    if shards <= 1:
+        return []
+    sample = ndb.Query(kind=kind).order(ndb.GenericProperty('__scatter__')).fetch(
+        shards * SCATTER_OVERSAMPLE, keys_only=True)
+    sample.sort()
+    if len(sample) < shards:
+        return sample
+    step = len(sample) / float(shards)
+    return [sample[int(step * i)] for i in range(1, shards)]
+
+
+def start(name, shards=1, batch_size=100):
+    """Create status entities for a new job and enqueue its first tasks."""
+    if name not in MAPPERS:
+        raise ValueError('Unknown mapper: %s' % name)
+    kind = MAPPERS[name][0]
+    job = '%s-%d' % (name, int(time.time()))
+    bounds = [None] + _splitPoints(kind, shards) + [None]
+
+    statuses = []
+    for shard in range(len(bounds) - 1):
+        statuses.append(MapperStatus(
+            id='%s:%d' % (job, shard), job=job, mapper=name, shard=shard,
+            startKey=bounds[shard], endKey=bounds[shard + 1],
+            batchSize=batch_size))
+    ndb.put_multi(statuses)
+    for status in statuses:
+        _enqueue(status)
+    return job
+
+
+def _enqueue(status):
+    # named after the slice so a checkpoint is only ever chained once
+    try:
+        taskqueue.add(
+            url=TASK_URL,
+            name='mapper-%s-%d' % (status.key.id().replace(':', '-'),
+                                   status.slice),
+            params={'status': status.key.id(),
+                    'cursor': status.cursor or ''})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def _query(kind, status):
+    """Key-ordered query over this shard's key range."""
+    q = ndb.Query(kind=kind)
+    if status.startKey:
+        q = q.filter(ndb.Model.key >= status.startKey)
+    if status.endKey:
+        q = q.filter(ndb.Model.key < status.endKey)
+    return q.order(ndb.Model.key)
+
+
+@ndb.transactional()
+def _checkpoint(status_id, expected, cursor, more, count):
+    """Advance the shard from expected to cursor; None if already moved."""
+    status = MapperStatus.get_by_id(status_id)
+    if status.done or (status.cursor or '') != expected:
+        return None
+    status.cursor = cursor
+    status.processed += count
+    status.done = not more
+    status.put()
+    return status
+
+
+@ndb.transactional()
+def _nextSlice(status_id, expected):
+    """Count a new slice from the expected checkpoint; None if the shard
+    has moved on."""
+    status = MapperStatus.get_by_id(status_id)
+    if status.done or (status.cursor or '') != expected:
+        return None
+    status.slice += 1
+    status.put()
+    return status
+
+
+@ndb.transactional()
+def _recordFailure(status_id):
+    status = MapperStatus.get_by_id(status_id)
+    status.failures += 1
+    status.put()
+
+
+def _applyBatch(func, batch, entities):
+    if batch:
+        func(entities)
+        return
+    to_put = []
+    for entity in entities:
+        result = func(entity)
+        if result is None:
+            continue
+        if isinstance(result, (list, tuple)):
+            to_put.extend(result)
+        else:
+            to_put.append(result)
+    if to_put:
+        keys = ndb.put_multi(to_put)
+        entitycache.invalidate(*keys)
+        etags.invalidate(*etags.tagsForKeys(keys))
+
+
+def run(status_id, expected):
+    """Process batches of one shard from the expected cursor until the
+    slice deadline, then chain the next slice."""
+    status = MapperStatus.get_by_id(status_id)
+    if not status or status.done or (status.cursor or '') != expected:
+        # duplicate or stale task; the shard has already moved on
+        return
+    kind, func, batch = MAPPERS[status.mapper]
+    query = _query(kind, status)
+    deadline = time.time() + SLICE_SECONDS
+
+    while time.time() < deadline:
+        start_cursor = Cursor(urlsafe=status.cursor) if status.cursor else None
+        entities, cursor, more = query.fetch_page(
+            status.batchSize, start_cursor=start_cursor)
+        try:
+            _applyBatch(func, batch, entities)
+        except Exception:
+            logging.exception('mapper %s failed at cursor %r',
+                              status_id, status.cursor)
+            _recordFailure(status_id)
+            # let the task queue retry this batch from the same cursor
+            raise
+        next_cursor = cursor.urlsafe() if (more and cursor) else ''
+        status = _checkpoint(status_id, status.cursor or '', next_cursor,
+                             bool(more and cursor), len(entities))
+        if status is None or status.done:
+            return
+
+    status = _nextSlice(status_id, status.cursor or '')
+    if status:
+        _enqueue(status)
+
+
+def progress():
+    """Return per-job progress and throughput for the admin handler."""
+    jobs = {}
+    for status in MapperStatus.query().order(-MapperStatus.started).fetch(200):
+        job = jobs.setdefault(status.job, {
+            'mapper': status.mapper, 'shards': 0, 'done_shards': 0,
+            'processed': 0, 'failures': 0,
+            'started': status.started, 'updated': status.updated})
+        job['shards'] += 1
+        job['done_shards'] += int(status.done)
+        job['processed'] += status.processed
+        job['failures'] += status.failures
+        job['started'] = min(job['started'], status.started)
+        job['updated'] = max(job['updated'], status.updated)
+
+    for job in jobs.values():
+        elapsed = (job['updated'] - job['started']).total_seconds()
+        job['per_second'] = round(job['processed'] / elapsed, 2) if elapsed else 0.0
+        job['started'] = job['started'].isoformat()
+        job['updated'] = job['updated'].isoformat()
+    return jobs
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+metrics.py -- time-bucketed registration and wishlist counters
+
+Registrations, cancellations and wishlist adds are counted per hour in
+sharded, root-level MetricShard entities.  The request path only queues
+a task (transactionally, so only committed registrations count); the
+task increments one shard, picked from the event's id, for the hour the
+event happened in, so neither the Conference entity group nor a single
+counter becomes a contention point.  The shard remembers the ids it
+counted, so a retried task counts its event once.  An event for an hour
+that has already been compacted is counted in the daily count instead.
+
+Reads aggregate a conference's shards into hourly or daily rollups that
+are cached in memcache for ROLLUP_TIME seconds.  A daily cron folds
+hourly shards older than COMPACT_AFTER_DAYS into one count per day, in
+tasks chained with a cursor; each daily count remembers which shards it
+folded, so compaction can be re-run safely and readers never count a
+shard twice.
+
+"""
+
+import itertools
+import random
+import time
+import uuid
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import MetricShard
+
+METRICS = ('registrations', 'cancellations', 'wishlist')
+RESOLUTIONS = ('hour', 'day')
+NUM_SHARDS = 10
+TASK_URL = '/tasks/record_metric'
+COMPACT_URL = '/tasks/compact_metrics'
+QUEUE_NAME = 'metrics'
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+ROLLUP_PREFIX = 'METRICS:'
+ROLLUP_TIME = 60
+COMPACT_AFTER_DAYS = 2
+MAX_DAYS = 31
+BATCH_SIZE = 200
+# compaction chains a follow-up task this long into a slice
+SLICE_SECONDS = 60
+
+
+def hourOf(dt):
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def dayOf(dt):
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _shardId(metric, conferenceKey, sessionKey, hour, n):
+    return '%s:%s:%s:%s:%d' % (metric, conferenceKey, sessionKey or '',
+                               hour.strftime('%Y%m%d%H'), n)
+
+
+def _dayId(metric, conferenceKey, sessionKey, day):
+    return '%s:%s:%s:%s:day' % (metric, conferenceKey, sessionKey or '',
+                                day.strftime('%Y%m%d'))
+
+
+def record(metric, conferenceKey, sessionKey=None):
+    """Queue one event; transactional when called in a transaction."""
+    taskqueue.add(url=TASK_URL, queue_name=QUEUE_NAME,
+                  transactional=ndb.in_transaction(), params={
+                      'metric': metric,
+                      'conferenceKey': conferenceKey,
+                      'sessionKey': sessionKey or '',
+                      'at': datetime.utcnow().strftime(TIME_FORMAT),
+                      'event': uuid.uuid4().hex})
+
+
+def increment(metric, conferenceKey, sessionKey, at, event=''):
+    """Add one event to a shard of its hour, or to its day's count if
+    that hour was already compacted; an event id already counted there
+    is skipped."""
+    hour = hourOf(datetime.strptime(at, TIME_FORMAT))
+    # a retry of the same event lands on the same shard
+    n = int(event[:8], 16) % NUM_SHARDS if event else random.randrange(NUM_SHARDS)
+    key = ndb.Key(MetricShard, _shardId(metric, conferenceKey, sessionKey, hour, n))
+    day_key = ndb.Key(MetricShard, _dayId(metric, conferenceKey, sessionKey,
+                                          dayOf(hour)))
+
+    @ndb.transactional(xg=True)
+    def txn():
+        shard, day = ndb.get_multi([key, day_key])
+        if day and key.id() in day.folded:
+            shard = day
+        elif not shard:
+            shard = MetricShard(
+                key=key, metric=metric, conferenceKey=conferenceKey,
+                sessionKey=sessionKey or None, resolution='hour', bucket=hour)
+        if event:
+            if event in shard.events:
+                return
+            shard.events.append(event)
+        shard.count += 1
+        shard.put()
+    txn()
+
+
+def rollup(conferenceKey, resolution, days):
+    """Return {'points': [(bucket, {metric: count})], 'sessions':
+    [(sessionKey, wishlist adds)]} for the last days days."""
+    cache_key = '%s%s:%s:%d' % (ROLLUP_PREFIX, conferenceKey, resolution, days)
+    cached = memcache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    since = dayOf(datetime.utcnow()) - timedelta(days=days - 1)
+    shards = MetricShard.query(MetricShard.conferenceKey == conferenceKey,
+                               MetricShard.bucket >= since).fetch()
+    # hourly shards already folded into a daily count, but not yet deleted
+    folded = set(itertools.chain.from_iterable(
+        s.folded for s in shards if s.resolution == 'day'))
+
+    points = {}
+    sessions = {}
+    for shard in shards:
+        if shard.key.id() in folded:
+            continue
+        bucket = shard.bucket if resolution == 'hour' else dayOf(shard.bucket)
+        counts = points.setdefault(bucket, dict.fromkeys(METRICS, 0))
+        counts[shard.metric] += shard.count
+        if shard.metric == 'wishlist' and shard.sessionKey:
+            sessions[shard.sessionKey] = sessions.get(shard.sessionKey, 0) + shard.count
+
+    result = {
+        'points': sorted(points.items()),
+        'sessions': sorted(sessions.items(), key=lambda item: (-item[1], item[0])),
+    }
+    memcache.set(cache_key, result, time=ROLLUP_TIME)
+    return result
+
+
+@ndb.transactional()
+def _fold(day_id, shards):
+    """Add hourly shards to their daily count, skipping any already in it."""
+    key = ndb.Key(MetricShard, day_id)
+    first = shards[0]
+    day = key.get() or MetricShard(
+        key=key, metric=first.metric, conferenceKey=first.conferenceKey,
+        sessionKey=first.sessionKey, resolution='day', bucket=dayOf(first.bucket))
+    done = set(day.folded)
+    for shard in shards:
+        if shard.key.id() not in done:
+            day.count += shard.count
+            day.folded.append(shard.key.id())
+    day.put()
+
+
+def compact(cursor='', cutoff=None):
+    """Fold hourly shards older than COMPACT_AFTER_DAYS into daily counts,
+    chaining a task with the cursor before the deadline; return the
+    number of hourly shards this slice folded."""
+    if cutoff is None:
+        cutoff = dayOf(datetime.utcnow()) - timedelta(days=COMPACT_AFTER_DAYS)
+    deadline = time.time() + SLICE_SECONDS
+    q = MetricShard.query(MetricShard.resolution == 'hour',
+                          MetricShard.bucket < cutoff)
+    folded = 0
+    start = Cursor(urlsafe=cursor) if cursor else None
+    while time.time() < deadline:
+        shards, start, more = q.fetch_page(BATCH_SIZE, start_cursor=start)
+        groups = {}
+        for shard in shards:
+            groups.setdefault(_dayId(shard.metric, shard.conferenceKey,
+                                     shard.sessionKey, dayOf(shard.bucket)),
+                              []).append(shard)
+        for day_id, group in groups.items():
+            _fold(day_id, group)
+        ndb.delete_multi([shard.key for shard in shards])
+        folded += len(shards)
+        if not more or not start:
+            return folded
+    taskqueue.add(url=COMPACT_URL, queue_name=QUEUE_NAME, params={
+        'cursor': start.urlsafe(), 'cutoff': cutoff.strftime(TIME_FORMAT)})
+    return folded
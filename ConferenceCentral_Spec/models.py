@@ -13,6 +13,9 @@ created/forked from conferences.py by wesc on 2014 may 24
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 import httplib
+import time
+from datetime import timedelta
+
 import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
@@ -24,13 +27,53 @@ class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
-class Profile(ndb.Model):
+class RateLimitExceededException(endpoints.ForbiddenException):
+    """RateLimitExceededException -- throttled call, sent as HTTP 403
+    'rateLimitExceeded' as Google APIs do (Endpoints v1 turns a 429 into
+    a 404)"""
+
+class VersionedModel(ndb.Model):
+    """VersionedModel -- bumps a version counter and timestamp on every put"""
+    updated = ndb.DateTimeProperty(auto_now=True)
+    version = ndb.IntegerProperty(default=0)
+
+    def _pre_put_hook(self):
+        self.version = (self.version or 0) + 1
+
+def nextChangeSeq(previous=None):
+    """Microseconds since the epoch, but always past previous, so an
+    entity's change sequence only grows."""
+    return max(int(time.time() * 1000000), (previous or 0) + 1)
+
+class SyncedModel(VersionedModel):
+    """SyncedModel -- VersionedModel that also stamps a change sequence,
+    the order getChangesSince reports changes in"""
+    changeSeq = ndb.IntegerProperty()
+
+    def _pre_put_hook(self):
+        super(SyncedModel, self)._pre_put_hook()
+        self.changeSeq = nextChangeSeq(self.changeSeq)
+
+class Tombstone(SyncedModel):
+    """Tombstone -- left by a deleted Conference, Session or WishList for
+    getChangesSince; the id is the deleted entity's websafe key"""
+    kind = ndb.StringProperty(indexed=False)
+    # userID for a WishList entry, None for catalogue entities
+    owner = ndb.StringProperty()
+
+class Profile(VersionedModel):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
 
+class EmailIndex(ndb.Model):
+    """EmailIndex -- stable user id for one normalized email (the key id),
+    used by getUserId's custom mode"""
+    userId = ndb.StringProperty(required=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
     displayName = messages.StringField(1)
@@ -46,12 +89,16 @@ class ProfileForm(messages.Message):
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
+    etag = messages.StringField(2)
+    # set, with no data, when If-None-Match matched etag
+    unchanged = messages.BooleanField(3)
 
 # This is part of the getConferenceSessionsByType
 class SessionByType(messages.Message):
     """StringMessage-- outbound (single) string message"""
     type = messages.StringField(1, required=True)
     websafeKey = messages.StringField(2, required=True)
+    fields = messages.StringField(3)
 
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
@@ -59,7 +106,21 @@ class BooleanMessage(messages.Message):
 
 #------------------------Session-Logic-------------------------
 
-class Session(ndb.Model):
+def sessionTimeBucket(startTime):
+    """Coarse part of day for a 0-24 startTime, used for facets & filters."""
+    if startTime is None:
+        return 'unscheduled'
+    if startTime < 12:
+        return 'morning'
+    if startTime < 17:
+        return 'afternoon'
+    return 'evening'
+
+def sessionAgendaSlot(date, startTime):
+    """Single sortable value ordering sessions by (date, startTime)."""
+    return (date.toordinal() if date else 0) * 100 + (startTime or 0)
+
+class Session(SyncedModel):
     """Session -- Session object"""
     name            = ndb.StringProperty(required=True)
     highlights      = ndb.StringProperty()
@@ -73,6 +134,8 @@ class Session(ndb.Model):
     # confWebSafeKey = ndb.StringProperty()
     websafeKey = ndb.StringProperty(required=True)
     organizerDisplayName = ndb.StringProperty()
+    timeBucket = ndb.ComputedProperty(lambda self: sessionTimeBucket(self.startTime))
+    agendaSlot = ndb.ComputedProperty(lambda self: sessionAgendaSlot(self.date, self.startTime))
 
 
 class SessionForm(messages.Message):
@@ -89,7 +152,7 @@ class SessionForm(messages.Message):
     organizerDisplayName = messages.StringField(10)
     # confWebSafeKey = messages.StringField(11)
 
-class WishList(ndb.Model):
+class WishList(SyncedModel):
     sessionKey = ndb.StringProperty(required=True)
     userID = ndb.StringProperty()
 
@@ -103,6 +166,57 @@ class WishListForm(messages.Message):
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    nextPageToken = messages.StringField(3)
+    missingKeys = messages.StringField(4, repeated=True)
+    partial = messages.BooleanField(5)
+    # set, with no items, when If-None-Match matched etag
+    unchanged = messages.BooleanField(6)
+
+class AgendaQueryForm(messages.Message):
+    """AgendaQueryForm -- inbound time-ordered session page request"""
+    websafeConferenceKey = messages.StringField(1, required=True)
+    fromDate = messages.StringField(2)
+    fromTime = messages.IntegerField(3, variant=messages.Variant.INT32)
+    pageSize = messages.IntegerField(4, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(5)
+    fields = messages.StringField(6)
+
+class KeysForm(messages.Message):
+    """KeysForm -- inbound websafe keys for a batch get"""
+    websafeKeys = messages.StringField(1, repeated=True)
+    fields = messages.StringField(2)
+
+class SessionFacetShard(ndb.Model):
+    """SessionFacetShard -- one shard of a conference's session facet counts"""
+    conferenceKey = ndb.KeyProperty(indexed=False)
+    byType = ndb.JsonProperty(default={})
+    bySpeaker = ndb.JsonProperty(default={})
+    byDay = ndb.JsonProperty(default={})
+    byTimeBucket = ndb.JsonProperty(default={})
+
+class FacetCount(messages.Message):
+    """FacetCount -- one facet value and the number of sessions with it"""
+    value = messages.StringField(1)
+    count = messages.IntegerField(2, variant=messages.Variant.INT32)
+
+class SessionFacetsForm(messages.Message):
+    """SessionFacetsForm -- outbound session facet counts for a conference"""
+    byType = messages.MessageField(FacetCount, 1, repeated=True)
+    bySpeaker = messages.MessageField(FacetCount, 2, repeated=True)
+    byDay = messages.MessageField(FacetCount, 3, repeated=True)
+    byTimeBucket = messages.MessageField(FacetCount, 4, repeated=True)
+
+class SessionFacetQueryForm(messages.Message):
+    """SessionFacetQueryForm -- inbound facet filters for one conference"""
+    websafeConferenceKey = messages.StringField(1, required=True)
+    typeOfSession = messages.StringField(2)
+    speaker = messages.StringField(3)
+    date = messages.StringField(4)
+    timeBucket = messages.StringField(5)
+    pageSize = messages.IntegerField(6, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(7)
+    fields = messages.StringField(8)
 
 class confWebSafeKey(messages.Message):
     """ConferenceQueryForm -- Conference query inbound form message"""
@@ -113,7 +227,37 @@ class confWebSafeKey(messages.Message):
 
 
 
-class Conference(ndb.Model):
+# a conference longer than this only gets buckets for its first part
+MAX_BUCKET_DAYS = 2 * 366
+
+def weekBuckets(start, end):
+    """ISO week buckets ('W2016-09') touched by the dates start..end."""
+    buckets = []
+    day = start - timedelta(days=start.weekday())
+    while day <= end:
+        year, week, _ = day.isocalendar()
+        buckets.append('W%04d-%02d' % (year, week))
+        day += timedelta(days=7)
+    return buckets
+
+def monthBuckets(start, end):
+    """Month buckets ('M2016-03') touched by the dates start..end."""
+    buckets = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        buckets.append('M%04d-%02d' % (year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return buckets
+
+def conferenceDateBuckets(startDate, endDate):
+    """Every week & month bucket a conference's dates fall in."""
+    if not startDate:
+        return []
+    end = max(endDate or startDate, startDate)
+    end = min(end, startDate + timedelta(days=MAX_BUCKET_DAYS))
+    return weekBuckets(startDate, end) + monthBuckets(startDate, end)
+
+class Conference(SyncedModel):
     """Conference -- Conference object"""
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
@@ -125,6 +269,11 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    # set by deleteConference while the cleanup task removes the subtree
+    deleted         = ndb.BooleanProperty(default=False)
+    # precomputed so date ranges become equality filters (queryConferences)
+    dateBuckets     = ndb.ComputedProperty(
+        lambda self: conferenceDateBuckets(self.startDate, self.endDate), repeated=True)
     # includeDrinks   = ndb.BooleanProperty()
 
 class ConferenceForm(messages.Message):
@@ -141,6 +290,9 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10) #DateTimeField()
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    etag            = messages.StringField(13)
+    # set, with no other fields, when If-None-Match matched etag
+    unchanged       = messages.BooleanField(14)
 
     # name            = messages.StringField(1)
     # description     = messages.StringField(2)
@@ -157,9 +309,29 @@ class ConferenceForm(messages.Message):
     # organizerDisplayName = messages.StringField(12)
     # # includeDrinks   = messages.BooleanProperty(13)
 
+class ChangeForm(messages.Message):
+    """ChangeForm -- one upsert or deletion in a getChangesSince page"""
+    kind = messages.StringField(1)
+    websafeKey = messages.StringField(2)
+    deleted = messages.BooleanField(3)
+    changeSeq = messages.IntegerField(4)
+    conference = messages.MessageField(ConferenceForm, 5)
+    session = messages.MessageField(SessionForm, 6)
+    wishlist = messages.MessageField(WishListForm, 7)
+
+class ChangesForm(messages.Message):
+    """ChangesForm -- changes since a sync token, oldest first"""
+    items = messages.MessageField(ChangeForm, 1, repeated=True)
+    syncToken = messages.StringField(2)
+    more = messages.BooleanField(3)
+    resync = messages.BooleanField(4)
+
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    missingKeys = messages.StringField(3, repeated=True)
+    partial = messages.BooleanField(4)
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -184,8 +356,112 @@ class ConferenceQueryForm(messages.Message):
     field = messages.StringField(1)
     operator = messages.StringField(2)
     value = messages.StringField(3)
+    # EQ only: match any of these values (OR); combined with value if set
+    values = messages.StringField(4, repeated=True)
 
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
-
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3)
+    # comma separated ConferenceForm field names to return
+    fields = messages.StringField(4)
+
+
+#------------------------Background-Jobs-------------------------
+
+class MapperStatus(ndb.Model):
+    """MapperStatus -- checkpoint for one shard of a batch mapper job"""
+    job = ndb.StringProperty(required=True)
+    mapper = ndb.StringProperty(required=True)
+    shard = ndb.IntegerProperty(default=0)
+    startKey = ndb.KeyProperty(indexed=False)
+    endKey = ndb.KeyProperty(indexed=False)
+    batchSize = ndb.IntegerProperty(default=100, indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    slice = ndb.IntegerProperty(default=0, indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    failures = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+class SessionRecommendation(ndb.Model):
+    """SessionRecommendation -- sessions most often wishlisted together with
+    the session whose websafe key is this entity's id, best first"""
+    sessionKeys = ndb.StringProperty(repeated=True, indexed=False)
+    scores = ndb.IntegerProperty(repeated=True, indexed=False)
+    # the rebuild that wrote the row; see recommendations.py
+    generation = ndb.IntegerProperty(indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class RecommendationStaging(ndb.Model):
+    """RecommendationStaging -- partial co-save counts of one session during
+    a recommendations rebuild, id 'generation:sessionKey'"""
+    generation = ndb.IntegerProperty()
+    sessionKey = ndb.StringProperty(indexed=False)
+    counts = ndb.JsonProperty(default={})
+    appliedSlice = ndb.IntegerProperty(default=0, indexed=False)
+
+class MetricShard(ndb.Model):
+    """MetricShard -- one shard of an event count in one hour, or the
+    compacted count for a whole day"""
+    metric = ndb.StringProperty()
+    conferenceKey = ndb.StringProperty()
+    sessionKey = ndb.StringProperty()
+    resolution = ndb.StringProperty()
+    bucket = ndb.DateTimeProperty()
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    # ids of the hourly shards folded into a daily count
+    folded = ndb.StringProperty(repeated=True, indexed=False)
+    # ids of the events counted into this shard directly, so a retried
+    # record task counts once
+    events = ndb.StringProperty(repeated=True, indexed=False)
+
+class MetricPoint(messages.Message):
+    """MetricPoint -- event counts for one hour or day"""
+    bucket = messages.StringField(1)
+    registrations = messages.IntegerField(2)
+    cancellations = messages.IntegerField(3)
+    wishlistAdds = messages.IntegerField(4)
+
+class SessionPopularity(messages.Message):
+    """SessionPopularity -- wishlist adds for one session"""
+    websafeKey = messages.StringField(1)
+    wishlistAdds = messages.IntegerField(2)
+
+class ConferenceMetricsForm(messages.Message):
+    """ConferenceMetricsForm -- outbound registration & wishlist metrics"""
+    websafeConferenceKey = messages.StringField(1)
+    resolution = messages.StringField(2)
+    points = messages.MessageField(MetricPoint, 3, repeated=True)
+    sessions = messages.MessageField(SessionPopularity, 4, repeated=True)
+
+class WishlistCountShard(ndb.Model):
+    """WishlistCountShard -- one shard of a session's wishlist count,
+    id 'sessionKey:n'; written by trending.flush"""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+class Leaderboard(ndb.Model):
+    """Leaderboard -- most wishlisted sessions, best first, of one
+    conference (id: its websafe key) or of all of them (id: 'global')"""
+    sessionKeys = ndb.StringProperty(repeated=True, indexed=False)
+    names = ndb.StringProperty(repeated=True, indexed=False)
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class TrendingSession(messages.Message):
+    """TrendingSession -- one leaderboard entry"""
+    websafeKey = messages.StringField(1)
+    name = messages.StringField(2)
+    wishlistCount = messages.IntegerField(3)
+
+class TrendingSessionsForm(messages.Message):
+    """TrendingSessionsForm -- outbound most wishlisted sessions"""
+    items = messages.MessageField(TrendingSession, 1, repeated=True)
+
+class IdempotencyRecord(ndb.Model):
+    """IdempotencyRecord -- recorded response for a client idempotency key"""
+    responseType = ndb.StringProperty(indexed=False)
+    response = ndb.TextProperty()
+    expires = ndb.DateTimeProperty()
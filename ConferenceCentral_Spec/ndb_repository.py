@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+"""
+ndb_repository.py -- benchmark storage engine on the App Engine datastore
+
+Mirrors the entity layout ConferenceApi uses: Conferences are children of
+their organizer's Profile, Sessions children of their Conference and
+WishList items children of their Session.
+
+"""
+
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import Profile
+from models import Session
+from models import WishList
+from models import TeeShirtSize
+
+from repository import ConflictError
+from repository import ForbiddenError
+from repository import NotFoundError
+import changes
+
+
+def _record(entity):
+    if entity is None:
+        return None
+    record = entity.to_dict()
+    record['key'] = entity.key.urlsafe()
+    return record
+
+
+class NdbRepository(object):
+    """Benchmark engine backed by ndb; see repository.py."""
+
+    # - - - Profiles - - - - - - - - - - - - - - - - - - - - - -
+
+    def getProfile(self, user_id):
+        return _record(ndb.Key(Profile, user_id).get())
+
+    def getOrCreateProfile(self, user_id, displayName, mainEmail):
+        p_key = ndb.Key(Profile, user_id)
+        profile = p_key.get()
+        if not profile:
+            profile = Profile(key=p_key, displayName=displayName,
+                              mainEmail=mainEmail,
+                              teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED))
+            profile.put()
+        return _record(profile)
+
+    def saveProfile(self, user_id, fields):
+        profile = ndb.Key(Profile, user_id).get()
+        if not profile:
+            raise NotFoundError('No profile for user: %s' % user_id)
+        profile.populate(**fields)
+        profile.put()
+        return _record(profile)
+
+    # - - - Conferences - - - - - - - - - - - - - - - - - - - - -
+
+    def createConference(self, user_id, data):
+        p_key = ndb.Key(Profile, user_id)
+        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
+        conf = Conference(key=ndb.Key(Conference, c_id, parent=p_key),
+                          organizerUserId=user_id, **data)
+        conf.put()
+        return conf.key.urlsafe()
+
+    def getConference(self, websafeKey):
+        return self.getConferences([websafeKey])[0]
+
+    def getConferences(self, websafeKeys):
+        return [_record(c) if c and not c.deleted else None for c in
+                ndb.get_multi([ndb.Key(urlsafe=k) for k in websafeKeys])]
+
+    @ndb.transactional()
+    def updateConference(self, websafeKey, user_id, fields):
+        conf = ndb.Key(urlsafe=websafeKey).get()
+        if not conf or conf.deleted:
+            raise NotFoundError('No conference found with key: %s' % websafeKey)
+        if conf.organizerUserId != user_id:
+            raise ForbiddenError('Only the owner can update the conference.')
+        conf.populate(**fields)
+        conf.put()
+        return _record(conf)
+
+    @ndb.transactional()
+    def deleteConference(self, websafeKey, user_id):
+        conf = ndb.Key(urlsafe=websafeKey).get()
+        if not conf:
+            raise NotFoundError('No conference found with key: %s' % websafeKey)
+        if conf.organizerUserId != user_id:
+            raise ForbiddenError('Only the owner can delete the conference.')
+        if conf.deleted:
+            return False
+        conf.deleted = True
+        conf.put()
+        return True
+
+    def conferencesByOrganizer(self, user_id):
+        return [_record(c) for c in
+                Conference.query(ancestor=ndb.Key(Profile, user_id))
+                if not c.deleted]
+
+    # - - - Sessions - - - - - - - - - - - - - - - - - - - - - - -
+
+    def createSession(self, conferenceKey, user_id, data):
+        return self.createSessions(conferenceKey, user_id, [data])[0]
+
+    def createSessions(self, conferenceKey, user_id, datas):
+        c_key = ndb.Key(urlsafe=conferenceKey)
+        first, last = Session.allocate_ids(size=len(datas), parent=c_key)
+        sessions = []
+        for s_id, data in zip(range(first, last + 1), datas):
+            data = dict(data, websafeKey=conferenceKey, organizerUserId=user_id)
+            sessions.append(Session(key=ndb.Key(Session, s_id, parent=c_key), **data))
+
+        @ndb.transactional()
+        def txn():
+            conf = c_key.get()
+            if not conf or conf.deleted:
+                raise NotFoundError('No conference found with key: %s' % conferenceKey)
+            return ndb.put_multi(sessions)
+        return [k.urlsafe() for k in txn()]
+
+    def getSessions(self, websafeKeys):
+        return [_record(s) for s in
+                ndb.get_multi([ndb.Key(urlsafe=k) for k in websafeKeys])]
+
+    def sessionsForConference(self, conferenceKey, typeOfSession=None):
+        q = Session.query(ancestor=ndb.Key(urlsafe=conferenceKey))
+        if typeOfSession is not None:
+            q = q.filter(Session.typeOfSession == typeOfSession)
+        return [_record(s) for s in q]
+
+    def sessionsBySpeaker(self, speaker):
+        return [_record(s) for s in Session.query(Session.speaker == speaker)]
+
+    # - - - Wishlists - - - - - - - - - - - - - - - - - - - - - -
+
+    @ndb.transactional()
+    def addToWishlist(self, user_id, sessionKey):
+        s_key = ndb.Key(urlsafe=sessionKey)
+        sess, conf = ndb.get_multi([s_key, s_key.parent()])
+        if not sess or not conf or conf.deleted:
+            raise NotFoundError('No session found with key: %s' % sessionKey)
+        if WishList.query(WishList.userID == user_id,
+                          ancestor=s_key).get(keys_only=True):
+            return False
+        WishList(id=user_id, parent=s_key,
+                 sessionKey=sessionKey, userID=user_id).put()
+        return True
+
+    def wishlistSessions(self, user_id):
+        keys = [ndb.Key(urlsafe=w.sessionKey) for w in
+                WishList.query(WishList.userID == user_id)]
+        return [_record(s) for s in ndb.get_multi(keys) if s]
+
+    def removeFromWishlist(self, user_id, sessionKey):
+        for key in WishList.query(
+                WishList.sessionKey == sessionKey,
+                WishList.userID == user_id).fetch(keys_only=True):
+            changes.delete(key, user_id)
+
+    # - - - Registration - - - - - - - - - - - - - - - - - - - - -
+
+    @ndb.transactional(xg=True)
+    def register(self, user_id, conferenceKey, reg=True):
+        prof = ndb.Key(Profile, user_id).get()
+        conf = ndb.Key(urlsafe=conferenceKey).get()
+        if not prof or not conf or conf.deleted:
+            raise NotFoundError('No conference found with key: %s' % conferenceKey)
+        if reg:
+            if conferenceKey in prof.conferenceKeysToAttend:
+                raise ConflictError('You have already registered for this conference')
+            if conf.seatsAvailable <= 0:
+                raise ConflictError('There are no seats available.')
+            prof.conferenceKeysToAttend.append(conferenceKey)
+            conf.seatsAvailable -= 1
+        elif conferenceKey in prof.conferenceKeysToAttend:
+            prof.conferenceKeysToAttend.remove(conferenceKey)
+            conf.seatsAvailable += 1
+        else:
+            return False
+        ndb.put_multi([prof, conf])
+        return True
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+profiling.py -- opt-in sampling cProfile captures for slow requests
+
+Wrap a WSGI app with profiling.middleware(app).  When SAMPLE_RATE is 0
+(the default) the app is returned unwrapped, so there is no overhead at
+all.  Otherwise a SAMPLE_RATE fraction of requests run under cProfile
+with an RPC timeline recorded through apiproxy hooks; requests slower
+than THRESHOLD_MS keep their capture (top functions by cumulative time
+plus the RPC timeline) in memcache, newest MAX_CAPTURES only.
+
+Enable with the PROFILE_SAMPLE_RATE / PROFILE_THRESHOLD_MS env_variables
+in app.yaml and read the captures at /admin/profiles.
+
+"""
+
+import cProfile
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from StringIO import StringIO
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+THRESHOLD_MS = int(os.environ.get('PROFILE_THRESHOLD_MS', 1000))
+MAX_CAPTURES = 50
+TOP_FUNCTIONS = 40
+CAPTURE_TIME = 24 * 60 * 60
+INDEX_KEY = 'PROFILE_INDEX'
+CAPTURE_PREFIX = 'PROFILE:'
+
+_active = threading.local()
+_hooks_installed = []
+
+
+def _preCall(service, call, request, response, rpc=None):
+    timeline = getattr(_active, 'timeline', None)
+    if timeline is not None:
+        timeline.append(['%s.%s' % (service, call), time.time(), None])
+
+
+def _postCall(service, call, request, response, rpc=None, error=None):
+    timeline = getattr(_active, 'timeline', None)
+    if timeline is None:
+        return
+    name = '%s.%s' % (service, call)
+    # close the most recent open entry for this call
+    for entry in reversed(timeline):
+        if entry[0] == name and entry[2] is None:
+            entry[2] = time.time()
+            break
+
+
+def _installHooks():
+    if _hooks_installed:
+        return
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'profiling_pre', _preCall)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'profiling_post', _postCall)
+    _hooks_installed.append(True)
+
+
+def _store(capture):
+    """Save a capture and push its id onto the bounded index."""
+    capture_id = uuid.uuid4().hex
+    memcache.set(CAPTURE_PREFIX + capture_id, capture, time=CAPTURE_TIME)
+    client = memcache.Client()
+    for _ in range(3):
+        index = client.gets(INDEX_KEY)
+        if index is None:
+            if client.add(INDEX_KEY, [capture_id], time=CAPTURE_TIME):
+                return
+            continue
+        index = ([capture_id] + index)[:MAX_CAPTURES]
+        if client.cas(INDEX_KEY, index, time=CAPTURE_TIME):
+            return
+
+
+def _capture(environ, profiler, started, elapsed_ms, timeline):
+    out = StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats(
+        'cumulative').print_stats(TOP_FUNCTIONS)
+    return {
+        'path': environ.get('PATH_INFO'),
+        'method': environ.get('REQUEST_METHOD'),
+        'started': started,
+        'elapsed_ms': elapsed_ms,
+        'stats': out.getvalue(),
+        'rpcs': [{'call': name,
+                  'start_ms': int((start - started) * 1000),
+                  'duration_ms': int(((end or start) - start) * 1000)}
+                 for name, start, end in timeline],
+    }
+
+
+def middleware(app):
+    """Return app wrapped with sampling profiling, or app itself if off."""
+    if not SAMPLE_RATE:
+        return app
+    _installHooks()
+
+    def profiled_app(environ, start_response):
+        if random.random() >= SAMPLE_RATE:
+            return app(environ, start_response)
+        profiler = cProfile.Profile()
+        _active.timeline = timeline = []
+        started = time.time()
+        def run():
+            # materialize the body here, so producing a streamed or lazy
+            # response is inside the profile too
+            body = app(environ, start_response)
+            try:
+                return list(body)
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+
+        try:
+            return profiler.runcall(run)
+        finally:
+            _active.timeline = None
+            elapsed_ms = int((time.time() - started) * 1000)
+            if elapsed_ms >= THRESHOLD_MS:
+                try:
+                    _store(_capture(environ, profiler, started,
+                                    elapsed_ms, timeline))
+                except Exception:
+                    logging.exception('could not store profile capture')
+    return profiled_app
+
+
+def captures():
+    """Return stored capture summaries, newest first."""
+    index = memcache.get(INDEX_KEY) or []
+    found = memcache.get_multi(index, key_prefix=CAPTURE_PREFIX)
+    return [dict(id=i, path=found[i]['path'],
+                 elapsed_ms=found[i]['elapsed_ms'],
+                 started=found[i]['started'])
+            for i in index if i in found]
+
+
+def capture(capture_id):
+    """Return one full capture, or None if it has expired."""
+    return memcache.get(CAPTURE_PREFIX + capture_id)
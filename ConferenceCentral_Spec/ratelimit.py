@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""
+ratelimit.py -- per-user, per-endpoint token buckets for ConferenceApi
+
+Every decorated method draws its cost from a token bucket stored in
+memcache under (user, method); anonymous calls are keyed by the
+client's address.  Each instance also remembers the last
+bucket state it saw; since other instances can only drain a bucket, a
+local estimate that is already short means the request can be rejected
+without a memcache round trip.  Rejection happens before the wrapped
+method runs, so an over-budget client causes no datastore work.
+
+On top of the per-user buckets, each instance sheds load: at most
+MAX_EXPENSIVE_CALLS calls to methods costing SHED_COST or more run at
+once, and further ones are rejected straight away instead of queueing
+behind them.
+
+Rejections are sent as HTTP 403 with a 'rateLimitExceeded' message;
+Endpoints v1 can't send a 429.
+
+"""
+
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+import endpoints
+from google.appengine.api import memcache
+
+from models import RateLimitExceededException
+
+# tokens a bucket holds when full, and tokens regained per second
+BUCKET_CAPACITY = 60
+REFILL_PER_SECOND = 1.0
+
+# tokens drawn per call; unlisted methods cost DEFAULT_COST.  Global,
+# unbounded scans are weighted by how much datastore work they do.
+DEFAULT_COST = 1
+METHOD_COSTS = {
+    'getAllMorningSessions': 10,
+    'getAllAfternoonSessions': 10,
+    'getNoneWorkshopsBefore7': 10,
+    'getSessionsSpeaker': 10,
+    'queryConferences': 5,
+    'filterPlayground': 5,
+    'getSessionsInWishlist': 3,
+    'getSessionRecommendations': 3,
+    'getConferenceSessions': 2,
+    'getConferenceSessionsByType': 2,
+    'getConferenceSessionsByFacet': 2,
+    'getConferencesCreated': 2,
+    'getConferencesToAttend': 2,
+    'getConferencesByKeys': 3,
+    'getSessionsByKeys': 3,
+    'getChangesSince': 2,
+}
+
+# methods at least this costly take a load-shedding slot
+SHED_COST = 5
+MAX_EXPENSIVE_CALLS = 4
+
+MEMCACHE_PREFIX = 'RATELIMIT:'
+CAS_RETRIES = 3
+# most bucket estimates kept per instance, least recently seen dropped
+LOCAL_CACHE_SIZE = 10000
+
+_lock = threading.Lock()
+_local = OrderedDict()
+_expensive = threading.BoundedSemaphore(MAX_EXPENSIVE_CALLS)
+
+
+def _refill(tokens, stamp, now):
+    return min(BUCKET_CAPACITY, tokens + (now - stamp) * REFILL_PER_SECOND)
+
+
+def _remember(key, tokens, now):
+    with _lock:
+        _local.pop(key, None)
+        _local[key] = (tokens, now)
+        while len(_local) > LOCAL_CACHE_SIZE:
+            _local.popitem(last=False)
+
+
+def _locallyShort(key, cost, now):
+    with _lock:
+        state = _local.get(key)
+    return state is not None and _refill(state[0], state[1], now) < cost
+
+
+def consume(caller, method, cost):
+    """Draw cost tokens from caller's bucket for method; False if short."""
+    key = '%s%s:%s' % (MEMCACHE_PREFIX, caller, method)
+    now = time.time()
+    if _locallyShort(key, cost, now):
+        return False
+
+    ttl = int(BUCKET_CAPACITY / REFILL_PER_SECOND) + 1
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        state = client.gets(key)
+        if state is None:
+            tokens = BUCKET_CAPACITY - cost
+            if client.add(key, (tokens, now), time=ttl):
+                _remember(key, tokens, now)
+                return True
+            continue
+        tokens = _refill(state[0], state[1], now)
+        if tokens < cost:
+            _remember(key, tokens, now)
+            return False
+        if client.cas(key, (tokens - cost, now), time=ttl):
+            _remember(key, tokens - cost, now)
+            return True
+        now = time.time()
+    # heavy contention on one bucket; let the call through rather than
+    # turning a memcache race into an error
+    return True
+
+
+def _clientAddress(request_state):
+    """The address an anonymous call came from.  Under Endpoints the
+    connection is from the API proxy, so prefer the client address it
+    forwards in X-Forwarded-For."""
+    headers = getattr(request_state, 'headers', None)
+    forwarded = headers and headers.get('X-Forwarded-For')
+    if forwarded:
+        return forwarded.split(',')[0].strip()
+    return getattr(request_state, 'remote_address', None)
+
+
+def _caller(service):
+    user = endpoints.get_current_user()
+    if user:
+        return user.email()
+    # a forged X-Forwarded-For only buys a fresh bucket; expensive calls
+    # are still capped per instance by load shedding
+    return 'ip:%s' % (_clientAddress(service.request_state) or 'anonymous')
+
+
+def limited(func):
+    """Reject calls to an API method once the caller is over budget, or
+    the instance is already busy with expensive calls.
+
+    Apply below @endpoints.method so the check runs before the method body.
+    """
+    cost = METHOD_COSTS.get(func.__name__, DEFAULT_COST)
+
+    @functools.wraps(func)
+    def wrapper(self, request):
+        if not consume(_caller(self), func.__name__, cost):
+            raise RateLimitExceededException(
+                'rateLimitExceeded: %s; retry later.' % func.__name__)
+        if cost < SHED_COST:
+            return func(self, request)
+        if not _expensive.acquire(False):
+            raise RateLimitExceededException(
+                'rateLimitExceeded: server busy with %s; retry later.' % func.__name__)
+        try:
+            return func(self, request)
+        finally:
+            _expensive.release()
+    return wrapper
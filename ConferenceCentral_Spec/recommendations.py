@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+"""
+recommendations.py -- "people who saved this also saved" for sessions
+
+A cron job rebuilds, from the whole WishList table, the TOP_K sessions
+most often wishlisted by the same users as each session, and stores them
+in one small SessionRecommendation entity per session (fronted by
+memcache).  Recommendations for a whole wishlist are then one batched
+lookup plus an in-memory merge.
+
+The rebuild is a chain of tasks, like deletion.py, so neither its time
+nor its memory grows with the table:
+
+    1. 'users'    users (a distinct projection on WishList.userID) are
+                  read USERS_PER_SLICE at a time; each slice adds its
+                  users' pairs to per-session RecommendationStaging rows
+                  of this rebuild's generation.  Rows remember the last
+                  slice they took, so a retried task adds nothing twice,
+                  and keep only their STAGING_K largest counts.
+    2. 'publish'  each staging row becomes the session's
+                  SessionRecommendation, and is deleted
+    3. 'prune'    rows from older generations are deleted
+
+Generations are start times in milliseconds.
+
+Between rebuilds, each new wishlist entry is folded in by a task that
+bumps the affected rows.  Removals, and any double counting from a
+retried task, are corrected by the next rebuild.
+
+"""
+
+import heapq
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import RecommendationStaging
+from models import SessionRecommendation
+from models import WishList
+
+TASK_URL = '/tasks/update_recommendations'
+REBUILD_URL = '/tasks/build_recommendations'
+TOP_K = 20
+# staging rows keep this many partial counts, bounding their size; a
+# pair that only becomes frequent late in a rebuild can be missed
+STAGING_K = 10 * TOP_K
+USERS_PER_SLICE = 50
+SLICE_SECONDS = 60
+# larger wishlists only contribute this many sessions, bounding the
+# pairs a single user adds to O(MAX_WISHLIST ** 2)
+MAX_WISHLIST = 100
+BATCH_SIZE = 500
+MEMCACHE_PREFIX = 'RECS:'
+MEMCACHE_TIME = 6 * 60 * 60
+
+
+def _top(row):
+    """Return the TOP_K (sessionKey, score) pairs of a co-occurrence row."""
+    return heapq.nlargest(TOP_K, row.items(),
+                          key=lambda item: (item[1], item[0]))
+
+
+def _store(rec, row):
+    pairs = _top(row)
+    rec.sessionKeys = [k for k, _ in pairs]
+    rec.scores = [n for _, n in pairs]
+    return rec
+
+
+def _pairs(rec):
+    return list(zip(rec.sessionKeys, rec.scores)) if rec else []
+
+
+def _now():
+    return int(time.time() * 1000)
+
+
+def startRebuild():
+    """Start a chained rebuild of every session's recommendations."""
+    _enqueueRebuild(_now(), 'users')
+
+
+def _enqueueRebuild(generation, phase, cursor='', slice_no=0):
+    taskqueue.add(url=REBUILD_URL, params={
+        'generation': generation, 'phase': phase, 'cursor': cursor,
+        'slice': slice_no})
+
+
+def _countUsers(generation, slice_no, user_ids):
+    """Add the pairs saved by user_ids to the staging rows, unless this
+    slice already did."""
+    futures = [WishList.query(WishList.userID == u).fetch_async()
+               for u in user_ids]
+    counts = {}
+    for future in futures:
+        saved = sorted(set(w.sessionKey for w in future.get_result()))[:MAX_WISHLIST]
+        for a in saved:
+            row = counts.setdefault(a, {})
+            for b in saved:
+                if a != b:
+                    row[b] = row.get(b, 0) + 1
+
+    sessionKeys = sorted(counts)
+    keys = [ndb.Key(RecommendationStaging, '%d:%s' % (generation, a))
+            for a in sessionKeys]
+    changed = []
+    for a, key, staging in zip(sessionKeys, keys, ndb.get_multi(keys)):
+        staging = staging or RecommendationStaging(
+            key=key, generation=generation, sessionKey=a)
+        if staging.appliedSlice >= slice_no:
+            continue
+        row = dict(staging.counts)
+        for b, n in counts[a].items():
+            row[b] = row.get(b, 0) + n
+        staging.counts = dict(heapq.nlargest(STAGING_K, row.items(),
+                                             key=lambda item: (item[1], item[0])))
+        staging.appliedSlice = slice_no
+        changed.append(staging)
+    ndb.put_multi(changed)
+
+
+def _countPhase(generation, cursor, slice_no, deadline):
+    """Count users' pairs; return (resume cursor or None, last slice)."""
+    q = WishList.query(projection=[WishList.userID], distinct=True)
+    start = Cursor(urlsafe=cursor) if cursor else None
+    while time.time() < deadline:
+        slice_no += 1
+        users, start, more = q.fetch_page(USERS_PER_SLICE, start_cursor=start)
+        _countUsers(generation, slice_no, [w.userID for w in users])
+        if not more or not start:
+            return None, slice_no
+    return start.urlsafe(), slice_no
+
+
+def _publishPhase(generation, cursor, deadline):
+    """Turn staging rows into recommendations; return the resume cursor,
+    or None when done."""
+    q = RecommendationStaging.query(RecommendationStaging.generation == generation)
+    start = Cursor(urlsafe=cursor) if cursor else None
+    while time.time() < deadline:
+        rows, start, more = q.fetch_page(BATCH_SIZE, start_cursor=start)
+        recs = [_store(SessionRecommendation(id=row.sessionKey, generation=generation),
+                       row.counts) for row in rows]
+        ndb.put_multi(recs)
+        memcache.set_multi(dict((rec.key.id(), _pairs(rec)) for rec in recs),
+                           key_prefix=MEMCACHE_PREFIX, time=MEMCACHE_TIME)
+        ndb.delete_multi([row.key for row in rows])
+        if not more or not start:
+            return None
+    return start.urlsafe()
+
+
+def _prunePhase(generation, cursor, deadline):
+    """Delete recommendations and staging rows older than generation;
+    return the resume cursor, or None when done."""
+    q = SessionRecommendation.query()
+    start = Cursor(urlsafe=cursor) if cursor else None
+    while time.time() < deadline:
+        recs, start, more = q.fetch_page(BATCH_SIZE, start_cursor=start)
+        stale = [rec.key for rec in recs
+                 if rec.generation is None or rec.generation < generation]
+        ndb.delete_multi(stale)
+        memcache.delete_multi([k.id() for k in stale], key_prefix=MEMCACHE_PREFIX)
+        if not more or not start:
+            break
+    else:
+        return start.urlsafe()
+
+    # staging left behind by an abandoned rebuild
+    old = RecommendationStaging.query(RecommendationStaging.generation < generation)
+    while time.time() < deadline:
+        keys = old.fetch(BATCH_SIZE, keys_only=True)
+        if not keys:
+            return None
+        ndb.delete_multi(keys)
+    return None
+
+
+def runRebuild(generation, phase, cursor='', slice_no=0):
+    """Run one slice of a rebuild and chain the next one if needed."""
+    deadline = time.time() + SLICE_SECONDS
+
+    if phase == 'users':
+        cursor, slice_no = _countPhase(generation, cursor, slice_no, deadline)
+        if cursor:
+            return _enqueueRebuild(generation, 'users', cursor, slice_no)
+        phase, cursor = 'publish', ''
+
+    if phase == 'publish':
+        cursor = _publishPhase(generation, cursor, deadline)
+        if cursor:
+            return _enqueueRebuild(generation, 'publish', cursor)
+        phase, cursor = 'prune', ''
+
+    if phase == 'prune':
+        cursor = _prunePhase(generation, cursor, deadline)
+        if cursor:
+            return _enqueueRebuild(generation, 'prune', cursor)
+
+
+def lookup(websafeKeys):
+    """Return {websafeKey: [(sessionKey, score), ...]} with one memcache
+    get_multi and at most one datastore get_multi."""
+    found = memcache.get_multi(websafeKeys, key_prefix=MEMCACHE_PREFIX)
+    missing = [k for k in websafeKeys if k not in found]
+    if missing:
+        fetched = dict((k, _pairs(rec)) for k, rec in zip(missing, ndb.get_multi(
+            [ndb.Key(SessionRecommendation, k) for k in missing])))
+        memcache.add_multi(fetched, key_prefix=MEMCACHE_PREFIX,
+                           time=MEMCACHE_TIME)
+        found.update(fetched)
+    return found
+
+
+def recommend(websafeKeys, limit=TOP_K):
+    """Return websafe keys of sessions co-saved with websafeKeys, best
+    first, excluding the sessions already in websafeKeys."""
+    saved = set(websafeKeys)
+    scores = {}
+    for pairs in lookup(list(saved)).values():
+        for key, n in pairs:
+            if key not in saved:
+                scores[key] = scores.get(key, 0) + n
+    return [k for k, _ in heapq.nlargest(limit, scores.items(),
+                                         key=lambda item: (item[1], item[0]))]
+
+
+def enqueue(sessionKey, user_id):
+    """Queue the incremental update for a new wishlist entry."""
+    taskqueue.add(url=TASK_URL, params={
+        'sessionKey': sessionKey, 'userID': user_id})
+
+
+@ndb.transactional()
+def _bump(websafeKey, others):
+    key = ndb.Key(SessionRecommendation, websafeKey)
+    # generations are start times, so a rebuild already under way won't
+    # prune a row created after it started
+    rec = key.get() or SessionRecommendation(key=key, generation=_now())
+    row = dict(_pairs(rec))
+    for other in others:
+        row[other] = row.get(other, 0) + 1
+    _store(rec, row).put()
+
+
+def update(sessionKey, user_id):
+    """Fold one new wishlist entry into the affected recommendation rows."""
+    saved = [w.sessionKey for w in WishList.query(WishList.userID == user_id)]
+    # a repeat save of the same session adds no new pairs
+    if saved.count(sessionKey) > 1:
+        return
+    others = sorted(set(saved) - set([sessionKey]))[:MAX_WISHLIST]
+    if not others:
+        return
+    _bump(sessionKey, others)
+    for other in others:
+        _bump(other, [sessionKey])
+    memcache.delete_multi([sessionKey] + others, key_prefix=MEMCACHE_PREFIX)
+
+
+def forget(sessionKeys):
+    """Drop the recommendation rows of deleted sessions.  Other rows that
+    list them are corrected by the next rebuild."""
+    if sessionKeys:
+        ndb.delete_multi([ndb.Key(SessionRecommendation, k) for k in sessionKeys])
+        memcache.delete_multi(sessionKeys, key_prefix=MEMCACHE_PREFIX)
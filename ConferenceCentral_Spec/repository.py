@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+"""
+repository.py -- storage engines compared by benchmark_storage.py
+
+Two engines run the same Conference, Session, Profile and WishList
+operations, so their cost can be compared on one workload:
+
+    NdbRepository     (ndb_repository.py)    the App Engine datastore
+    SqliteRepository  (sqlite_repository.py) SQLite, runs anywhere
+
+They are a benchmark harness only.  ConferenceApi talks to ndb directly
+and does the cache, etag and facet bookkeeping these engines skip, so
+neither is a drop-in store for the API.
+
+Both offer getProfile, getOrCreateProfile, saveProfile, createConference,
+getConference, getConferences, updateConference, deleteConference,
+conferencesByOrganizer, createSession, createSessions, getSessions,
+sessionsForConference, sessionsBySpeaker, addToWishlist,
+wishlistSessions, removeFromWishlist and register.  Records are dicts
+keyed by the model property names, plus 'key' holding the record's own
+websafe key string.
+
+Both follow the API's rules, so the workload does the same work on each:
+
+    - deleteConference only flags the conference, as the API does before
+      its cleanup task runs; a deleted conference reads as missing
+      (None, NotFoundError) everywhere except session reads, and takes
+      no new sessions, registrations or wishlist items
+    - a user has at most one wishlist item per session; addToWishlist
+      returns False for a repeat, and needs the session to exist
+    - removeFromWishlist only removes the calling user's item
+
+"""
+
+
+class NotFoundError(Exception):
+    """Raised when a key does not resolve to a stored record."""
+
+
+class ConflictError(Exception):
+    """Raised when a write conflicts with existing state."""
+
+
+class ForbiddenError(Exception):
+    """Raised when a user may not modify a record."""
+
+
+def get(name, **kwargs):
+    """Return the named engine."""
+    if name == 'ndb':
+        from ndb_repository import NdbRepository
+        return NdbRepository(**kwargs)
+    if name == 'sqlite':
+        from sqlite_repository import SqliteRepository
+        return SqliteRepository(**kwargs)
+    raise ValueError('Unknown storage backend: %s' % name)
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+
+"""
+sqlite_repository.py -- benchmark storage engine on SQLite
+
+Runs benchmark_storage.py's workload off App Engine, on any machine with
+the standard library.
+
+Keys are '<table>:<id>' strings.  Each query the workload issues has a
+matching index, multi-gets are single IN (...) statements, batch inserts
+use executemany, and registration runs in a BEGIN IMMEDIATE transaction.
+Connections come from a small pool; the database runs in WAL mode so
+readers do not block the writer.
+
+"""
+
+import datetime
+import json
+import sqlite3
+from contextlib import contextmanager
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from repository import ConflictError
+from repository import ForbiddenError
+from repository import NotFoundError
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS profile (
+    user_id TEXT PRIMARY KEY,
+    displayName TEXT,
+    mainEmail TEXT,
+    teeShirtSize TEXT NOT NULL DEFAULT 'NOT_SPECIFIED'
+);
+CREATE TABLE IF NOT EXISTS conference (
+    id INTEGER PRIMARY KEY,
+    organizerUserId TEXT NOT NULL,
+    name TEXT NOT NULL,
+    description TEXT,
+    topics TEXT NOT NULL DEFAULT '[]',
+    city TEXT,
+    startDate TEXT,
+    month INTEGER,
+    endDate TEXT,
+    maxAttendees INTEGER,
+    seatsAvailable INTEGER,
+    deleted INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS conference_organizer ON conference (organizerUserId);
+CREATE TABLE IF NOT EXISTS session (
+    id INTEGER PRIMARY KEY,
+    conference_id INTEGER NOT NULL REFERENCES conference (id),
+    name TEXT NOT NULL,
+    highlights TEXT,
+    speaker TEXT NOT NULL,
+    duration INTEGER,
+    typeOfSession TEXT,
+    date TEXT,
+    startTime INTEGER NOT NULL,
+    organizerUserId TEXT,
+    websafeKey TEXT NOT NULL,
+    organizerDisplayName TEXT
+);
+CREATE INDEX IF NOT EXISTS session_conference_type ON session (conference_id, typeOfSession);
+CREATE INDEX IF NOT EXISTS session_speaker ON session (speaker);
+CREATE TABLE IF NOT EXISTS wishlist (
+    user_id TEXT NOT NULL,
+    session_id INTEGER NOT NULL REFERENCES session (id),
+    PRIMARY KEY (user_id, session_id)
+);
+CREATE TABLE IF NOT EXISTS registration (
+    user_id TEXT NOT NULL,
+    conference_id INTEGER NOT NULL REFERENCES conference (id),
+    PRIMARY KEY (user_id, conference_id)
+);
+"""
+
+CONFERENCE_FIELDS = ('name', 'description', 'topics', 'city', 'startDate',
+                     'month', 'endDate', 'maxAttendees', 'seatsAvailable')
+SESSION_FIELDS = ('name', 'highlights', 'speaker', 'duration',
+                  'typeOfSession', 'date', 'startTime',
+                  'organizerDisplayName')
+PROFILE_FIELDS = ('displayName', 'mainEmail', 'teeShirtSize')
+DATE_FIELDS = ('startDate', 'endDate', 'date')
+
+
+def _key(table, row_id):
+    return '%s:%d' % (table, row_id)
+
+
+def _id(table, websafeKey):
+    prefix, _, row_id = websafeKey.partition(':')
+    if prefix != table or not row_id.isdigit():
+        raise NotFoundError('No %s found with key: %s' % (table, websafeKey))
+    return int(row_id)
+
+
+def _toColumn(name, value):
+    if name == 'topics':
+        return json.dumps(value or [])
+    if name in DATE_FIELDS and isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def _fromColumn(name, value):
+    if name == 'topics':
+        return json.loads(value)
+    if name == 'deleted':
+        return bool(value)
+    if name in DATE_FIELDS and value:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    return value
+
+
+def _record(table, row):
+    if row is None:
+        return None
+    record = dict((k, _fromColumn(k, row[k])) for k in row.keys())
+    if table == 'session':
+        del record['conference_id']
+    record['key'] = _key(table, record.pop('id'))
+    return record
+
+
+class ConnectionPool(object):
+    """Fixed-size pool of SQLite connections shared across threads."""
+
+    def __init__(self, path, size=4):
+        self._pool = queue.Queue()
+        for _ in range(size):
+            conn = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._pool.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """Run the block in one transaction; roll back on any error."""
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            try:
+                yield conn
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+
+class SqliteRepository(object):
+    """Benchmark engine backed by a SQLite database file; see repository.py."""
+
+    # an in-memory database is private to one connection, so it gets a
+    # single-connection pool
+    def __init__(self, path='conference.db', pool_size=4):
+        self.pool = ConnectionPool(path, 1 if path == ':memory:' else pool_size)
+        with self.pool.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def _getMulti(self, table, websafeKeys):
+        ids = [_id(table, k) for k in websafeKeys]
+        if not ids:
+            return []
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                'SELECT * FROM %s WHERE id IN (%s)' % (
+                    table, ','.join('?' * len(ids))), ids).fetchall()
+        by_id = dict((row['id'], _record(table, row)) for row in rows)
+        return [by_id.get(i) for i in ids]
+
+    def _query(self, table, where, args):
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                'SELECT * FROM %s WHERE %s ORDER BY id' % (table, where),
+                args).fetchall()
+        return [_record(table, row) for row in rows]
+
+    # - - - Profiles - - - - - - - - - - - - - - - - - - - - - -
+
+    def getProfile(self, user_id):
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT * FROM profile WHERE user_id = ?',
+                               (user_id,)).fetchone()
+            keys = [_key('conference', r[0]) for r in conn.execute(
+                'SELECT conference_id FROM registration WHERE user_id = ?',
+                (user_id,))]
+        if row is None:
+            return None
+        record = dict((k, row[k]) for k in PROFILE_FIELDS)
+        record['key'] = 'profile:%s' % user_id
+        record['conferenceKeysToAttend'] = keys
+        return record
+
+    def getOrCreateProfile(self, user_id, displayName, mainEmail):
+        with self.pool.connection() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO profile (user_id, displayName, mainEmail) '
+                'VALUES (?, ?, ?)', (user_id, displayName, mainEmail))
+        return self.getProfile(user_id)
+
+    def saveProfile(self, user_id, fields):
+        fields = dict((k, v) for k, v in fields.items() if k in PROFILE_FIELDS)
+        if fields:
+            with self.pool.connection() as conn:
+                cur = conn.execute(
+                    'UPDATE profile SET %s WHERE user_id = ?' % ', '.join(
+                        '%s = ?' % k for k in fields),
+                    list(fields.values()) + [user_id])
+                if not cur.rowcount:
+                    raise NotFoundError('No profile for user: %s' % user_id)
+        return self.getProfile(user_id)
+
+    # - - - Conferences - - - - - - - - - - - - - - - - - - - - -
+
+    def createConference(self, user_id, data):
+        cols = [f for f in CONFERENCE_FIELDS if f in data]
+        with self.pool.connection() as conn:
+            cur = conn.execute(
+                'INSERT INTO conference (organizerUserId, %s) VALUES (?, %s)' % (
+                    ', '.join(cols), ', '.join('?' * len(cols))),
+                [user_id] + [_toColumn(c, data[c]) for c in cols])
+        return _key('conference', cur.lastrowid)
+
+    def getConference(self, websafeKey):
+        return self.getConferences([websafeKey])[0]
+
+    def getConferences(self, websafeKeys):
+        return [c if c and not c['deleted'] else None
+                for c in self._getMulti('conference', websafeKeys)]
+
+    def updateConference(self, websafeKey, user_id, fields):
+        c_id = _id('conference', websafeKey)
+        cols = [f for f in CONFERENCE_FIELDS if f in fields]
+        with self.pool.transaction(immediate=True) as conn:
+            row = conn.execute('SELECT organizerUserId FROM conference '
+                               'WHERE id = ? AND NOT deleted', (c_id,)).fetchone()
+            if row is None:
+                raise NotFoundError('No conference found with key: %s' % websafeKey)
+            if row[0] != user_id:
+                raise ForbiddenError('Only the owner can update the conference.')
+            if cols:
+                conn.execute(
+                    'UPDATE conference SET %s WHERE id = ?' % ', '.join(
+                        '%s = ?' % c for c in cols),
+                    [_toColumn(c, fields[c]) for c in cols] + [c_id])
+        return self.getConference(websafeKey)
+
+    def deleteConference(self, websafeKey, user_id):
+        c_id = _id('conference', websafeKey)
+        with self.pool.transaction(immediate=True) as conn:
+            row = conn.execute('SELECT organizerUserId, deleted FROM conference '
+                               'WHERE id = ?', (c_id,)).fetchone()
+            if row is None:
+                raise NotFoundError('No conference found with key: %s' % websafeKey)
+            if row[0] != user_id:
+                raise ForbiddenError('Only the owner can delete the conference.')
+            if row[1]:
+                return False
+            conn.execute('UPDATE conference SET deleted = 1 WHERE id = ?', (c_id,))
+        return True
+
+    def conferencesByOrganizer(self, user_id):
+        return self._query('conference', 'organizerUserId = ? AND NOT deleted',
+                           (user_id,))
+
+    # - - - Sessions - - - - - - - - - - - - - - - - - - - - - - -
+
+    def createSession(self, conferenceKey, user_id, data):
+        return self.createSessions(conferenceKey, user_id, [data])[0]
+
+    def createSessions(self, conferenceKey, user_id, datas):
+        c_id = _id('conference', conferenceKey)
+        rows = [[c_id, conferenceKey, user_id] +
+                [_toColumn(f, d.get(f)) for f in SESSION_FIELDS]
+                for d in datas]
+        with self.pool.transaction(immediate=True) as conn:
+            if conn.execute('SELECT 1 FROM conference WHERE id = ? AND NOT deleted',
+                            (c_id,)).fetchone() is None:
+                raise NotFoundError('No conference found with key: %s' % conferenceKey)
+            first = conn.execute('SELECT COALESCE(MAX(id), 0) FROM session').fetchone()[0] + 1
+            conn.executemany(
+                'INSERT INTO session (id, conference_id, websafeKey, organizerUserId, %s) '
+                'VALUES (%s)' % (', '.join(SESSION_FIELDS),
+                                 ', '.join('?' * (len(SESSION_FIELDS) + 4))),
+                [[first + i] + row for i, row in enumerate(rows)])
+        return [_key('session', first + i) for i in range(len(rows))]
+
+    def getSessions(self, websafeKeys):
+        return self._getMulti('session', websafeKeys)
+
+    def sessionsForConference(self, conferenceKey, typeOfSession=None):
+        c_id = _id('conference', conferenceKey)
+        if typeOfSession is None:
+            return self._query('session', 'conference_id = ?', (c_id,))
+        return self._query('session', 'conference_id = ? AND typeOfSession = ?',
+                           (c_id, typeOfSession))
+
+    def sessionsBySpeaker(self, speaker):
+        return self._query('session', 'speaker = ?', (speaker,))
+
+    # - - - Wishlists - - - - - - - - - - - - - - - - - - - - - -
+
+    def addToWishlist(self, user_id, sessionKey):
+        s_id = _id('session', sessionKey)
+        with self.pool.transaction(immediate=True) as conn:
+            if conn.execute(
+                    'SELECT 1 FROM session JOIN conference '
+                    'ON conference.id = session.conference_id '
+                    'WHERE session.id = ? AND NOT conference.deleted',
+                    (s_id,)).fetchone() is None:
+                raise NotFoundError('No session found with key: %s' % sessionKey)
+            cur = conn.execute('INSERT OR IGNORE INTO wishlist (user_id, session_id) '
+                               'VALUES (?, ?)', (user_id, s_id))
+        return cur.rowcount == 1
+
+    def wishlistSessions(self, user_id):
+        return self._query(
+            'session', 'id IN (SELECT session_id FROM wishlist WHERE user_id = ?)',
+            (user_id,))
+
+    def removeFromWishlist(self, user_id, sessionKey):
+        with self.pool.connection() as conn:
+            conn.execute('DELETE FROM wishlist WHERE user_id = ? AND session_id = ?',
+                         (user_id, _id('session', sessionKey)))
+
+    # - - - Registration - - - - - - - - - - - - - - - - - - - - -
+
+    def register(self, user_id, conferenceKey, reg=True):
+        c_id = _id('conference', conferenceKey)
+        with self.pool.transaction(immediate=True) as conn:
+            row = conn.execute('SELECT seatsAvailable FROM conference '
+                               'WHERE id = ? AND NOT deleted', (c_id,)).fetchone()
+            if row is None:
+                raise NotFoundError('No conference found with key: %s' % conferenceKey)
+            registered = conn.execute(
+                'SELECT 1 FROM registration WHERE user_id = ? AND conference_id = ?',
+                (user_id, c_id)).fetchone() is not None
+            if reg:
+                if registered:
+                    raise ConflictError('You have already registered for this conference')
+                if (row[0] or 0) <= 0:
+                    raise ConflictError('There are no seats available.')
+                conn.execute('INSERT INTO registration (user_id, conference_id) '
+                             'VALUES (?, ?)', (user_id, c_id))
+                delta = -1
+            elif registered:
+                conn.execute('DELETE FROM registration '
+                             'WHERE user_id = ? AND conference_id = ?', (user_id, c_id))
+                delta = 1
+            else:
+                return False
+            conn.execute('UPDATE conference SET seatsAvailable = seatsAvailable + ? '
+                         'WHERE id = ?', (delta, c_id))
+        return True
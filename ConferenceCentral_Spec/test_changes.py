@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+test_changes.py -- changes.since() paging against the App Engine testbed
+stubs; run with the SDK on the path:
+
+    python -m unittest test_changes
+
+Entities are stamped with chosen change sequences, and the feed's clock
+is set far past them, so every change is inside the settled horizon.
+
+"""
+
+import unittest
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import changes
+import models
+from models import Conference
+from models import Profile
+from models import Session
+from models import WishList
+
+NOW = 10 ** 12
+
+
+class ChangesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+                probability=1))
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+
+        self.seq = None
+        self._nextChangeSeq = models.nextChangeSeq
+        models.nextChangeSeq = lambda previous=None: self.seq
+        self._now = changes._now
+        changes._now = lambda: NOW
+
+        self.p_key = ndb.Key(Profile, 'organizer')
+        self.c_key = self._conference(1)
+        self.s_key = self._session(2)
+
+    def tearDown(self):
+        models.nextChangeSeq = self._nextChangeSeq
+        changes._now = self._now
+        self.testbed.deactivate()
+
+    def _put(self, entity, seq):
+        self.seq = seq
+        return entity.put()
+
+    def _conference(self, seq, name='Conf'):
+        return self._put(Conference(parent=self.p_key, name=name), seq)
+
+    def _session(self, seq, name='Talk'):
+        s_key = ndb.Key(Session, name, parent=self.c_key)
+        return self._put(Session(key=s_key, name=name, speaker='Speaker',
+                                 startTime=9, websafeKey=self.c_key.urlsafe()), seq)
+
+    def _tombstone(self, seq, key, owner=None):
+        return self._put(changes.tombstone(key, owner), seq)
+
+    def _wish(self, seq, user_id):
+        return self._put(WishList(id=user_id, parent=self.s_key,
+                                  sessionKey=self.s_key.urlsafe(),
+                                  userID=user_id), seq)
+
+    def _drain(self, page_size, user_id=None, token=None):
+        """Follow since() until it has nothing more; return the pages as
+        lists of (changeSeq, key) and the final token."""
+        pages = []
+        for _ in range(100):
+            entities, token, more, resync = changes.since(token, user_id, page_size)
+            self.assertFalse(resync)
+            pages.append([(e.changeSeq, e.key) for e in entities])
+            if not more:
+                return pages, token
+        self.fail('since() never ran out of pages')
+
+    def _seqs(self, pages):
+        return [seq for page in pages for seq, _ in page]
+
+    def testMultiKindPages(self):
+        self._conference(4, 'Conf 2')
+        self._session(5, 'Talk 2')
+        self._tombstone(3, ndb.Key(Session, 'gone', parent=self.c_key))
+        self._tombstone(6, ndb.Key(Session, 'gone 2', parent=self.c_key))
+
+        pages, token = self._drain(2)
+        self.assertEqual(self._seqs(pages), [1, 2, 3, 4, 5, 6])
+        keys = [key for page in pages for _, key in page]
+        self.assertEqual(len(keys), len(set(keys)))
+        for page in pages:
+            self.assertTrue(len(page) <= 2)
+        self.assertEqual(token, str(NOW - changes._seconds(changes.SETTLE_SECONDS)))
+
+    def testEqualSeqAcrossKindsNotSplit(self):
+        self._conference(7, 'Conf 2')
+        self._session(7, 'Talk 2')
+        self._tombstone(7, ndb.Key(Session, 'gone', parent=self.c_key))
+        self._conference(8, 'Conf 3')
+
+        pages, _ = self._drain(2)
+        self.assertEqual(self._seqs(pages), [1, 2, 7, 7, 7, 8])
+        for page in pages:
+            # every change stamped 7 lands on one page
+            if any(seq == 7 for seq, _ in page):
+                self.assertEqual([seq for seq, _ in page].count(7), 3)
+
+    def testEqualSeqWithinOneKindNotSplit(self):
+        for i in range(5):
+            self._conference(3, 'Same %d' % i)
+        self._conference(4, 'After')
+
+        pages, _ = self._drain(2)
+        self.assertEqual(self._seqs(pages), [1, 2, 3, 3, 3, 3, 3, 4])
+
+    def testTombstoneOnlyPages(self):
+        ndb.delete_multi([self.c_key, self.s_key])
+        for seq in range(10, 15):
+            self._tombstone(seq, ndb.Key(Session, 'gone %d' % seq, parent=self.c_key))
+
+        pages, _ = self._drain(2, token='2')
+        self.assertEqual(self._seqs(pages), [10, 11, 12, 13, 14])
+
+    def testWishlistChangesOnlyForOwner(self):
+        w_key = self._wish(3, 'alice')
+        self._wish(4, 'bob')
+        self._tombstone(5, ndb.Key(WishList, 'old', parent=self.s_key), 'alice')
+
+        pages, _ = self._drain(2, user_id='alice')
+        self.assertEqual(self._seqs(pages), [1, 2, 3, 5])
+        self.assertIn((3, w_key), [e for page in pages for e in page])
+        pages, _ = self._drain(2)
+        self.assertEqual(self._seqs(pages), [1, 2])
+
+    def testTokenHandling(self):
+        horizon = NOW - changes._seconds(changes.SETTLE_SECONDS)
+        # nothing new: the token comes back as the horizon
+        self.assertEqual(changes.since(str(horizon)), ([], str(horizon), False, False))
+        # a token from before tombstone retention means a full resync
+        old = horizon - changes._seconds(changes.TOMBSTONE_DAYS * 24 * 3600) - 1
+        self.assertEqual(changes.since(str(old)), ([], None, False, True))
+        self.assertRaises(changes.BadSyncToken, changes.since, 'x')
+        self.assertRaises(changes.BadSyncToken, changes.since, '-1')
+        # a change stamped past the horizon isn't reported yet
+        self._conference(horizon + 1, 'Late')
+        pages, token = self._drain(10)
+        self.assertEqual(self._seqs(pages), [1, 2])
+        self.assertEqual(token, str(horizon))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+test_trending.py -- trending.record() and flush() against the App Engine
+testbed stubs; run with the SDK on the path:
+
+    python -m unittest test_trending
+
+"""
+
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import trending
+from models import Conference
+from models import Profile
+from models import Session
+
+
+class TrendingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+
+        c_key = Conference(parent=ndb.Key(Profile, 'organizer'),
+                           name='Conf').put()
+        self.sessionKey = self._session(c_key, 'Talk')
+        self.otherKey = self._session(c_key, 'Other talk')
+        self.conferenceKey = c_key.urlsafe()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def _session(self, c_key, name):
+        s_key = ndb.Key(Session, name, parent=c_key)
+        Session(key=s_key, name=name, speaker='Speaker', startTime=9,
+                websafeKey=s_key.urlsafe()).put()
+        return s_key.urlsafe()
+
+    def _count(self, sessionKey):
+        shards = ndb.get_multi([trending._shardKey(sessionKey, n)
+                                for n in range(trending.NUM_SHARDS)])
+        return sum(s.count for s in shards if s)
+
+    def testAddThenRemove(self):
+        trending.record(self.sessionKey, 1)
+        trending.record(self.sessionKey, 1)
+        trending.record(self.otherKey, 1)
+        trending.record(self.sessionKey, -1)
+        self.assertEqual(trending.flush(), 2)
+        self.assertEqual(self._count(self.sessionKey), 1)
+        self.assertEqual(self._count(self.otherKey), 1)
+
+        trending.record(self.otherKey, -1)
+        self.assertEqual(trending.flush(), 1)
+        self.assertEqual(self._count(self.otherKey), 0)
+        self.assertEqual(trending.top(), [(self.sessionKey, 'Talk', 1)])
+        self.assertEqual(trending.top(self.conferenceKey),
+                         [(self.sessionKey, 'Talk', 1)])
+
+    def testRemoveBeforeAnyAdd(self):
+        # a remove can reach a delta memcache doesn't hold yet
+        trending.record(self.sessionKey, -1)
+        self.assertEqual(trending.flush(), 1)
+        self.assertEqual(self._count(self.sessionKey), -1)
+        self.assertEqual(trending.top(), [])
+
+    def testRemoveWhenMemcacheFails(self):
+        # offset_multi() reports a failed key as None; record() then
+        # writes the delta to a count shard directly
+        original = memcache.offset_multi
+        memcache.offset_multi = lambda mapping, **kwargs: dict.fromkeys(mapping)
+        try:
+            trending.record(self.sessionKey, -1)
+        finally:
+            memcache.offset_multi = original
+        self.assertEqual(self._count(self.sessionKey), -1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+trending.py -- most wishlisted sessions, per conference and overall
+
+Wishlist adds and removes don't touch the datastore: record() adds the
+change to a per-session delta in memcache and, the first time a session
+changes since the last flush, appends its key to a memcache log.  Every
+minute flush() drains the log, moves each delta into one random
+WishlistCountShard of its session, sums the shards and re-ranks the
+touched Leaderboards, which keep TOP_K entries (plus headroom, so a
+session can drop out and another move up without a rebuild).  A
+leaderboard read is one memcache get, backed by one get by key.
+
+Deltas only live in memcache until the next flush, so an eviction in
+between loses them; counts are approximate, which a trending widget
+tolerates.  When memcache is down record() writes to a shard directly.
+
+"""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Leaderboard
+from models import WishlistCountShard
+
+GLOBAL = 'global'
+TOP_K = 10
+STORED_K = 3 * TOP_K
+NUM_SHARDS = 4
+BATCH_SIZE = 200
+
+DELTA_PREFIX = 'TRENDING:delta:'
+DIRTY_PREFIX = 'TRENDING:dirty:'
+LOG_PREFIX = 'TRENDING:log:'
+LOG_HEAD = 'TRENDING:head'
+LOG_TAIL = 'TRENDING:tail'
+BOARD_PREFIX = 'TRENDING:board:'
+# deltas are stored offset, as memcache counters can't go below zero
+OFFSET = 1 << 32
+# a session whose log entry was evicted is logged again after this
+DIRTY_TIME = 10 * 60
+BOARD_TIME = 10 * 60
+
+
+def _shardKey(sessionKey, n):
+    return ndb.Key(WishlistCountShard, '%s:%d' % (sessionKey, n))
+
+
+@ndb.transactional()
+def _addToShard(sessionKey, delta):
+    key = _shardKey(sessionKey, random.randrange(NUM_SHARDS))
+    shard = key.get() or WishlistCountShard(key=key)
+    shard.count += delta
+    shard.put()
+
+
+def record(sessionKey, delta):
+    """Buffer a wishlist add (delta 1) or remove (delta -1)."""
+    # incr() rejects negative deltas; offset_multi() takes either sign
+    offsets = memcache.offset_multi({sessionKey: delta}, key_prefix=DELTA_PREFIX,
+                                    initial_value=OFFSET)
+    if offsets.get(sessionKey) is None:
+        _addToShard(sessionKey, delta)
+        return
+    if memcache.add(DIRTY_PREFIX + sessionKey, 1, time=DIRTY_TIME):
+        slot = memcache.incr(LOG_HEAD, initial_value=0)
+        if slot is not None:
+            memcache.set(LOG_PREFIX + str(slot), sessionKey)
+
+
+def _drainLog():
+    """Return the session keys logged since the last flush."""
+    head = memcache.get(LOG_HEAD) or 0
+    tail = memcache.get(LOG_TAIL) or 0
+    if tail > head:
+        # the head counter was evicted and started over
+        tail = 0
+    slots = [str(i) for i in range(tail + 1, head + 1)]
+    sessionKeys = set()
+    for i in range(0, len(slots), BATCH_SIZE):
+        batch = slots[i:i + BATCH_SIZE]
+        sessionKeys.update(memcache.get_multi(batch, key_prefix=LOG_PREFIX).values())
+        memcache.delete_multi(batch, key_prefix=LOG_PREFIX)
+    memcache.set(LOG_TAIL, head)
+    return sorted(sessionKeys)
+
+
+def _takeDeltas(sessionKeys):
+    """Return {sessionKey: delta} for sessionKeys, zeroing their
+    buffered deltas."""
+    # clear the markers first, so a change from here on is logged again
+    memcache.delete_multi(sessionKeys, key_prefix=DIRTY_PREFIX)
+    values = memcache.get_multi(sessionKeys, key_prefix=DELTA_PREFIX)
+    deltas = dict((k, int(v) - OFFSET) for k, v in values.items()
+                  if int(v) != OFFSET)
+    # subtract what was read rather than reset, keeping concurrent changes
+    memcache.offset_multi(dict((k, -d) for k, d in deltas.items()),
+                          key_prefix=DELTA_PREFIX)
+    return deltas
+
+
+def _entries(board):
+    if not board:
+        return []
+    return list(zip(board.sessionKeys, board.names, board.counts))
+
+
+@ndb.transactional()
+def _rerank(board_id, changed, dropped=()):
+    """Merge {sessionKey: (name, count)} into a leaderboard, drop the
+    given session keys, and return its entries."""
+    key = ndb.Key(Leaderboard, board_id)
+    board = key.get() or Leaderboard(key=key)
+    entries = dict((k, (name, n)) for k, name, n in _entries(board))
+    entries.update(changed)
+    for k in dropped:
+        entries.pop(k, None)
+    ranked = sorted(((k, name, n) for k, (name, n) in entries.items() if n > 0),
+                    key=lambda e: (-e[2], e[0]))[:STORED_K]
+    board.sessionKeys = [k for k, _, _ in ranked]
+    board.names = [name for _, name, _ in ranked]
+    board.counts = [n for _, _, n in ranked]
+    board.put()
+    return ranked
+
+
+def _cache(board_id, entries):
+    memcache.set(BOARD_PREFIX + board_id, entries[:TOP_K], time=BOARD_TIME)
+
+
+def flush():
+    """Move buffered deltas into count shards and re-rank the affected
+    leaderboards; return the number of sessions updated."""
+    deltas = _takeDeltas(_drainLog())
+    for sessionKey, delta in deltas.items():
+        _addToShard(sessionKey, delta)
+    if not deltas:
+        return 0
+
+    sessionKeys = sorted(deltas)
+    shards = ndb.get_multi([_shardKey(k, n) for k in sessionKeys
+                            for n in range(NUM_SHARDS)])
+    sessions = ndb.get_multi([ndb.Key(urlsafe=k) for k in sessionKeys])
+    changed, dropped, by_conference = {}, [], {}
+    for i, sessionKey in enumerate(sessionKeys):
+        sess = sessions[i]
+        if sess is None:
+            dropped.append(sessionKey)
+            continue
+        total = sum(s.count for s in shards[i * NUM_SHARDS:(i + 1) * NUM_SHARDS] if s)
+        changed[sessionKey] = (sess.name, total)
+        by_conference.setdefault(sess.key.parent().urlsafe(), {})[sessionKey] = \
+            changed[sessionKey]
+
+    for conferenceKey, board_changes in by_conference.items():
+        _cache(conferenceKey, _rerank(conferenceKey, board_changes))
+    _cache(GLOBAL, _rerank(GLOBAL, changed, dropped))
+    return len(deltas)
+
+
+def top(board_id=GLOBAL, limit=TOP_K):
+    """Return [(sessionKey, name, count)] for a leaderboard, best first."""
+    entries = memcache.get(BOARD_PREFIX + board_id)
+    if entries is None:
+        entries = _entries(ndb.Key(Leaderboard, board_id).get())
+        _cache(board_id, entries)
+    return entries[:min(limit, TOP_K)]
+
+
+def forget(conferenceKey):
+    """Drop a deleted conference's leaderboard and its sessions from the
+    global one."""
+    board = ndb.Key(Leaderboard, conferenceKey).get()
+    if board:
+        _cache(GLOBAL, _rerank(GLOBAL, {}, board.sessionKeys))
+        board.key.delete()
+    memcache.delete(BOARD_PREFIX + conferenceKey)
+
+
+def forgetSessions(sessionKeys):
+    """Drop the count shards and buffered deltas of deleted sessions."""
+    if sessionKeys:
+        ndb.delete_multi([_shardKey(k, n) for k in sessionKeys
+                          for n in range(NUM_SHARDS)])
+        memcache.delete_multi(sessionKeys, key_prefix=DELTA_PREFIX)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+unitofwork.py -- change-tracked, coalesced writes for ndb entities
+
+Entities read during a request (or transaction) are tracked with a
+snapshot of their property values; new entities are added as always
+dirty.  commit() writes only the entities whose values actually changed,
+all in a single put_multi, and counts the writes that were skipped.
+
+    uow = unitofwork.UnitOfWork()
+    prof = uow.track(p_key.get())
+    prof.displayName = 'New name'
+    uow.commit()            # one put, or none if nothing changed
+
+"""
+
+import copy
+import threading
+
+from google.appengine.ext import ndb
+
+_lock = threading.Lock()
+_stats = {
+    'commits': 0,
+    'writes': 0,
+    'writes_saved': 0,
+}
+
+
+def _count(**deltas):
+    with _lock:
+        for name, n in deltas.items():
+            _stats[name] += n
+
+
+def _snapshot(entity):
+    return copy.deepcopy(entity.to_dict())
+
+
+class UnitOfWork(object):
+    """Collects entity changes and writes the dirty ones in one batch."""
+
+    def __init__(self):
+        self._tracked = []
+        self._snapshots = {}
+        self.written = []
+
+    def track(self, entity):
+        """Start tracking an existing entity; returns it for chaining."""
+        if entity is not None and id(entity) not in self._snapshots:
+            self._snapshots[id(entity)] = _snapshot(entity)
+            self._tracked.append(entity)
+        return entity
+
+    def add(self, entity):
+        """Register a new entity, which is always written on commit."""
+        if id(entity) not in self._snapshots:
+            self._snapshots[id(entity)] = None
+            self._tracked.append(entity)
+        return entity
+
+    def dirty(self):
+        """Return the tracked entities that are new or have changed."""
+        return [e for e in self._tracked
+                if self._snapshots[id(e)] is None or
+                _snapshot(e) != self._snapshots[id(e)]]
+
+    def commit(self):
+        """Write every dirty entity with one put_multi; return their keys."""
+        dirty = self.dirty()
+        self.written = ndb.put_multi(dirty) if dirty else []
+        _count(commits=1, writes=len(dirty),
+               writes_saved=len(self._tracked) - len(dirty))
+        # written entities become the new baseline
+        for entity in dirty:
+            self._snapshots[id(entity)] = _snapshot(entity)
+        return self.written
+
+
+def stats():
+    """Return a snapshot of write counters for this instance."""
+    with _lock:
+        return dict(_stats)
@@ -1,10 +1,10 @@
 import json
 import os
 import time
-import uuid
 
 from google.appengine.api import urlfetch
 from models import Profile
+import identity
 
 def getUserId(user, id_type="email"):
     if id_type == "email":
@@ -35,11 +35,6 @@ def getUserId(user, id_type="email"):
         return user.get('user_id', '')
 
     if id_type == "custom":
-        # implement your own user_id creation and getting algorythm
-        # this is just a sample that queries datastore for an existing profile
-        # and generates an id if profile does not exist for an email
-        profile = Conference.query(Conference.mainEmail == user.email())
-        if profile:
-            return profile.id()
-        else:
-            return str(uuid.uuid1().get_hex())
+        # a stable id per normalized email, minted once in an EmailIndex
+        # entity and then served from the identity caches
+        return identity.userIdForEmail(user.email())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+warmup.py -- /_ah/warmup work for new instances
+
+Imports and initialises the API service, builds the protorpc field tables
+for every form message, and primes the memcache entries and entity cache
+pages that the first user requests would otherwise pay for.
+
+"""
+
+import logging
+import time
+
+from protorpc import messages
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import conference
+import entitycache
+import models
+from conference import ConferenceApi
+from models import Conference
+from models import Profile
+from models import Session
+
+# size of the default "Show Conferences" page primed into the entity cache
+CONFERENCE_PAGE_SIZE = 20
+
+
+def _loadApi():
+    """Touch the endpoints server and service so both are fully built."""
+    return conference.api, ConferenceApi.all_remote_methods()
+
+
+def _compileForms():
+    """Walk every message class once so field lookup tables are built."""
+    count = 0
+    for value in vars(models).values():
+        if (isinstance(value, type) and issubclass(value, messages.Message)
+                and value is not messages.Message):
+            value.all_fields()
+            value()
+            count += 1
+    return count
+
+
+def _primeAnnouncement():
+    if memcache.get(conference.MEMCACHE_ANNOUNCEMENTS_KEY) is None:
+        ConferenceApi._cacheAnnouncement()
+
+
+def _primeFeaturedSpeaker():
+    if memcache.get(conference.FEATURED_SPEAKER) is None:
+        ConferenceApi._cacheFeaturedSpeaker()
+
+
+def _primeConferencePage():
+    """Load the first conference page, its organizers and sessions."""
+    keys = Conference.query().order(Conference.name).fetch(
+        CONFERENCE_PAGE_SIZE, keys_only=True)
+    confs = [c for c in entitycache.get_multi(keys) if c]
+    entitycache.get_multi(
+        [ndb.Key(Profile, c.organizerUserId) for c in confs])
+    session_keys = []
+    for c_key in keys:
+        session_keys.extend(
+            Session.query(ancestor=c_key).fetch(keys_only=True))
+    entitycache.get_multi(session_keys)
+    return len(confs)
+
+
+def warm():
+    """Run every warmup step, returning {step: milliseconds}."""
+    timings = {}
+    start = time.time()
+    for name, step in (('api', _loadApi),
+                       ('forms', _compileForms),
+                       ('announcement', _primeAnnouncement),
+                       ('featured_speaker', _primeFeaturedSpeaker),
+                       ('conference_page', _primeConferencePage)):
+        began = time.time()
+        try:
+            step()
+        except Exception:
+            # a cold cache is only slower; never fail the instance start
+            logging.exception('warmup step %s failed', name)
+        timings[name] = int((time.time() - began) * 1000)
+    timings['total'] = int((time.time() - start) * 1000)
+    logging.info('warmup timings (ms): %s', timings)
+    return timings